@@ -0,0 +1,416 @@
+"""
+Benchmarks for smoking model
+
+Builds synthetic inputs of a controlled difficulty and times the stages of runs
+(building the outputs and tables, the patient loop, merging the blocks and writing
+the outputs) at several runsizes and worker counts. Results are saved as json so
+that runs on different revisions or engines can be compared.
+"""
+
+from inputs import *
+from outputs import *
+from sim import *
+from profiling import get_peak_rss
+import json, multiprocessing, platform, shutil, sys, tempfile, time
+from concurrent.futures import ProcessPoolExecutor
+
+#root seed of benchmark runs so that every run simulates the same patients
+BENCHMARK_SEED = 12345
+
+#ages of the lifetables in the inputs
+NUM_LIFETABLE_AGES = 101
+
+#difficulty of synthetic inputs.
+#event_scale multiplies the incidence of pre-events, events and complications,
+#num_active is the number of prophs and interventions patients can start and
+#maxage the age patients are followed until
+class Difficulty(object):
+    def __init__(self, event_scale = 1.0, num_active = NUM_PROPHS, maxage = 100):
+        if maxage >= NUM_LIFETABLE_AGES:
+            raise ValueError("maxage {0} is past the end of the lifetables".format(maxage))
+        if not 0 <= num_active <= min(NUM_PROPHS, NUM_INTERVENTIONS):
+            raise ValueError("num_active {0} is not between 0 and {1}".format(num_active, NUM_PROPHS))
+        self.event_scale = event_scale
+        self.num_active = num_active
+        self.maxage = maxage
+    def __repr__(self):
+        return "Difficulty(event_scale={0}, num_active={1}, maxage={2})".format(self.event_scale,
+                                                                                self.num_active, self.maxage)
+
+DIFFICULTIES = {"easy": Difficulty(0.25, 2, 85),
+                "medium": Difficulty(1.0, 5, 95),
+                "hard": Difficulty(4.0, NUM_PROPHS, 100),
+                }
+
+#difficulty by name or the Difficulty itself
+def get_difficulty(difficulty):
+    if isinstance(difficulty, Difficulty):
+        return difficulty
+    if difficulty not in DIFFICULTIES:
+        raise ValueError("unknown difficulty {0}".format(difficulty))
+    return DIFFICULTIES[difficulty]
+
+#shape of the value xl_get_range reads from address, None for a single cell
+def get_address_shape(address):
+    if ":" not in address and ";" not in address:
+        return None
+    start, end = address.replace(";", ":").split(":")
+    startrow, startcol = xl_cell_to_rowcol(start)
+    endrow, endcol = xl_cell_to_rowcol(end)
+    num_rows, num_cols = endrow-startrow+1, endcol-startcol+1
+    #col slices have a row for each col
+    if ";" in address:
+        num_rows, num_cols = num_cols, num_rows
+    if num_rows == 1:
+        return (num_cols,)
+    return (num_rows, num_cols)
+
+#gompertz monthly probabilities of death by age, with mult for smokers
+def get_synthetic_lifetable(shape, mult):
+    ages = np.arange(NUM_LIFETABLE_AGES)
+    prob = 1-np.exp(-0.0004*np.exp(0.085*ages)/12)
+    return np.broadcast_to(np.minimum(prob*mult, 0.9), shape).copy()
+
+#value of one input of the synthetic inputs. rs draws the values that are not
+#fixed and difficulty scales the ones it controls
+def get_synthetic_value(tabvar, varname, shape, rs, difficulty):
+    scale = difficulty.event_scale
+    if tabvar == "sim":
+        return {"runsize": 1000,
+                "disc_rate_year": 0.03,
+                "rand_seed": False,
+                "event_names": np.array(["Event {0}".format(event) for event in range(NUM_EVENTS)]),
+                "maxage": difficulty.maxage}[varname]
+    if tabvar == "init":
+        if varname == "age_dist":
+            #mean, std, min and max age in months
+            return np.array([480.0, 150.0, 0.0, 1100.0])
+        if varname == "quit_dist":
+            return np.array([60.0, 80.0])
+        if varname == "sex_dist":
+            return np.array([0.5, 0.5])
+        return rs.uniform(0.2, 1.0, shape)
+    if tabvar == "nathist":
+        if varname.endswith("usemult"):
+            return True
+        if varname == "ns_lifetable":
+            return get_synthetic_lifetable(shape, 1.0)
+        if varname == "xs_lifetable":
+            return get_synthetic_lifetable(shape, 1.2)
+        if varname == "cs_lifetable":
+            return get_synthetic_lifetable(shape, 1.5)
+        if varname == "trans":
+            return np.array([6, 120])
+        return rs.uniform(1.0, 2.5, shape)
+    if tabvar == "smoking":
+        if varname == "start_prob":
+            return np.full(shape, 0.002)
+        if varname == "quit_prob":
+            return np.full(shape, 0.01)
+        if varname.endswith("duration"):
+            return rs.randint(3, 24, shape)
+        if varname == "relapse_coeffs":
+            coeffs = np.empty(shape)
+            coeffs[..., 0] = 0.05
+            coeffs[..., 1] = -0.03
+            return coeffs
+        return rs.uniform(0.01, 0.05, shape)
+    if tabvar in ("pre_events", "events"):
+        if varname.endswith("_trans"):
+            return np.tile([6, 120], (shape[0], 1))
+        if varname in ("pevent_inc_baseline", "pevent_to_event_prob", "screening_background_prob",
+                       "event_inc_baseline", "event_comp_baseline"):
+            return np.minimum(rs.uniform(0.0, 0.002*scale, shape), 1.0)
+        if "_mult_curr" in varname or "_mult_ex" in varname:
+            return rs.uniform(1.0, 3.0, shape)
+        if varname in ("screening_sensitivity", "screening_specificity"):
+            return rs.uniform(0.7, 0.95, shape)
+        if varname == "screening_regular_start_age":
+            return np.tile([[40], [50], [45]], (1, shape[1]))
+        if varname == "screening_regular_interval":
+            return np.full(shape, 24)
+        if varname == "screening_regular_max":
+            return rs.randint(0, 6, shape)
+        if varname == "screening_regular_prob_skip":
+            return np.full(shape, 0.2)
+        if varname == "screening_conf_delay":
+            return rs.randint(0, 4, shape)
+        if varname == "screening_outcome_proph":
+            #proph started after detection, one based with 0 for none
+            return rs.randint(0, difficulty.num_active+1, shape)
+        if varname == "screening_outcome_intervention":
+            return rs.rand(*shape) < 0.5
+        if varname.startswith("screening_"):
+            return rs.uniform(0.0, 0.3, shape)
+        #mortality of pre-events and probability of death of events
+        return rs.uniform(0.0, 0.2, shape)
+    if tabvar in ("prophs", "intervention"):
+        if varname.endswith("_names"):
+            prefix = "Proph" if tabvar == "prophs" else "Intervention"
+            return np.array(["{0} {1}".format(prefix, n) for n in range(shape[0])])
+        if varname in ("start_prob_month", "start_prob_init"):
+            #only the active prophs and interventions are ever started
+            prob = rs.uniform(0.0, 0.01, shape)
+            prob[..., difficulty.num_active:] = 0.0
+            return prob
+        if varname == "stop_prob_month":
+            return rs.uniform(0.0, 0.05, shape)
+        if varname in ("eff_events", "eff_comp"):
+            return rs.uniform(0.5, 1.0, shape)
+        if varname == "tox_prob":
+            return rs.uniform(0.0, 0.02, shape)
+        if varname == "tox_dth_prob":
+            return rs.uniform(0.0, 0.2, shape)
+        if varname in ("stop_on_tox", "allow_restart_on_tox", "stop_on_quit"):
+            return rs.rand(*shape) < 0.5
+        if varname == "stop_abst_duration":
+            return rs.randint(-1, 24, shape)
+        if varname == "duration":
+            return rs.randint(3, 24, shape)
+        #start and quit multipliers
+        return rs.uniform(0.5, 2.0, shape)
+    if tabvar == "costs":
+        if varname == "bkgd_trans":
+            return 12
+        return rs.uniform(10, 1000, shape)
+    if tabvar == "qol":
+        if varname == "enable_qol":
+            return True
+        if varname == "quit_duration":
+            return rs.randint(3, 24, shape)
+        return rs.uniform(0.7, 1.0, shape)
+    raise ValueError("no synthetic value for {0}.{1}".format(tabvar, varname))
+
+#inputs with synthetic values laid out as INPUTS. The same seed and difficulty
+#always give the same inputs
+def make_synthetic_inputs(difficulty = "medium", runsize = 1000, seed = 0):
+    difficulty = get_difficulty(difficulty)
+    rs = np.random.RandomState(seed)
+    inputs = Inputs()
+    for sheetname, sheetvar in TABS:
+        setattr(inputs, sheetvar, Tab(sheetname))
+        inputs.tabnames.append(sheetvar)
+    for sheetname, sheetvar in TABS:
+        for label, varname, address, tp in INPUTS[sheetvar]:
+            if callable(address):
+                #prevalence of events at init
+                shape = (NUM_EVENTS, len(GENDERS), len(SS), len(SI), len(AGE_BRACKETS))
+                value = np.minimum(rs.uniform(0.0, 0.05*difficulty.event_scale, shape), 1.0)
+            elif isinstance(varname, tuple):
+                base, full_shape, index = varname
+                value = get_synthetic_value(sheetvar, base, full_shape[1:], rs, difficulty)
+            else:
+                value = get_synthetic_value(sheetvar, varname, get_address_shape(address), rs, difficulty)
+            if tp == int and isinstance(value, np.ndarray):
+                value = value.astype(int)
+            getattr(inputs, sheetvar).add_input(varname, value)
+    inputs.sim.runsize = runsize
+    return inputs
+
+############################################################################################################
+#timing
+
+#times the stages of one run. args is (difficulty, seed, engine, runsize, workers).
+#Run in a process of its own so that peak memory is of this run only
+def run_case(args):
+    difficulty, seed, engine, runsize, workers = args
+    seconds = {}
+    start = time.perf_counter()
+    inputs = make_synthetic_inputs(difficulty, runsize, seed)
+    seconds["inputs"] = time.perf_counter()-start
+
+    folder = tempfile.mkdtemp(prefix = "smbench")
+    try:
+        #outputs and tables
+        start = time.perf_counter()
+        s = Sim(engine, workers = workers, seed = BENCHMARK_SEED)
+        s.input_path = os.path.join(folder, "benchmark.smin")
+        s.inputs = inputs
+        s.init_outputs()
+        s.init_run()
+        seconds["init"] = time.perf_counter()-start
+
+        #patient loop and merging of the blocks, timed apart as the blocks arrive
+        pool = ProcessPoolExecutor(workers) if workers > 1 else None
+        try:
+            start = time.perf_counter()
+            blocks = s.get_blocks()
+            pending = map(run_block, blocks) if pool is None else pool.map(run_block, blocks)
+            seconds["aggregate"] = 0.0
+            for block in pending:
+                merge_start = time.perf_counter()
+                s.results.merge(block)
+                seconds["aggregate"] += time.perf_counter()-merge_start
+            seconds["loop"] = time.perf_counter()-start-seconds["aggregate"]
+        finally:
+            if pool is not None:
+                pool.shutdown()
+
+        start = time.perf_counter()
+        s.write_outputs()
+        seconds["write"] = time.perf_counter()-start
+    finally:
+        shutil.rmtree(folder)
+    seconds["total"] = seconds["init"]+seconds["loop"]+seconds["aggregate"]+seconds["write"]
+
+    patient_months = float(np.sum(patient_sum(s.disc_outputs.undisc.lms)))
+    return {"engine": engine,
+            "runsize": runsize,
+            "workers": workers,
+            "seconds": seconds,
+            "patient_months": patient_months,
+            "patient_months_per_second": patient_months/seconds["loop"],
+            "peak_rss_kb": get_peak_rss(),
+            "peak_rss_workers_kb": get_peak_rss(children = True) if workers > 1 else None}
+
+#speedup and scaling efficiency of each case over the one worker case of the same
+#engine and runsize, None without one
+def add_scaling(cases):
+    serial = {(case["engine"], case["runsize"]): case for case in cases if case["workers"] == 1}
+    for case in cases:
+        base = serial.get((case["engine"], case["runsize"]))
+        if base is None:
+            case["speedup"] = case["efficiency"] = None
+        else:
+            case["speedup"] = case["patient_months_per_second"]/base["patient_months_per_second"]
+            case["efficiency"] = case["speedup"]/case["workers"]
+
+def get_machine_info():
+    return {"platform": platform.platform(),
+            "processor": platform.processor(),
+            "cpu_count": os.cpu_count(),
+            "python": platform.python_version(),
+            "numpy": np.__version__}
+
+#times every engine, runsize and worker count. Each case is run repeats times
+#in a new process and the fastest run is kept
+def run_benchmark(difficulty = "medium", runsizes = (1000, 4000), workers = (1, 2),
+                  engines = ("patient", "cohort"), repeats = 1, seed = 0):
+    context = multiprocessing.get_context("spawn")
+    cases = []
+    for engine in engines:
+        for runsize in runsizes:
+            for num_workers in workers:
+                runs = []
+                for repeat in range(repeats):
+                    with ProcessPoolExecutor(1, mp_context = context) as runner:
+                        args = (difficulty, seed, engine, runsize, num_workers)
+                        runs.append(runner.submit(run_case, args).result())
+                case = min(runs, key = lambda run: run["seconds"]["total"])
+                case["repeats"] = repeats
+                print("{0} runsize {1} workers {2}: {3:.0f} patient months/s".format(
+                    engine, runsize, num_workers, case["patient_months_per_second"]))
+                cases.append(case)
+    add_scaling(cases)
+    return {"machine": get_machine_info(),
+            "difficulty": repr(get_difficulty(difficulty)),
+            "seed": seed,
+            "cases": cases}
+
+def write_benchmark(filepath, results):
+    with open(filepath, "w") as fout:
+        json.dump(results, fout, indent = 1)
+
+#ratio of the throughput of each case of results to the same case of baseline.
+#Cases slower by more than tolerance are returned as regressions
+def compare_benchmarks(baseline, results, tolerance = 0.1):
+    base = {(case["engine"], case["runsize"], case["workers"]): case for case in baseline["cases"]}
+    ratios = []
+    regressions = []
+    for case in results["cases"]:
+        key = (case["engine"], case["runsize"], case["workers"])
+        if key not in base:
+            continue
+        ratio = case["patient_months_per_second"]/base[key]["patient_months_per_second"]
+        ratios.append(key+(ratio,))
+        if ratio < 1-tolerance:
+            regressions.append(key+(ratio,))
+    return ratios, regressions
+
+############################################################################################################
+#reproducibility
+
+#bytes of the .smout of one run of inputs, written in folder
+def get_output_bytes(inputs, engine, workers, folder):
+    s = Sim(engine, workers = workers, seed = BENCHMARK_SEED)
+    s.input_path = os.path.join(folder, "{0}_{1}.smin".format(engine, workers))
+    s.inputs = inputs
+    s.init_outputs()
+    s.run()
+    with open(os.path.splitext(s.input_path)[0]+".smout", "rb") as fin:
+        return fin.read()
+
+#runs inputs with one worker and with each of workers and returns the worker counts
+#whose .smout is not byte identical to the one worker run. Only runs of more than
+#BLOCK_SIZE patients spread their blocks over the workers
+def check_workers(inputs, engine = "patient", workers = (2,)):
+    folder = tempfile.mkdtemp(prefix = "smcheck")
+    try:
+        serial = get_output_bytes(inputs, engine, 1, folder)
+        return [num_workers for num_workers in workers
+                if get_output_bytes(inputs, engine, num_workers, folder) != serial]
+    finally:
+        shutil.rmtree(folder)
+
+#runs inputs with each of engines and returns the engines whose .smout is not byte
+#identical to the one of the first. The cohort engine must match the patient engine.
+#The event engine samples its waits with other draws so it only agrees in distribution
+def check_engines(inputs, engines = ("patient", "cohort")):
+    folder = tempfile.mkdtemp(prefix = "smcheck")
+    try:
+        first = get_output_bytes(inputs, engines[0], 1, folder)
+        return [engine for engine in engines[1:] if get_output_bytes(inputs, engine, 1, folder) != first]
+    finally:
+        shutil.rmtree(folder)
+
+#python benchmark.py [--difficulty easy|medium|hard] [--runsizes 1000,4000] [--workers 1,2]
+#[--engines patient,cohort] [--repeats N] [--out FILE] [--baseline FILE] [--save-inputs FILE]
+#python benchmark.py --check-workers 2,3 [--inputs FILE] [--difficulty ...] [--runsizes 4000] [--engines ...]
+#python benchmark.py --check-engines [--inputs FILE] [--difficulty ...] [--runsizes 4000] [--engines ...]
+if __name__ == "__main__":
+    difficulty = pop_option(sys.argv, "--difficulty", "medium")
+    runsizes = [int(n) for n in pop_option(sys.argv, "--runsizes", "1000,4000").split(",")]
+    workers = [int(n) for n in pop_option(sys.argv, "--workers", "1,2").split(",")]
+    engines = pop_option(sys.argv, "--engines", "patient,cohort").split(",")
+    repeats = int(pop_option(sys.argv, "--repeats", 1))
+    outpath = pop_option(sys.argv, "--out", "benchmark.json")
+    baseline = pop_option(sys.argv, "--baseline")
+    inputs_path = pop_option(sys.argv, "--save-inputs")
+    check = pop_option(sys.argv, "--check-workers")
+    check_engine = pop_flag(sys.argv, "--check-engines")
+    check_path = pop_option(sys.argv, "--inputs")
+    if check is not None or check_engine:
+        #the .smout of every engine must not depend on the worker count and the
+        #engines must agree. Runs the input file at its own runsize or synthetic
+        #inputs at the largest runsize
+        if check_path is None:
+            inputs = make_synthetic_inputs(difficulty, max(runsizes))
+        else:
+            loader = Sim()
+            loader.load_inputs(check_path)
+            inputs = loader.inputs
+        mismatched = []
+        if check_engine:
+            for engine in check_engines(inputs, engines):
+                print("{0}: .smout differs from {1}".format(engine, engines[0]))
+                mismatched.append(engine)
+        if check is not None:
+            for engine in engines:
+                for num_workers in check_workers(inputs, engine, [int(n) for n in check.split(",")]):
+                    print("{0} workers {1}: .smout differs from workers 1".format(engine, num_workers))
+                    mismatched.append((engine, num_workers))
+        sys.exit(1 if mismatched else 0)
+    if inputs_path is not None:
+        #the synthetic inputs as a text input file that sim.py can run
+        make_synthetic_inputs(difficulty, runsizes[0]).save_txt(inputs_path)
+        sys.exit()
+
+    results = run_benchmark(difficulty, runsizes, workers, engines, repeats)
+    write_benchmark(outpath, results)
+    if baseline is not None:
+        with open(baseline) as fin:
+            ratios, regressions = compare_benchmarks(json.load(fin), results)
+        for engine, runsize, num_workers, ratio in ratios:
+            print("{0} runsize {1} workers {2}: {3:.2f}x baseline".format(engine, runsize, num_workers, ratio))
+        if regressions:
+            sys.exit(1)
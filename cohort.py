@@ -0,0 +1,935 @@
+"""
+The vectorized cohort object for smoking model
+
+Steps every live patient of a cohort one month at a time.  Each updater
+mirrors the one of the same name in patient.py but runs as a few numpy
+operations over the index array of the patients it applies to.
+"""
+
+from enums import *
+from inputs import *
+from outputs import *
+from streams import *
+from tables import *
+
+AGE_BRACKET_BOUNDS = np.array(AGE_BRACKETS, dtype = float)
+
+#month value used for regular screens that are not scheduled
+NO_SCREEN = np.iinfo(np.int64).max
+
+#per patient state arrays. Compacted each month to the live patients
+STATE_VARS = ["pid","row","stream_key","gender","age","agecat","ss","si","month_of_quit","agequit_cat",
+              "disc_factor","qol","isalive","ever_quit","ever_relapse",
+              "month_of_reg_screen","num_reg_screens","month_of_conf","is_detected_pevent",
+              "has_int","month_start_int","has_int_tox_hist","ever_start_any_int",
+              "has_proph","has_proph_tox_hist",
+              "events","month_of_event","month_of_comp","has_comp",
+              "mort_nodeath","mort_risks"]
+
+#gets the index of the age category for an array of ages in months
+def get_age_cats(agemonths):
+    return np.searchsorted(AGE_BRACKET_BOUNDS, agemonths/12, side = "right")
+
+#vectorized draw_dist. weights is (K,) or (N,K), u are the uniform draws
+def draw_dists(weights, u):
+    cum = np.cumsum(weights, axis = -1)
+    randnum = u*cum[...,-1]
+    choice = (randnum[:,None] > np.atleast_2d(cum)).sum(axis = 1)
+    return np.minimum(choice, cum.shape[-1]-1)
+
+#bitmask of the set columns of each row of a boolean state matrix
+def get_masks(flags):
+    return flags @ (1 << np.arange(flags.shape[1]))
+
+######################################################################
+#All helpers take idx, an index array into the live patients, and values
+#that are either scalars or arrays aligned with idx
+class Cohort(object):
+    #seed is the root seed of the run that each patient's random stream is spawned from
+    def __init__(self, pids, inputs, outputs, disc_outputs, monthly_outputs, seed = 0):
+        self.inputs = inputs
+        self.outputs = outputs
+        self.disc_outputs = disc_outputs
+        self.monthly_outputs = monthly_outputs
+        #step of the random streams. 0 for init and month+1 after
+        self.step = 0
+        #calendar month of run
+        self.month = 0
+        #number of patient months simulated
+        self.num_months = 0
+
+        self.update_qol = self.inputs.qol.enable_qol
+        self.tables = get_tables(inputs)
+
+        self.pid = np.asarray(pids, dtype = np.int64)
+        #row of each patient in the outputs
+        self.row = self.pid - outputs.first_pid
+        n = self.n = self.pid.size
+        self.stream_key = patient_keys(seed, self.pid)
+        self.every = np.arange(n)
+
+        self.isalive = np.ones(n, bool)
+        #overall_costs cells of the patients, see get_cost_cells
+        self.cost_cells = None
+        #monthly costs of the month and list outputs of the cohort by name, kept until
+        #they can be added in pid order as the patients of the patient engine add them
+        self.month_costs = {}
+        self.list_outs = {}
+
+        #month of next regular screening
+        self.month_of_reg_screen = np.full((n, NUM_EVENTS), NO_SCREEN, np.int64)
+        self.num_reg_screens = np.zeros((n, NUM_EVENTS), np.int64)
+        self.month_of_conf = np.full((n, NUM_EVENTS), -1, np.int64)
+        self.is_detected_pevent = np.zeros((n, NUM_EVENTS), bool)
+
+        #mortality risks. Survival product and summed risk by cause
+        self.mort_nodeath = np.ones(n)
+        self.mort_risks = np.zeros((n, len(DTH_CAUSES)))
+
+        #smoking
+        self.ever_quit = np.zeros(n, bool)
+        self.ever_relapse = np.zeros(n, bool)
+
+        #interventions
+        self.has_int = np.zeros((n, NUM_INTERVENTIONS), bool)
+        self.month_start_int = np.zeros((n, NUM_INTERVENTIONS), np.int64)
+        self.has_int_tox_hist = np.zeros((n, NUM_INTERVENTIONS), bool)
+        self.ever_start_any_int = np.zeros(n, bool)
+
+        #prophs
+        self.has_proph = np.zeros((n, NUM_PROPHS), bool)
+        self.has_proph_tox_hist = np.zeros((n, NUM_PROPHS), bool)
+
+        #events
+        self.events = np.full((n, NUM_EVENTS), EVT_NONE, np.int8)
+        self.month_of_event = np.zeros((n, NUM_EVENTS), np.int64)
+        self.month_of_comp = np.zeros((n, NUM_EVENTS), np.int64)
+        self.has_comp = np.zeros((n, NUM_EVENTS), bool)
+
+        self.init_cohort()
+    #uniform draws of slot for the patients in idx
+    def random(self, idx, slot):
+        return keyed_uniforms(self.stream_key[idx], self.step, slot)
+    #initialize cohort
+    def init_cohort(self):
+        init = self.inputs.init
+        n = self.n
+        every = self.every
+
+        self.disc_mult_month = pow(self.inputs.sim.disc_rate_year+1,1/12.0)
+        self.disc_factor = np.ones(n)
+        self.qol = np.ones(n)
+        self.gender = self.tables.gender.draw(self.random(every, SLOT_INIT_GENDER))
+        self.age = np.round(self.tables.age.draw(self.random(every, SLOT_INIT_AGE))).astype(np.int64)
+        self.agecat = get_age_cats(self.age)
+        self.ss = self.tables.ss.draw(self.random(every, SLOT_INIT_SS), self.gender, self.agecat)
+        self.si = self.tables.si.draw(self.random(every, SLOT_INIT_SI), self.gender, self.agecat)
+
+        #roll for time since quit
+        self.month_of_quit = np.zeros(n, np.int64)
+        self.agequit_cat = np.zeros(n, np.int64)
+        former = np.flatnonzero(self.ss == SS_FORMER)
+        if former.size:
+            quit_time = self.tables.quit_time.draw(self.random(former, SLOT_INIT_QUIT), high = self.age[former])
+            self.month_of_quit[former] = -1*np.round(quit_time).astype(np.int64)
+            agequit = self.age[former] - (self.month - self.month_of_quit[former])
+            self.agequit_cat[former] = get_age_cats(agequit)
+
+        #draw event prev
+        for event in range(NUM_EVENTS):
+            prob = init.event_prev[event,self.gender,self.ss,self.si,self.agecat]
+            self.get_event(event, every[self.random(every, SLOT_INIT_EVENT+event) <= prob], True)
+
+        event_mask = get_masks(self.events == EVT_FULL)
+        #roll for start proph at init
+        prophs = self.inputs.prophs
+        for i in range(NUM_PROPHS):
+            prob_proph = prophs.start_prob_init[self.si,self.gender,i]
+            prob_proph *= prophs.start_age_mult[self.gender, i, self.agecat]
+            prob_proph *= self.tables.proph_event_hist_prod[self.gender, i, event_mask]
+            prob_proph *= prophs.ss_mult[self.gender, i, self.ss]
+
+            self.start_proph(i, every[self.random(every, SLOT_INIT_PROPH+i) <= prob_proph], True)
+
+        #roll for start intervention at init
+        intv = self.inputs.intervention
+        for i in range(NUM_INTERVENTIONS):
+            prob_int = intv.start_prob_init[self.si,self.gender,i]
+            prob_int *= intv.start_age_mult[self.gender, i, self.agecat]
+            prob_int *= self.tables.int_event_hist_max[self.gender, i, event_mask]
+
+            self.start_intervention(i, every[self.random(every, SLOT_INIT_INT+i) <= prob_int], True)
+
+        #set next regular screening month
+        for event in range(NUM_EVENTS):
+            if self.inputs.pre_events.screening_regular_max[event] > 0:
+                start_age = self.inputs.pre_events.screening_regular_start_age[self.ss, event]*12
+                sched = start_age >= 0
+                self.month_of_reg_screen[sched, event] = (start_age - self.age)[sched]
+
+        #add outputs
+        self.add_out("init_dist_smoking",every,(self.ss, self.si),1)
+        self.add_out("init_dist_gender",every,(self.gender,),1)
+        self.add_out("init_age",every,None, self.age)
+    #multiplies prob by the smoking multiplier. Former smokers look up the
+    #months since quit curve for event
+    def mult_time_since_quit(self, idx, prob, event, cs_mult, curve):
+        ss = self.ss[idx]
+        time_since_quit = self.month - self.month_of_quit[idx]
+        mult = curve.lookup(time_since_quit, event, self.si[idx], self.agequit_cat[idx])
+        mult = np.where(ss == SS_CURRENT, cs_mult, mult)
+        return np.where(ss == SS_NEVER, prob, prob*mult)
+    def update_start_month(self):
+        #clear mortality risks
+        self.mort_nodeath.fill(1.0)
+        self.mort_risks.fill(0.0)
+        #calculate age_category
+        self.agecat = get_age_cats(self.age)
+        self.cost_cells = None
+        self.qol.fill(1.0)
+
+        #add month for output
+        self.monthly_outputs.use_month(self.month)
+        self.step = self.month+1
+
+    def update_interventions(self):
+        smoker = self.ss != SS_NEVER
+        intv = self.inputs.intervention
+        event_mask = None
+
+        for i in range(NUM_INTERVENTIONS):
+            #those who have intervention
+            has = np.flatnonzero(self.has_int[:,i] & smoker)
+            if has.size:
+                #Check for int stop
+                stop_int = np.zeros(has.size, bool)
+
+                #abstinance condition
+                abst_cond = intv.stop_abst_duration[i]
+                if abst_cond >= 0:
+                    quit_duration = self.month - self.month_of_quit[has]
+                    stop_int |= (self.ss[has] == SS_FORMER) & (quit_duration >= abst_cond)
+
+                dur_cond = intv.duration[i]
+                if dur_cond >= 0:
+                    stop_int |= self.month - self.month_start_int[has,i] >= dur_cond
+
+                prob_stop = intv.stop_prob_month[self.si[has], self.gender[has], i]
+                stop_int |= self.random(has, SLOT_INT_STOP+i) <= prob_stop
+
+                self.stop_intervention(i, has[stop_int])
+
+            #check for int start
+            can_start = (self.ss == SS_CURRENT) & ~self.has_int[:,i]
+            if not intv.allow_restart_on_tox[i]:
+                can_start &= ~self.has_int_tox_hist[:,i]
+            cand = np.flatnonzero(can_start)
+            if cand.size:
+                if event_mask is None:
+                    event_mask = get_masks(self.events == EVT_FULL)
+                gender = self.gender[cand]
+                prob_start = intv.start_prob_month[self.si[cand], gender, i]
+                prob_start *= intv.start_age_mult[gender, i, self.agecat[cand]]
+                prob_start *= self.tables.int_event_hist_max[gender, i, event_mask[cand]]
+                self.start_intervention(i, cand[self.random(cand, SLOT_INT_START+i) <= prob_start])
+
+            #toxicity
+            has = np.flatnonzero(self.has_int[:,i] & smoker)
+            if has.size:
+                tox = has[self.random(has, SLOT_INT_TOX+i) <= intv.tox_prob[i]]
+                if tox.size:
+                    self.set_int_tox(i, tox)
+                    #add tox death prob
+                    self.add_mort_risk(DTH_TOX_INT,tox,intv.tox_dth_prob[i])
+                    #stop intervention if set
+                    if intv.stop_on_tox[i]:
+                        self.stop_intervention(i, tox)
+
+    def update_smoke_start(self):
+        #updater for starting smoking
+        never = np.flatnonzero(self.ss == SS_NEVER)
+        if not never.size:
+            return
+        ageyrs = self.age[never] // 12
+        probstart = self.inputs.smoking.start_prob[self.gender[never],ageyrs]
+        #roll for start
+        self.start_smoking(never[self.random(never, SLOT_SMOKE_START) <= probstart])
+
+    def update_smoke_quit(self):
+        #updater for stoping smoking
+        current = np.flatnonzero(self.ss == SS_CURRENT)
+        if not current.size:
+            return
+
+        smoking = self.inputs.smoking
+        ageyrs = self.age[current] // 12
+
+        evts = ((self.events[current] == EVT_FULL) &
+                (self.month - self.month_of_event[current] <= smoking.event_quit_duration))
+        comps = self.has_comp[current] & (self.month - self.month_of_comp[current] <= smoking.comp_quit_duration)
+        probs = np.concatenate((np.where(evts, smoking.event_quit_prob, -np.inf),
+                                np.where(comps, smoking.comp_quit_prob, -np.inf)), axis = 1).max(axis = 1)
+        has_probs = evts.any(axis = 1) | comps.any(axis = 1)
+        probquit = np.where(has_probs, probs, smoking.quit_prob[self.gender[current], ageyrs])
+
+        probquit *= self.tables.int_quit_max[get_masks(self.has_int[current])]
+
+        self.quit_smoking(current[self.random(current, SLOT_SMOKE_QUIT) <= probquit])
+
+    def update_smoke_relapse(self):
+        #updater for smoking relapse
+        former = np.flatnonzero(self.ss == SS_FORMER)
+        if not former.size:
+            return
+
+        time_since_quit = self.month - self.month_of_quit[former]
+        probrelapse = self.tables.relapse.lookup(time_since_quit, self.si[former], self.agecat[former])
+
+        probrelapse *= self.tables.int_relapse_max[get_masks(self.has_int[former])]
+
+        self.relapse_smoking(former[self.random(former, SLOT_SMOKE_RELAPSE) <= probrelapse])
+
+    def update_prophs(self):
+        prophs = self.inputs.prophs
+        event_mask = None
+
+        for i in range(NUM_PROPHS):
+            #those with proph
+            has = np.flatnonzero(self.has_proph[:,i])
+            if has.size:
+                #Check for proph stop
+                prob_stop = prophs.stop_prob_month[self.si[has], self.gender[has], i]
+                self.stop_proph(i, has[self.random(has, SLOT_PROPH_STOP+i) <= prob_stop])
+
+            #check for proph start
+            can_start = ~self.has_proph[:,i]
+            if not prophs.allow_restart_on_tox[i]:
+                can_start &= ~self.has_proph_tox_hist[:,i]
+            cand = np.flatnonzero(can_start)
+            if cand.size:
+                if event_mask is None:
+                    event_mask = get_masks(self.events == EVT_FULL)
+                gender = self.gender[cand]
+                prob_start = prophs.start_prob_month[self.si[cand], gender, i]
+                prob_start *= prophs.start_age_mult[gender, i, self.agecat[cand]]
+                prob_start *= self.tables.proph_event_hist_max[gender, i, event_mask[cand]]
+                prob_start *= prophs.ss_mult[gender, i, self.ss[cand]]
+                self.start_proph(i, cand[self.random(cand, SLOT_PROPH_START+i) <= prob_start])
+
+            #toxicity
+            has = np.flatnonzero(self.has_proph[:,i])
+            if has.size:
+                tox = has[self.random(has, SLOT_PROPH_TOX+i) <= prophs.tox_prob[i]]
+                if tox.size:
+                    self.set_proph_tox(i, tox)
+                    #add tox death prob
+                    self.add_mort_risk(DTH_TOX_PROPH,tox,prophs.tox_dth_prob[i])
+                    #stop proph if set
+                    if prophs.stop_on_tox[i]:
+                        self.stop_proph(i, tox)
+
+    def update_pre_events(self):
+        #roll for incidence of pre-events
+        pevt = self.inputs.pre_events
+
+        for event in range(NUM_EVENTS):
+            free = np.flatnonzero(self.events[:,event] == EVT_NONE)
+            if not free.size:
+                continue
+
+            si = self.si[free]
+            prob_event = pevt.pevent_inc_baseline[self.gender[free],event,self.agecat[free]]
+            prob_event = self.mult_time_since_quit(free, prob_event, event,
+                                                   pevt.pevent_inc_mult_curr[event,si],
+                                                   self.tables.pevent_inc_quit)
+            #roll for pre-event
+            self.get_pevent(event, free[self.random(free, SLOT_PEVENT_INC+event) <= prob_event])
+
+        for event in range(NUM_EVENTS):
+            self.add_out("pevent_mths",np.flatnonzero(self.events[:,event] == EVT_PRE),event,1)
+    def update_pevent_screening(self):
+        #handles screening for pre events
+        pevt = self.inputs.pre_events
+        qol = self.inputs.qol
+
+        for event in range(NUM_EVENTS):
+            open_evt = self.events[:,event] != EVT_FULL
+            no_conf = np.flatnonzero(open_evt & (self.month_of_conf[:,event] == -1))
+
+            #check if regular screening should be done
+            due = no_conf[self.month >= self.month_of_reg_screen[no_conf,event]]
+            attend = due[:0]
+            if due.size:
+                #roll for prob attend
+                attend = due[self.random(due, SLOT_SCREEN_ATTEND+event) > pevt.screening_regular_prob_skip[event]]
+                self.num_reg_screens[attend,event] += 1
+
+                #schedule next reg screen if possible
+                more = self.num_reg_screens[due,event] < pevt.screening_regular_max[event]
+                self.month_of_reg_screen[due[more],event] = self.month+pevt.screening_regular_interval[event]
+                self.month_of_reg_screen[due[~more],event] = NO_SCREEN
+
+            #roll for background screening
+            rest = no_conf[~np.isin(no_conf, attend, assume_unique = True)] if attend.size else no_conf
+            prob_back = pevt.screening_background_prob[self.gender[rest],event,self.agecat[rest]]
+            back = rest[self.random(rest, SLOT_SCREEN_BACK+event) <= prob_back]
+            self.screen(event, np.union1d(attend, back))
+
+            #awaiting conf test
+            waiting = np.flatnonzero(open_evt & (self.month_of_conf[:,event] != -1))
+            if waiting.size:
+                #add qol
+                if self.update_qol:
+                    self.add_qol(waiting, qol.screen_wait_conf[event])
+
+                #check for conf test
+                self.conf_test(event, waiting[self.month_of_conf[waiting,event] == self.month])
+
+            pre = np.flatnonzero(open_evt & (self.events[:,event] == EVT_PRE))
+            if pre.size:
+                detected = self.is_detected_pevent[pre,event]
+                #add cost for being detected
+                self.add_cost("cost_screening",pre[detected],event, self.inputs.costs.screen_detected[event], True)
+                #add qol
+                if self.update_qol:
+                    self.add_qol(pre[detected], qol.screen_det[event])
+                    self.add_qol(pre[~detected], qol.screen_undet[event])
+
+    def update_events(self):
+        #updater for events
+        inp = self.inputs.events
+        proph_mask = get_masks(self.has_proph)
+
+        #for those who have event
+        full = self.events == EVT_FULL
+        for event in range(NUM_EVENTS):
+            has = np.flatnonzero(full[:,event])
+            if not has.size:
+                continue
+
+            #add monthly cost of event:
+            self.add_cost("cost_event",has,event, self.inputs.costs.event_month[event], True)
+
+            #add qol
+            if self.update_qol:
+                self.add_qol(has, self.inputs.qol.event_month[event])
+
+            #roll for event complications
+            si = self.si[has]
+            prob_comp = inp.event_comp_baseline[self.gender[has], event, self.agecat[has]]
+            prob_comp = self.mult_time_since_quit(has, prob_comp, event,
+                                                  inp.event_comp_mult_curr[event, si],
+                                                  self.tables.event_comp_quit)
+
+            #modify by proph
+            prob_comp *= self.tables.proph_eff_comp_prod[event, proph_mask[has]]
+
+            #roll for complication
+            comp = has[self.random(has, SLOT_EVENT_COMP+event) <= prob_comp]
+            if comp.size:
+                self.get_event_comp(event, comp)
+                #roll for complication death
+                self.add_mort_risk(DTH_EVENT_COMP_0+event,comp,inp.event_comp_prob_death[event])
+
+        #roll for transitions from pre-event to event
+        pevt = self.inputs.pre_events
+        for event in range(NUM_EVENTS):
+            pre = np.flatnonzero(self.events[:,event] == EVT_PRE)
+            if not pre.size:
+                continue
+            prob_event = pevt.pevent_to_event_prob[self.gender[pre], event, self.agecat[pre]]
+            #modify by detected status
+            prob_event = np.where(self.is_detected_pevent[pre,event],
+                                  prob_event*pevt.screening_outcome_event_mult[event], prob_event)
+            self.get_event(event, pre[self.random(pre, SLOT_PEVENT_TO_EVENT+event) <= prob_event])
+
+        #roll for incidence of event
+        for event in range(NUM_EVENTS):
+            free = np.flatnonzero(self.events[:,event] == EVT_NONE)
+            if not free.size:
+                continue
+
+            si = self.si[free]
+            prob_event = inp.event_inc_baseline[self.gender[free],event,self.agecat[free]]
+            prob_event = self.mult_time_since_quit(free, prob_event, event,
+                                                   inp.event_inc_mult_curr[event,si],
+                                                   self.tables.event_inc_quit)
+
+            #modify by proph
+            prob_event *= self.tables.proph_eff_events_prod[event, proph_mask[free]]
+
+            #roll for event
+            new = free[self.random(free, SLOT_EVENT_INC+event) <= prob_event]
+            if new.size:
+                self.get_event(event, new)
+                #roll for event death
+                self.add_mort_risk(DTH_EVENT_0+event,new,inp.event_prob_death[event])
+
+    def update_nathist(self):
+        nh = self.inputs.nathist
+        pevt = self.inputs.pre_events
+        ageyrs = self.age//12
+        agecat = self.agecat
+
+        #accumulate pre-event multiplier
+        pevent_mult = np.ones(self.n)
+        for event in range(NUM_EVENTS):
+            pre = np.flatnonzero(self.events[:,event] == EVT_PRE)
+            if pre.size:
+                pevent_mult[pre] *= pevt.pevent_mort_mult[self.gender[pre],event, agecat[pre]]
+                pevent_mult[pre[self.is_detected_pevent[pre,event]]] *= pevt.screening_outcome_pevent_mort_mult[event]
+
+        ns_mort = nh.ns_lifetable[self.gender,ageyrs]
+        #current smokers
+        if nh.cs_mort_usemult:
+            cs_mort = ns_mort*nh.cs_mort_mult[self.si,self.gender,agecat]
+        else:
+            cs_mort = nh.cs_lifetable[self.si,self.gender,ageyrs]
+        #ex smokers
+        if nh.xs_mort_usemult:
+            xs_mort = ns_mort * nh.xs_mort_mult[self.si,self.gender,agecat]
+        else:
+            xs_mort = nh.xs_agequit_mult[self.si,self.gender,agecat]*nh.xs_lifetable[self.si,self.gender,ageyrs]
+
+        #former smokers move from current to ex smoker mortality over the transition
+        time_since_quit = self.month - self.month_of_quit
+        weight = self.tables.nathist_quit_weight.lookup(time_since_quit)
+        fs_mort = (1-weight)*cs_mort + weight*xs_mort
+
+        mort = np.choose(self.ss, (ns_mort, fs_mort, cs_mort))
+        self.add_mort_risk(DTH_NAT_HIST,self.every,mort,pevent_mult)
+
+    def update_mort(self):
+        #roll for death
+        dies = np.flatnonzero(self.random(self.every, SLOT_DEATH) > self.mort_nodeath)
+        if dies.size:
+            #roll for cause of death
+            causes = draw_dists(self.mort_risks[dies], self.random(dies, SLOT_DEATH_CAUSE))
+            self.kill_patient(dies, causes)
+    def update_end_month(self):
+        qol = self.inputs.qol
+        costs = self.inputs.costs
+        every = self.every
+        time_since_quit = self.month - self.month_of_quit
+
+        #add costs for background care
+        status = np.where((self.ss == SS_FORMER) & (time_since_quit < costs.bkgd_trans), SS_CURRENT, self.ss)
+        self.add_cost("cost_bkgd",every,None, costs.bkgd[self.gender,status,self.agecat], True)
+
+        #add qol
+        if self.update_qol:
+            mult = qol.base[self.si, self.ss]
+            recent = (self.ss == SS_FORMER) & (time_since_quit <= qol.quit_duration[self.si])
+            mult = np.where(recent, mult*qol.quit[self.si], mult)
+            self.add_qol(every, mult)
+
+        #add outputs
+        self.add_disc_out('lms',every,(self.ss,self.agecat, self.gender),1.0)
+        self.add_disc_out('lms_SI',every,(self.si,),1.0)
+        self.add_disc_out('qalms',every,(self.ss,self.agecat, self.gender),self.qol)
+
+        for intv in range(NUM_INTERVENTIONS):
+            has = np.flatnonzero(self.has_int[:,intv])
+            #add cost
+            self.add_cost("cost_int",has,intv,costs.int_month[intv], True)
+            #add output
+            self.add_month_out("int_num_with",has,intv,1)
+
+        for proph in range(NUM_PROPHS):
+            has = np.flatnonzero(self.has_proph[:,proph])
+            #add cost
+            self.add_cost("cost_proph",has,(proph,),costs.proph_month[proph], True)
+            #add output
+            self.add_month_out("proph_num_with",has,proph,1)
+
+        for event in range(NUM_EVENTS):
+            full = self.events[:,event] == EVT_FULL
+            has = np.flatnonzero(full)
+            self.add_month_out('event_num_with',has,(event,self.ss[has],self.agecat[has],self.gender[has]),1)
+            self.add_month_out('event_num_without',np.flatnonzero(~full),event,1)
+
+        #kill patient if max age reached
+        old = np.flatnonzero(self.isalive & (self.age / 12 >= self.inputs.sim.maxage))
+        if old.size:
+            self.kill_patient(old, DTH_OLD_AGE)
+
+        alive = np.flatnonzero(self.isalive)
+        dead = np.flatnonzero(~self.isalive)
+        self.add_month_out('num_alive',alive,(self.ss[alive],self.si[alive]), 1)
+        self.add_month_out('num_deaths',dead,(self.ss[dead],self.si[dead]), 1)
+
+        self.add_month_costs()
+
+        #advance age
+        self.month+=1
+        self.age+=1
+        #update disc factor
+        self.disc_factor*=1/self.disc_mult_month
+
+    def screen(self, event, idx):
+        #screen for pre events handles intial screen and schedules conf test
+        if not idx.size:
+            return
+        pevt = self.inputs.pre_events
+        costs = self.inputs.costs
+
+        #add cost
+        self.add_cost("cost_screening",idx,(event,),costs.screen[event], True)
+
+        #add qol
+        if self.update_qol:
+            self.add_qol(idx, self.inputs.qol.screen[event])
+
+        true_status = self.events[idx,event] == EVT_PRE
+        gender = self.gender[idx]
+        rate = np.where(true_status, pevt.screening_sensitivity[gender, event],
+                        pevt.screening_specificity[gender, event])
+        result = np.where(self.random(idx, SLOT_SCREEN_RESULT+event) <= rate, true_status, ~true_status)
+
+        self.add_month_out("pevent_screen_results", idx, (event,true_status.astype(int),result.astype(int)),1)
+
+        #schedule conf test
+        pos = idx[result]
+        self.month_of_conf[pos,event] = self.month+pevt.screening_conf_delay[event]
+        self.add_cost("cost_screening",pos,event,costs.screen_pos[event], True)
+        self.add_cost("cost_screening",idx[~result],event,costs.screen_neg[event], True)
+    def conf_test(self, event, idx):
+        #handles a conf test
+        if not idx.size:
+            return
+        pevt = self.inputs.pre_events
+        self.month_of_conf[idx,event] = -1
+
+        #add cost
+        self.add_cost("cost_screening",idx,event,self.inputs.costs.screen_conf[event], True)
+
+        #add output
+        self.add_month_out("pevent_conf",idx,event,1)
+
+        #add qol
+        if self.update_qol:
+            self.add_qol(idx, self.inputs.qol.screen_conf[event])
+
+        #add conf test mortality
+        self.add_mort_risk(DTH_CONF_TEST,idx,pevt.screening_conf_mort[event])
+
+        #change outcomes for true positives
+        pos = idx[self.events[idx,event] == EVT_PRE]
+        if pos.size:
+            self.is_detected_pevent[pos,event] = True
+            #roll for revert to neutral
+            self.cure_pevent(event, pos[self.random(pos, SLOT_CONF_NEUTRAL+event) <= pevt.screening_outcome_neutral[event]])
+            #start proph if set
+            if pevt.screening_outcome_proph[event]:
+                proph_index = pevt.screening_outcome_proph[event] - 1
+                if proph_index >= 0:
+                    self.start_proph(proph_index, pos)
+            #start intervention if set
+            if pevt.screening_outcome_intervention[event]:
+                self.start_intervention(event, pos)
+
+    #add a mortality risk for that month
+    def add_mort_risk(self, cause, idx, prob, mult = 1):
+        risk = prob*mult
+        self.mort_nodeath[idx] *= 1-risk
+        self.mort_risks[idx,cause] += risk
+    #adds value to output
+    def add_out(self, name, idx, index, value, add_month = False):
+        if not idx.size:
+            return
+        out = self.outputs[name]
+        if index is None:
+            out[self.row[idx]] += value
+        else:
+            if not isinstance(index, tuple):
+                index = (index,)
+            out[(self.row[idx],)+index] += value
+
+        #if true add to same name category in monthly costs
+        if add_month:
+            self.add_month_out(name, idx, index, value)
+
+    def add_list_out(self, name, idx, value):
+        self.list_outs.setdefault(name, []).append((self.pid[idx], value))
+    #appends the list outputs of every patient in pid order and of each patient in
+    #the order they were added
+    def add_list_outs(self):
+        for name, adds in self.list_outs.items():
+            pids = np.concatenate([pid for pid, value in adds])
+            values = np.concatenate([value for pid, value in adds])
+            self.outputs[name].extend(values[np.argsort(pids, kind = "stable")].tolist())
+        self.list_outs = {}
+    #rows are unique in idx so the values are added through flat views of the
+    #outputs, which is much faster than indexing them by row and index
+    def add_disc_out(self, name, idx, index, value, disc_value = None):
+        undisc = self.disc_outputs.undisc[name]
+        cells = self.row[idx]
+        if index is not None:
+            if not isinstance(index, tuple):
+                index = (index,)
+            cells = cells*(undisc.size//len(undisc)) + np.ravel_multi_index(index, undisc.shape[1:])
+        if disc_value is None:
+            disc_value = value*self.disc_factor[idx]
+        self.add_disc_cells(name, cells, value, disc_value)
+    #adds to the flat cells of the undiscounted and discounted output name
+    def add_disc_cells(self, name, cells, value, disc_value):
+        out = self.disc_outputs
+        out.undisc[name].reshape(-1)[cells] += value
+        out.disc[name].reshape(-1)[cells] += disc_value
+    #offset of the (ss, agecat, gender) cell of each patient in idx within its
+    #overall_costs row. Kept until ss or agecat change
+    def get_cost_cells(self, idx):
+        if self.cost_cells is None:
+            shape = self.disc_outputs.undisc.overall_costs.shape[1:]
+            self.cost_cells = np.ravel_multi_index((self.ss, self.agecat, self.gender), shape)
+        return self.cost_cells[idx]
+    def add_month_out(self, name, idx, index, value):
+        if not idx.size:
+            return
+        if index is not None and not isinstance(index, tuple):
+            index = (index,)
+        if index is None or not any(isinstance(i, np.ndarray) for i in index):
+            #single cell
+            if isinstance(value, np.ndarray):
+                value = value.sum()
+            else:
+                value = value*idx.size
+            self.add_month_total(name, index, value)
+        else:
+            mo = self.monthly_outputs[name]
+            shape = mo.shape[1:]
+            cells = np.ravel_multi_index(index, shape)
+            if isinstance(value, np.ndarray):
+                sums = np.bincount(cells, weights = value, minlength = mo[0].size)
+            else:
+                sums = np.bincount(cells, minlength = mo[0].size)*value
+            mo[self.month] += sums.reshape(shape).astype(mo.dtype)
+    #adds the total of the patients to the single cell index of monthly output name
+    def add_month_total(self, name, index, total):
+        if index is None:
+            self.monthly_outputs[name][self.month] += total
+        else:
+            self.monthly_outputs[name][(self.month,)+index] += total
+    #keeps the discounted cost of each patient in idx for monthly output name until
+    #add_month_costs. Summing them here would add them in a different order than the
+    #patient engine and change the rounding of the monthly costs
+    def add_month_cost(self, name, idx, index, disc_value):
+        if index is None:
+            cells = 0
+        else:
+            if not isinstance(index, tuple):
+                index = (index,)
+            cells = np.ravel_multi_index(index, self.monthly_outputs[name].shape[1:])
+        self.month_costs.setdefault(name, []).append((idx, cells, disc_value))
+    #adds the monthly costs of the month one patient at a time in the order of
+    #their rows, which is pid order
+    def add_month_costs(self):
+        for name, adds in self.month_costs.items():
+            idx = np.concatenate([a[0] for a in adds])
+            if all(np.ndim(a[1]) == 0 for a in adds):
+                cells = np.repeat([a[1] for a in adds], [a[0].size for a in adds])
+            else:
+                cells = np.concatenate([np.broadcast_to(a[1], a[0].shape) for a in adds])
+            values = np.concatenate([a[2] for a in adds])
+            order = np.argsort(idx, kind = "stable")
+            month = self.monthly_outputs[name][self.month:self.month+1].reshape(-1)
+            np.add.at(month, cells[order], values[order])
+        self.month_costs = {}
+    def add_cost(self, name, idx, index, value, add_month = False):
+        if not idx.size:
+            return
+        disc_value = value*self.disc_factor[idx]
+        overall_costs = self.disc_outputs.undisc.overall_costs
+        cells = self.row[idx]*(overall_costs.size//len(overall_costs)) + self.get_cost_cells(idx)
+        self.add_disc_cells("overall_costs",cells, value, disc_value)
+        self.add_disc_out(name,idx,index, value, disc_value)
+
+        self.add_month_cost("costs_disc", idx, None, disc_value)
+
+        #if true add to same name category in monthly costs
+        if add_month:
+            self.add_month_cost(name, idx, index, disc_value)
+
+    def add_qol(self, idx, qol_mult):
+        self.qol[idx] *= qol_mult
+    def set_proph_tox(self, proph, idx):
+        self.has_proph_tox_hist[idx,proph] = True
+        #add qol
+        if self.update_qol:
+            self.add_qol(idx, self.inputs.qol.proph_tox[proph])
+        #add output
+        self.add_out("proph_num_tox",idx,proph,1)
+    def set_int_tox(self, intv, idx):
+        self.has_int_tox_hist[idx,intv] = True
+        #add qol
+        if self.update_qol:
+            self.add_qol(idx, self.inputs.qol.int_tox[intv])
+
+        #add output
+        self.add_out("int_num_tox",idx,intv,1)
+
+    def stop_proph(self, proph, idx):
+        if not idx.size:
+            return
+        self.has_proph[idx,proph] = False
+        #add output
+        self.add_month_out("proph_stop",idx,proph,1)
+    def start_proph(self, proph, idx, is_init = False):
+        if not idx.size:
+            return
+        self.has_proph[idx,proph] = True
+        #add cost
+        if not is_init:
+            self.add_cost("cost_proph",idx,(proph,),self.inputs.costs.proph_init[proph], True)
+            #add output
+            self.add_month_out("proph_start",idx,proph,1)
+    def stop_intervention(self, intv, idx):
+        if not idx.size:
+            return
+        self.has_int[idx,intv] = False
+
+        #add output
+        self.add_month_out("int_stop",idx,intv,1)
+    def start_intervention(self, intv, idx, is_init = False):
+        if not idx.size:
+            return
+        self.month_start_int[idx,intv] = self.month
+        self.has_int[idx,intv] = True
+        self.ever_start_any_int[idx] = True
+        #add cost
+        if not is_init:
+            self.add_cost("cost_int",idx,intv,self.inputs.costs.int_init[intv], True)
+            #add output
+            self.add_out("int_start",idx,intv,1)
+            self.add_month_out("int_start",idx,intv,1)
+    def start_smoking(self, idx):
+        if not idx.size:
+            return
+        self.ss[idx] = SS_CURRENT
+        self.cost_cells = None
+
+        #add output
+        self.add_out("smoking_start",idx,None,1, True)
+    def quit_smoking(self, idx):
+        if not idx.size:
+            return
+        self.ss[idx] = SS_FORMER
+        self.cost_cells = None
+        self.ever_quit[idx] = True
+        self.month_of_quit[idx] = self.month
+        self.agequit_cat[idx] = get_age_cats(self.age[idx])
+
+        #check to see if should stop intervention
+        for i in range(NUM_INTERVENTIONS):
+            if self.inputs.intervention.stop_on_quit[i]:
+                self.stop_intervention(i, idx[self.has_int[idx,i]])
+
+        #add output
+        self.add_out("smoking_quit",idx,(self.agecat[idx],self.gender[idx]),1, True)
+        self.add_list_out("age_at_quit",idx,self.age[idx])
+    def relapse_smoking(self, idx):
+        if not idx.size:
+            return
+        self.ss[idx] = SS_CURRENT
+        self.cost_cells = None
+        self.ever_relapse[idx] = True
+        #add output
+        self.add_out("smoking_relapse",idx,(self.agecat[idx],self.gender[idx]),1, True)
+    def get_event(self, event, idx, is_prev=False):
+        if not idx.size:
+            return
+        self.events[idx,event] = EVT_FULL
+        self.month_of_event[idx,event] = self.month
+        #add cost
+        if not is_prev:
+            self.add_cost("cost_event",idx,event,self.inputs.costs.event_init[event], True)
+            #add qol
+            if self.update_qol:
+                self.add_qol(idx, self.inputs.qol.event_init[event])
+
+        #add output
+        if is_prev:
+            self.add_out("event_num_prev",idx,event,1)
+        else:
+            self.add_out("event_num_inc",idx,event,1)
+            self.add_month_out('event_inc',idx,(event, self.ss[idx], self.agecat[idx], self.gender[idx]),1)
+
+        #remove scheduled conf test
+        self.month_of_conf[idx,event] = -1
+
+    def cure_pevent(self, event, idx):
+        self.events[idx,event] = EVT_NONE
+        self.is_detected_pevent[idx,event] = False
+    def get_pevent(self, event, idx):
+        if not idx.size:
+            return
+        self.events[idx,event] = EVT_PRE
+
+        #add output
+        self.add_out("pevent_num_inc",idx,event,1)
+        self.add_month_out('pevent_inc',idx,(event, self.ss[idx], self.agecat[idx], self.gender[idx]),1)
+    def get_event_comp(self, event, idx):
+        self.month_of_comp[idx,event] = self.month
+        self.has_comp[idx,event] = True
+        #add cost
+        self.add_cost("cost_comp",idx,(event,),self.inputs.costs.comp[event], True)
+
+        #add qol
+        if self.update_qol:
+            self.add_qol(idx, self.inputs.qol.comp[event])
+
+        #add output
+        self.add_out("event_comp",idx,event,1)
+        self.add_month_out('event_comp',idx,(event, self.ss[idx], self.agecat[idx], self.gender[idx]),1)
+    #run single time step(month) for every live patient
+    def run_step(self):
+        self.update_start_month()
+        self.update_interventions()
+        self.update_smoke_start()
+        self.update_smoke_quit()
+        self.update_smoke_relapse()
+        self.update_prophs()
+        self.update_pre_events()
+        self.update_pevent_screening()
+        self.update_events()
+        self.update_nathist()
+        self.update_mort()
+        self.update_end_month()
+        self.num_months += self.n
+        self.remove_dead()
+
+    def run_until_death(self):
+        while(self.n):
+            self.run_step()
+        self.add_list_outs()
+
+    #drops dead patients from the state arrays
+    def remove_dead(self):
+        alive = self.isalive
+        if alive.all():
+            return
+        #take by index is faster than a boolean mask for the 2d arrays
+        keep = np.flatnonzero(alive)
+        for varname in STATE_VARS:
+            setattr(self, varname, getattr(self, varname).take(keep, axis = 0))
+        self.n = self.pid.size
+        self.every = np.arange(self.n)
+        self.cost_cells = None
+    def kill_patient(self, idx, cause):
+        self.isalive[idx] = False
+
+        #record output
+        ss, si = self.ss[idx], self.si[idx]
+        self.add_out("death_dist",idx,(ss,si),1)
+        for event in range(NUM_EVENTS):
+            full = self.events[idx,event] == EVT_FULL
+            self.add_out("event_mths",idx[full],event,self.month - self.month_of_event[idx[full],event])
+        self.add_out("death_causes",idx,cause,1, True)
+
+        self.add_out("smoking_ever_quit",idx[self.ever_quit[idx]],None, 1)
+        self.add_out("smoking_ever_relapse",idx[self.ever_relapse[idx]],None, 1)
+
+        self.add_out("int_start",idx[self.ever_start_any_int[idx]],None,1)
+
+    def __repr__(self):
+        return "Cohort of {0} live patients at month {1}".format(self.n, self.month)
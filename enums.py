@@ -39,13 +39,16 @@ AGE_BRACKET_STRS = ("<20","20-24","25-29","30-34",
 
 #draws from a weighted distribution where distribution is a dictionary
 #with choices to weights.  or a list of probs. weights are not normalized
-def draw_dist(dist):
+#u is the uniform draw to use, a new one is drawn if not given
+def draw_dist(dist, u = None):
     if isinstance(dist, dict):
         sumWeights = sum(dist.values())
     else:
         sumWeights = sum(dist)        
         
-    randNum = random()*sumWeights
+    if u is None:
+        u = random()
+    randNum = u*sumWeights
     culNum = 0
 
     if isinstance(dist, dict):
@@ -58,16 +61,18 @@ def draw_dist(dist):
         if randNum <= culNum:
             return key
 
-#draws from truncated normal dist
-def draw_trunc_norm(mean, std, low, high):
+#draws from truncated normal dist by inverting the cdf at uniform draw u
+def draw_trunc_norm(mean, std, low, high, u = None):
     if std == 0:
         return mean
     if low == -1:
-        low == -np.inf
+        low = -np.inf
     if high == -1:
         high = np.inf
+    if u is None:
+        u = random()
     a, b = (low - mean)/float(std), (high - mean)/float(std)
-    return truncnorm(a,b, loc=mean, scale=std).rvs()
+    return truncnorm.ppf(u, a, b, loc=mean, scale=std)
 
 def convertage(agemonths):
     return divmod(agemonths,12)
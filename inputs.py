@@ -7,7 +7,7 @@ Handles reading and manipulating inputs for the smoking model
 import xlrd, re
 import numpy as np
 from enums import *
-import collections
+import hashlib, os, pickle
 ######################################################################
 #data structure for reading inputs
 
@@ -47,6 +47,8 @@ def add_prev(sheet):
 
     return prev
 
+#the labels do not include the gender so the rows for each gender are
+#told apart by the order they were written in
 def add_prev_load_text(textfile, inputs):
     prev = np.ndarray(((NUM_EVENTS, len(GENDERS), len(SS),len(SI),len(AGE_BRACKETS))))
     for event in range(NUM_EVENTS):
@@ -54,11 +56,11 @@ def add_prev_load_text(textfile, inputs):
             offset = event*20+gender*10
             label = "prev_event\t{}\t{}".format(inputs.sim.event_names[event], SS_STRS[SS_NEVER])
             for si in SI:
-                prev[event][gender][SS_NEVER][si] = text_get_range(textfile, "Y{0}:AM{0}".format(7+offset), label,float)
+                prev[event][gender][SS_NEVER][si] = text_get_range(textfile, "Y{0}:AM{0}".format(7+offset), label,float, gender)
             label = "prev_event\t{}\t{}".format(inputs.sim.event_names[event], SS_STRS[SS_FORMER])
-            prev[event][gender][SS_FORMER] = text_get_range(textfile, "Y{0}:AM{1}".format(8+offset, 10+offset),label,float)
+            prev[event][gender][SS_FORMER] = text_get_range(textfile, "Y{0}:AM{1}".format(8+offset, 10+offset),label,float, gender)
             label = "prev_event\t{}\t{}".format(inputs.sim.event_names[event], SS_STRS[SS_CURRENT])
-            prev[event][gender][SS_CURRENT] = text_get_range(textfile, "Y{0}:AM{1}".format(11+offset, 13+offset),label,float)
+            prev[event][gender][SS_CURRENT] = text_get_range(textfile, "Y{0}:AM{1}".format(11+offset, 13+offset),label,float, gender)
 
     return prev
 
@@ -454,52 +456,58 @@ def xl_get_range(sheet, address, tp):
                 
             return np.array(values)
 
-def text_get_range(textfile, address, label, tp):
-
+#index of the lines of a text input file by their first field so that
+#a label is found without searching the whole file
+class TextIndex(object):
+    def __init__(self, text):
+        self.lines = text.split("\n")
+        self.first = {}
+        for n, line in enumerate(self.lines):
+            self.first.setdefault(line.split("\t", 1)[0], []).append(n)
+    #the line of the occurrence-th input with label and the lines after it
+    #as lists of fields. The first row has the label removed
+    def get_rows(self, label, num_rows, occurrence = 0):
+        prefix = label+"\t"
+        found = [n for n in self.first.get(label.split("\t", 1)[0], ())
+                 if self.lines[n].startswith(prefix)]
+        if len(found) <= occurrence:
+            raise ValueError("input {0} not found".format(label.replace("\t", " ")))
+        n = found[occurrence]
+        if n+num_rows > len(self.lines):
+            raise ValueError("input {0} is missing rows".format(label.replace("\t", " ")))
+        rows = [self.lines[n][len(prefix):]]+self.lines[n+1:n+num_rows]
+        return [row.split("\t") for row in rows]
+
+#array of type tp from the fields of a text input
+def text_to_array(fields, tp):
     if tp == bool:
-        tp = lambda x:x=="True"
+        return np.array(fields) == "True"
+    if tp == str:
+        return np.array(fields)
+    return np.array(fields, tp)
+
+#gets a value from the index of a text file. Follows the addresses of xl_get_range
+#occurrence picks between inputs written with the same label
+def text_get_range(textfile, address, label, tp, occurrence = 0):
     # single cell
     if ":" not in address and ";" not in address:
-        val = re.search(label+"\t(.*)\n",textfile).group(1)
+        val = "\t".join(textfile.get_rows(label, 1, occurrence)[0])
+        if tp == bool:
+            return val == "True"
         return tp(val)
 
-    # row slice
+    start, end = address.replace(";", ":").split(":")
+    startrow, startcol = xl_cell_to_rowcol(start)
+    endrow, endcol = xl_cell_to_rowcol(end)
+    # row slice has a row of text per row and col slice a row of text per col
     if ":" in address:
-        start, end = address.split(":")
-        startrow, startcol = xl_cell_to_rowcol(start)
-        endrow, endcol = xl_cell_to_rowcol(end)
-        if startrow == endrow:
-            val = re.search(label+"\t(.*)\n",textfile).group(1)
-            return np.array([tp(_) for _ in val.split("\t")])
-        else:
-            values = []
-            pattern = label+"\t"
-            for row in range(startrow, endrow + 1):
-                pattern+="(.*)\n"
-
-            val = re.search(pattern,textfile)
-            for row in val.groups():
-                values.append([tp(_) for _ in row.split("\t")])
-            return np.array(values)
-    # col slice
-    if ";" in address:
-        start, end = address.split(";")
-        startrow, startcol = xl_cell_to_rowcol(start)
-        endrow, endcol = xl_cell_to_rowcol(end)
-        if startcol == endcol:
-            val = re.search(label+"\t(.*)\n",textfile).group(1)
-            return np.array([tp(_) for _ in val.split("\t")])
-        else:
-            values = []
-            pattern = label+"\t"
-            for col in range(startcol, endcol + 1):
-                pattern+="(.*)\n"
-
-            val = re.search(pattern,textfile)
-
-            for col in val.groups():
-                values.append([tp(_) for _ in col.split("\t")])
-            return np.array(values)
+        num_rows = endrow-startrow+1
+    else:
+        num_rows = endcol-startcol+1
+    rows = textfile.get_rows(label, num_rows, occurrence)
+    if num_rows == 1:
+        return text_to_array(rows[0], tp)
+    return text_to_array(rows, tp)
 
 def text_write_range(textfile, address, label, val):
     #single cell
@@ -518,6 +526,23 @@ def text_write_range(textfile, address, label, val):
 
     textfile.write("\n")
 
+#version of the input loaders. Change when loading changes in a way the
+#INPUTS layout does not show so that cached inputs are rebuilt
+INPUTS_VERSION = 1
+
+#key of a cached input file. Depends on the file contents, the loader and
+#the INPUTS layout so that cached inputs are never used after any of them change
+def get_cache_key(contents, loader):
+    key = hashlib.sha256()
+    key.update("{0}\n{1}\n".format(INPUTS_VERSION, loader).encode())
+    for sheetname, sheetvar in TABS:
+        for label, varname, address, tp in INPUTS[sheetvar]:
+            if callable(address):
+                address = address.__name__
+            key.update(repr((sheetname, label, varname, address, tp.__name__)).encode())
+    key.update(contents)
+    return key.hexdigest()
+
 #converts excel address to row,col
 def xl_cell_to_rowcol(cell):
     collet,rownum = re.match("([a-zA-Z]*)(\d*)",cell).groups()
@@ -557,6 +582,8 @@ class Inputs(object):
     def __init__(self):
         #create object for each tab
         self.tabnames = []
+        #precomputed tables, see tables.py
+        self.tables = None
 
     def load_excel(self, filepath):
         self.delete_inputs()
@@ -568,7 +595,7 @@ class Inputs(object):
             inputtab = INPUTS[sheetvar]
             sheet = wb.sheet_by_name(sheetname)
             for label, varname, address, tp in inputtab:
-                if isinstance(address, collections.Callable):
+                if callable(address):
                     #its a function
                     value = address(sheet)
                 else:
@@ -581,7 +608,7 @@ class Inputs(object):
             for sheetname, sheetvar in TABS:
                 inputtab = INPUTS[sheetvar]
                 for label, varname, address, tp in inputtab:
-                    if isinstance(address, collections.Callable):
+                    if callable(address):
                         fname = address.__name__
                         fname+="_write_text"
                         globals()[fname](fwrite,self)
@@ -601,12 +628,12 @@ class Inputs(object):
             self.tabnames.append(varname)
 
         with open(filepath) as fread:
-            textfile = fread.read()
+            textfile = TextIndex(fread.read())
 
         for sheetname, sheetvar in TABS:
             inputtab = INPUTS[sheetvar]
             for label, varname, address, tp in inputtab:
-                if isinstance(address, collections.Callable):
+                if callable(address):
                     #its a function
                     fname = address.__name__
                     fname += "_load_text"
@@ -615,8 +642,31 @@ class Inputs(object):
                     value = text_get_range(textfile, address,label, tp)
                 getattr(self,sheetvar).add_input(varname,value)
 
+    #loads inputs with load (load_excel or load_txt) unless the same file was
+    #already loaded into cache_dir, in which case the built tabs are read back
+    def load_cached(self, filepath, load, cache_dir):
+        with open(filepath, "rb") as f:
+            key = get_cache_key(f.read(), load.__name__)
+        cachepath = os.path.join(cache_dir, key+".pkl")
+        if os.path.exists(cachepath):
+            self.delete_inputs()
+            with open(cachepath, "rb") as f:
+                for varname, tab in pickle.load(f):
+                    setattr(self, varname, tab)
+                    self.tabnames.append(varname)
+            return
+        load(filepath)
+        #write to a temporary file first so that runs sharing the cache never read part of an entry
+        os.makedirs(cache_dir, exist_ok = True)
+        tmppath = "{0}.{1}.tmp".format(cachepath, os.getpid())
+        with open(tmppath, "wb") as f:
+            pickle.dump([(varname, getattr(self, varname)) for varname in self.tabnames], f,
+                        pickle.HIGHEST_PROTOCOL)
+        os.replace(tmppath, cachepath)
+
     def delete_inputs(self):
         self.tabnames = []
+        self.tables = None
         for sheetname, varname in TABS:
             if hasattr(self, varname):
                 delattr(self, varname)
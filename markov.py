@@ -0,0 +1,344 @@
+"""
+Markov cohort solver for smoking model
+
+Propagates the expected state occupancy of the cohort month by month instead of
+simulating patients, giving the population means of the summary outputs in
+seconds. States are by gender, initial age in years, smoking status with former
+smokers bucketed by time since quit, and smoking intensity. The pre-event and
+event masses of each event are carried within every state assuming events are
+independent of each other given the state. Interventions, prophs, screening
+and the quit probs that depend on event history are left out. Those the inputs
+use are written as a warning at the top of the output.
+"""
+
+from enums import *
+from inputs import *
+from outputs import *
+from tables import *
+from cohort import get_age_cats
+import numpy as np
+
+#width in months of the time since quit buckets of former smokers and the
+#number of buckets. The last bucket is open ended
+QUIT_BUCKET_WIDTH = 12
+NUM_QUIT_BUCKETS = 10
+
+#states of never and current smokers. Former smokers are in the buckets after them
+STATE_NEVER = 0
+STATE_CURRENT = 1
+STATE_FORMER = 2
+NUM_STATES = STATE_FORMER+NUM_QUIT_BUCKETS
+STATE_SS = np.array([SS_NEVER, SS_CURRENT]+[SS_FORMER]*NUM_QUIT_BUCKETS)
+
+#mean of a table by months since quit (last axis) over the months of each quit
+#bucket. Months past the end of the table take its last value
+def quit_bucket_mean(table):
+    table = np.asarray(table, float)
+    months = np.minimum(np.arange(NUM_QUIT_BUCKETS*QUIT_BUCKET_WIDTH), table.shape[-1]-1)
+    table = table[..., months]
+    return table.reshape(table.shape[:-1]+(NUM_QUIT_BUCKETS, QUIT_BUCKET_WIDTH)).mean(axis=-1)
+
+#the features left out of the markov cohort that have a nonzero prob in inputs.
+#The expected outputs do not include whatever these would change
+def get_omitted_features(inputs):
+    pevt = inputs.pre_events
+    intv = inputs.intervention
+    prophs = inputs.prophs
+    smoking = inputs.smoking
+    omitted = []
+    if np.any((pevt.screening_regular_max > 0) & (pevt.screening_regular_start_age >= 0).any(axis = 0)):
+        omitted.append("regular screening")
+    if np.any(pevt.screening_background_prob > 0):
+        omitted.append("background screening")
+    if np.any(intv.start_prob_init > 0) or np.any(intv.start_prob_month > 0):
+        omitted.append("interventions")
+    if np.any(prophs.start_prob_init > 0) or np.any(prophs.start_prob_month > 0):
+        omitted.append("prophs")
+    if (np.any((smoking.event_quit_prob > 0) & (smoking.event_quit_duration >= 0)) or
+        np.any((smoking.comp_quit_prob > 0) & (smoking.comp_quit_duration >= 0))):
+        omitted.append("quit probs after events")
+    return omitted
+
+######################################################################
+#Occupancies are by [gender, age group, state, si] and the event masses by
+#[event, gender, age group, state, si]. Age group y is the patients with initial
+#age of y years and is taken to be 12*y+6 months old at the start
+class MarkovCohort(object):
+    def __init__(self, inputs):
+        self.inputs = inputs
+        self.tables = get_tables(inputs)
+        self.month = 0
+        self.num_groups = int(inputs.sim.maxage)
+        self.disc_mult_month = pow(inputs.sim.disc_rate_year+1,1/12.0)
+        self.disc_factor = 1.0
+
+        #expected outputs of a single patient
+        self.disc_outputs = DiscOutputs(1, inputs)
+        self.death_causes = np.zeros(len(DTH_CAUSES))
+        self.num_alive = []
+        #features of the inputs the expected outputs leave out
+        self.omitted = get_omitted_features(inputs)
+
+        #index arrays that broadcast over the occupancy axes
+        self.g = np.arange(len(GENDERS))[:,None,None,None]
+        self.ss = STATE_SS[None,None,:,None]
+        self.si = np.arange(len(SI))[None,None,None,:]
+        self.e = np.arange(NUM_EVENTS)[:,None,None,None,None]
+        self.init_tables()
+        self.init_cohort()
+    #state tables that depend on months since quit only through the bucket
+    def init_tables(self):
+        inp = self.inputs
+        months = np.arange(NUM_QUIT_BUCKETS*QUIT_BUCKET_WIDTH)
+        #by [si, agecat, bucket]
+        self.relapse = quit_bucket_mean(self.tables.relapse.table)
+        #by [event, si, agequit_cat, bucket]
+        self.pevent_inc_quit = quit_bucket_mean(self.tables.pevent_inc_quit.table)
+        self.event_inc_quit = quit_bucket_mean(self.tables.event_inc_quit.table)
+        self.event_comp_quit = quit_bucket_mean(self.tables.event_comp_quit.table)
+        #by [bucket]
+        self.nathist_quit_weight = quit_bucket_mean(self.tables.nathist_quit_weight.table)
+        #share of each bucket with background care costs of current smokers, by [bucket]
+        self.bkgd_current = quit_bucket_mean(months < inp.costs.bkgd_trans)
+        #share of each bucket with the quit qol multiplier, by [si, bucket]
+        self.qol_quit = quit_bucket_mean(months <= inp.qol.quit_duration[:,None])
+        #months since quit at the middle of each state's bucket, 0 for never and current smokers
+        self.quit_mid = np.zeros(NUM_STATES)
+        self.quit_mid[STATE_FORMER:] = QUIT_BUCKET_WIDTH*np.arange(NUM_QUIT_BUCKETS)+QUIT_BUCKET_WIDTH/2
+    def init_cohort(self):
+        init = self.inputs.init
+        tables = self.tables
+        ages = 12*np.arange(self.num_groups)+6
+        agecat = get_age_cats(ages)
+
+        #initial age by group with the tails in the first and last groups
+        edges = np.concatenate(([-np.inf], 12*np.arange(1, self.num_groups)-0.5, [np.inf]))
+        age_dist = np.diff(tables.age.cdf(edges))
+
+        #by [gender, group, ss or si]
+        gender_dist = init.sex_dist/init.sex_dist.sum()
+        ss_dist = normalize(init.ss[:,:,agecat].transpose(0,2,1))
+        si_dist = normalize(init.si[:,:,agecat].transpose(0,2,1))
+
+        #months since quit by [group, bucket], bounded by age
+        edges = np.concatenate(([-np.inf], QUIT_BUCKET_WIDTH*np.arange(1, NUM_QUIT_BUCKETS)-0.5, [np.inf]))
+        quit_dist = np.diff(tables.quit_time.cdf(edges[None,:], high = ages[:,None]), axis = 1)
+
+        state_dist = np.zeros((len(GENDERS), self.num_groups, NUM_STATES))
+        state_dist[:,:,STATE_NEVER] = ss_dist[:,:,SS_NEVER]
+        state_dist[:,:,STATE_CURRENT] = ss_dist[:,:,SS_CURRENT]
+        state_dist[:,:,STATE_FORMER:] = ss_dist[:,:,SS_FORMER,None]*quit_dist
+        self.alive = (gender_dist[:,None,None,None]*age_dist[None,:,None,None]*
+                      state_dist[:,:,:,None]*si_dist[:,:,None,:])
+
+        self.pevents = np.zeros((NUM_EVENTS,)+self.alive.shape)
+        self.events = self.alive*init.event_prev[:, self.g, self.ss, self.si, agecat[None,:,None,None]]
+    #age group axis values for the current month
+    def update_start_month(self):
+        ages = 12*np.arange(self.num_groups)+6+self.month
+        self.ageyrs = np.minimum(ages//12, self.inputs.nathist.ns_lifetable.shape[1]-1)[None,:,None,None]
+        self.agecat = get_age_cats(ages)[None,:,None,None]
+        self.old_age = (ages/12 >= self.inputs.sim.maxage)
+        #age category at quitting from the middle of the bucket
+        self.agequit_cat = get_age_cats(np.maximum(ages[:,None]-self.quit_mid, 0))[None,:,:,None]
+        self.bucket = np.maximum(np.arange(NUM_STATES)-STATE_FORMER, 0)[None,None,:,None]
+    #moves occupancy between smoking states. x has the occupancy axes last
+    def update_smoking(self, x):
+        smoking = self.inputs.smoking
+        never = x[...,STATE_NEVER,:]
+        current = x[...,STATE_CURRENT,:]
+        former = x[...,STATE_FORMER:,:]
+
+        start = never*smoking.start_prob[self.g[...,0,0], self.ageyrs[...,0,0]][...,None]
+        quit = current*smoking.quit_prob[self.g[...,0,0], self.ageyrs[...,0,0]][...,None]
+        relapse = former*self.relapse[self.si, self.agecat, self.bucket][...,STATE_FORMER:,:]
+
+        moved = np.empty_like(x)
+        moved[...,STATE_NEVER,:] = never-start
+        moved[...,STATE_CURRENT,:] = current-quit+start+relapse.sum(axis = -2)
+        #former smokers move to the next bucket after its width on average
+        stay = former-relapse
+        shift = stay[...,:-1,:]/QUIT_BUCKET_WIDTH
+        moved[...,STATE_FORMER:,:] = stay
+        moved[...,STATE_FORMER+1:,:] += shift
+        moved[...,STATE_FORMER:-1,:] -= shift
+        moved[...,STATE_FORMER,:] += quit
+        return moved
+    #smoking multiplier of an event prob by state
+    def smoking_mult(self, cs_mult, quit_curve):
+        former = quit_curve[self.e, self.si, self.agequit_cat, self.bucket]
+        return np.where(self.ss == SS_CURRENT, cs_mult[self.e, self.si],
+                        np.where(self.ss == SS_FORMER, former, 1.0))
+    def update_events(self):
+        pevt = self.inputs.pre_events
+        evts = self.inputs.events
+        costs = self.inputs.costs
+        qol = self.inputs.qol
+        g, agecat = self.g, self.agecat
+
+        without = self.alive-self.pevents-self.events
+        prob_pevent = pevt.pevent_inc_baseline[g, self.e, agecat]*self.smoking_mult(pevt.pevent_inc_mult_curr,
+                                                                                    self.pevent_inc_quit)
+        prob_event = evts.event_inc_baseline[g, self.e, agecat]*self.smoking_mult(evts.event_inc_mult_curr,
+                                                                                  self.event_inc_quit)
+        prob_comp = evts.event_comp_baseline[g, self.e, agecat]*self.smoking_mult(evts.event_comp_mult_curr,
+                                                                                  self.event_comp_quit)
+        new_pevents = without*prob_pevent
+        comps = self.events*prob_comp
+        had_pevents = self.pevents+new_pevents
+        pevent_to_event = had_pevents*pevt.pevent_to_event_prob[g, self.e, agecat]
+        new_events = (without-new_pevents)*prob_event
+        had_events = self.events
+
+        self.pevents = self.pevents+new_pevents-pevent_to_event
+        self.events = self.events+pevent_to_event+new_events
+
+        #costs and qol multiplier by event
+        e = self.e
+        self.event_costs = had_events*costs.event_month[e]+(pevent_to_event+new_events)*costs.event_init[e]
+        self.comp_costs = comps*costs.comp[e]
+        with np.errstate(divide = "ignore", invalid = "ignore"):
+            qol_change = (had_events*(qol.event_month[e]*(1+prob_comp*(qol.comp[e]-1))-1)+
+                          new_events*(qol.event_init[e]-1)+
+                          (had_pevents-pevent_to_event)*(qol.screen_undet[e]-1)+
+                          pevent_to_event*(qol.screen_undet[e]*qol.event_init[e]-1))
+            self.event_qol = np.where(self.alive > 0, 1+qol_change/self.alive, 1.0).prod(axis = 0)
+
+        #deaths from the events and their complications
+        self.event_deaths = new_events*evts.event_prob_death[e]
+        self.comp_deaths = comps*evts.event_comp_prob_death[e]
+    def get_nathist_mort(self):
+        nh = self.inputs.nathist
+        g, si, ageyrs, agecat = self.g, self.si, self.ageyrs, self.agecat
+        ns_mort = nh.ns_lifetable[g, ageyrs]
+        if nh.cs_mort_usemult:
+            cs_mort = ns_mort*nh.cs_mort_mult[si, g, agecat]
+        else:
+            cs_mort = nh.cs_lifetable[si, g, ageyrs]
+        if nh.xs_mort_usemult:
+            xs_mort = ns_mort*nh.xs_mort_mult[si, g, agecat]
+        else:
+            xs_mort = nh.xs_agequit_mult[si, g, agecat]*nh.xs_lifetable[si, g, ageyrs]
+        weight = self.nathist_quit_weight[self.bucket]
+        return np.where(self.ss == SS_NEVER, ns_mort,
+                        np.where(self.ss == SS_CURRENT, cs_mort, (1-weight)*cs_mort + weight*xs_mort))
+    def update_mort(self):
+        pevt = self.inputs.pre_events
+        #pre-event mortality multiplier of each event averaged over the state
+        mort_mult = pevt.pevent_mort_mult[self.g, self.e, self.agecat]
+        with np.errstate(divide = "ignore", invalid = "ignore"):
+            share = np.where(self.alive > 0, self.pevents/self.alive, 0.0)
+        mean_mult = 1+share*(mort_mult-1)
+        nathist = self.get_nathist_mort()*mean_mult.prod(axis = 0)
+
+        #deaths from each event come out of that event's mass and the others' in proportion
+        event_deaths = self.event_deaths+self.comp_deaths
+        total = event_deaths.sum(axis = 0)
+        with np.errstate(divide = "ignore", invalid = "ignore"):
+            others = np.where(self.alive > 0, (total-event_deaths)/self.alive, 0.0)
+        #those with a pre-event die at its multiplier and those without at none
+        without_pevent = nathist/mean_mult
+        self.events = (self.events-event_deaths-self.events*others)*(1-without_pevent)
+        self.pevents = (self.pevents-self.pevents*others)*(1-without_pevent*mort_mult)
+        nathist_deaths = (self.alive-total)*nathist
+
+        self.death_causes[DTH_NAT_HIST] += nathist_deaths.sum()
+        self.death_causes[DTH_EVENT_0:DTH_EVENT_0+NUM_EVENTS] += self.event_deaths.sum(axis = (1,2,3,4))
+        self.death_causes[DTH_EVENT_COMP_0:DTH_EVENT_COMP_0+NUM_EVENTS] += self.comp_deaths.sum(axis = (1,2,3,4))
+        return (self.alive-total)*(1-nathist)
+    #adds the outputs for the month of the occupancy alive at the start of the month
+    def update_end_month(self, survivors):
+        inp = self.inputs
+        alive = self.alive
+        #by [ss, agecat, gender]
+        by_ss = np.zeros((len(SS), len(AGE_BRACKETS), len(GENDERS)))
+
+        #background costs with recent quitters at the current smoker cost
+        bkgd = inp.costs.bkgd[self.g, self.ss, self.agecat]
+        bkgd_current = inp.costs.bkgd[self.g, SS_CURRENT, self.agecat]
+        share = self.bkgd_current[self.bucket]
+        bkgd = np.where(self.ss == SS_FORMER, share*bkgd_current+(1-share)*bkgd, bkgd)
+        bkgd_costs = alive*bkgd
+        costs = bkgd_costs+self.event_costs.sum(axis = 0)+self.comp_costs.sum(axis = 0)
+
+        qalms = alive
+        if inp.qol.enable_qol:
+            mult = inp.qol.base[self.si, self.ss]
+            share = self.qol_quit[self.si, self.bucket]
+            mult = np.where(self.ss == SS_FORMER, mult*(1+share*(inp.qol.quit[self.si]-1)), mult)
+            qalms = alive*mult*self.event_qol
+
+        for name, value in (("lms", alive), ("qalms", qalms), ("overall_costs", costs)):
+            by_ss[:] = 0
+            np.add.at(by_ss, (self.ss, self.agecat, self.g), value.sum(axis = -1, keepdims = True))
+            self.add_disc_out(name, by_ss)
+        self.add_disc_out("lms_SI", alive.sum(axis = (0,1,2)))
+        self.add_disc_out("cost_bkgd", bkgd_costs.sum())
+        self.add_disc_out("cost_event", self.event_costs.sum(axis = (1,2,3,4)))
+        self.add_disc_out("cost_comp", self.comp_costs.sum(axis = (1,2,3,4)))
+        self.num_alive.append(alive.sum())
+
+        #kill patients if max age reached
+        old_age = survivors[:,self.old_age]
+        self.death_causes[DTH_OLD_AGE] += old_age.sum()
+        survivors[:,self.old_age] = 0
+        self.events[:,:,self.old_age] = 0
+        self.pevents[:,:,self.old_age] = 0
+        self.alive = survivors
+
+        self.month += 1
+        self.disc_factor *= 1/self.disc_mult_month
+    def add_disc_out(self, name, value):
+        self.disc_outputs.add_value(name, 0, None, value, self.disc_factor)
+    #run single time step(month)
+    def run_step(self):
+        self.update_start_month()
+        self.alive = self.update_smoking(self.alive)
+        self.pevents = self.update_smoking(self.pevents)
+        self.events = self.update_smoking(self.events)
+        self.update_events()
+        self.update_end_month(self.update_mort())
+    def run_until_death(self):
+        while self.month < self.inputs.sim.maxage*12 and self.alive.sum() > 0:
+            self.run_step()
+
+#normalizes weights over the last axis. All zero weights give the first category
+def normalize(weights):
+    weights = np.array(weights, float)
+    total = weights.sum(axis = -1, keepdims = True)
+    weights[...,0] += (total[...,0] <= 0)
+    return weights/weights.sum(axis = -1, keepdims = True)
+
+#writes the expected summary outputs of a markov cohort
+def write_markov_output(filepath, cohort):
+    dout = cohort.disc_outputs
+    with open(filepath,'w') as fout:
+        fout.write("POPULATION SUMMARY MEASURES (MARKOV COHORT)")
+        if cohort.omitted:
+            fout.write("\n\tWARNING\tLeft out but used by the inputs\t{0}".format(", ".join(cohort.omitted)))
+        fout.write("\n\tDisc Rate\t{0}".format(dout.disc.disc_rate))
+
+        fout.write("\n\n\tOutcome\tMean\tStd Dev")
+        for label, out in (("Disc", dout.disc), ("Undisc", dout.undisc)):
+            for name, value in (("Costs", out.overall_costs), ("Life Months", out.lms),
+                                ("Quality-Adjusted Life Months", out.qalms)):
+                fout.write("\n\t{0} {1}\t{2}\t--".format(name, label, value.sum()))
+            fout.write("\n")
+
+        write_3d_array(fout, "Costs",(SS_STRS,AGE_BRACKET_STRS,GENDER_STRS),dout.disc.overall_costs,(2,0,1))
+        write_3d_array(fout, "Life Months",(SS_STRS,AGE_BRACKET_STRS,GENDER_STRS),dout.disc.lms,(2,0,1))
+        write_3d_array(fout, "Quality-Adjusted Life Months",(SS_STRS,AGE_BRACKET_STRS,GENDER_STRS),dout.disc.qalms,(2,0,1))
+
+        write_1d_array(fout, "Life Months",(SI_STRS), dout.disc.lms_SI)
+
+        fout.write("\nDEATH DISTRIBUTIONS")
+        death_causes = ["Nat Hist","Old Age", "Proph Tox", "Intervention Tox", "Confirmatory Test",]
+        death_causes.extend(["{0}".format(cohort.inputs.sim.event_names[i]) for i in range(NUM_EVENTS)])
+        death_causes.extend(["{0} Complication".format(cohort.inputs.sim.event_names[i]) for i in range(NUM_EVENTS)])
+        write_1d_array(fout, "Causes of Death", death_causes, cohort.death_causes, ismonth = True)
+
+        fout.write("\nCOSTS")
+        write_1d_array(fout, "Event Costs",cohort.inputs.sim.event_names, dout.disc.cost_event)
+        write_1d_array(fout, "Event Complication Costs",cohort.inputs.sim.event_names, dout.disc.cost_comp,
+                       write_labels = False)
+        write_single(fout, "Background Care Costs",dout.disc.cost_bkgd)
@@ -5,7 +5,10 @@ Handles reading and manipulating outputs for the smoking model
 """
 
 from enums import *
+from tracelog import *
+from profiling import *
 import numpy as np
+import gzip, io, struct, zipfile
 
 ######################################################################
 #(varname, shape, init,type)
@@ -84,10 +87,14 @@ MONTH_OUTPUTS = [("num_alive",(len(SS),len(SI)),0,int),
     ]
     
 #Overall Outputs (undiscounted)
+#first_pid is the pid of the first patient row so that a worker can hold
+#the outputs for a range of patients only
 class Outputs(dict):
-    def __init__(self, num_patients, inputs, outputs = OUTPUTS):
+    def __init__(self, num_patients, inputs, outputs = OUTPUTS, first_pid = 0):
         super(Outputs,self).__init__()
         self.num_patients = num_patients
+        self.first_pid = first_pid
+        self.varnames = []
         self.init_outputs(outputs)
         self.inputs = inputs
         self.disc_rate = inputs.sim.disc_rate_year
@@ -96,6 +103,7 @@ class Outputs(dict):
             self.add_output(output)
     def add_output(self, params):
         varname, shape, value, typ =params
+        self.varnames.append(varname)
         if typ == list:
             #dont create numpy array this will be a dynamically grown list
             self[varname] = []
@@ -104,6 +112,7 @@ class Outputs(dict):
             self[varname] = np.full(new_shape, value, typ)
     def add_value(self, *args):
         varname, pid, index, value = args
+        pid -= self.first_pid
         if index is not None:
             self[varname][pid][index]+=value
         else:
@@ -111,134 +120,310 @@ class Outputs(dict):
     def add_list_value(self, *args):
         name, value = args
         self[name].append(value)
+    #adds in the patient rows of outputs from another range of patients
+    def merge(self, other):
+        start = other.first_pid - self.first_pid
+        for varname in other.varnames:
+            if isinstance(other[varname], list):
+                self[varname].extend(other[varname])
+            else:
+                self[varname][start:start+other.num_patients] += other[varname]
+    #keeps only the first num_patients patient rows
+    def truncate(self, num_patients):
+        for varname in self.varnames:
+            if not isinstance(self[varname], list):
+                self[varname] = self[varname][:num_patients]
+        self.num_patients = num_patients
     def __getattr__(self, name):
         return self[name]    
     def __setattr__(self,name, value):
         self[name] = value
 
 
+
+#running summary of a patient level output over all patients merged so far.
+#Keeps the totals, the number of patients with a nonzero value and the
+#Welford mean and sum of squared deviations of each patient's total
+class OutputSummary(object):
+    def __init__(self, shape, typ):
+        self.count = 0
+        self.total = np.zeros(shape, typ)
+        self.nonzero = np.zeros(shape, int)
+        self.mean_total = 0.0
+        self.m2_total = 0.0
+    #adds the rows of a per patient output array
+    def add_rows(self, rows):
+        n = len(rows)
+        if not n:
+            return
+        totals = rows.reshape(n, -1).sum(axis=1)
+        mean = totals.mean()
+        self.total += rows.sum(axis=0)
+        self.nonzero += (rows != 0).sum(axis=0)
+        self.add_stats(n, mean, ((totals-mean)**2).sum())
+    #combines mean and m2 of n more patient totals (Chan et al. parallel update)
+    def add_stats(self, n, mean, m2):
+        if not n:
+            return
+        count = self.count+n
+        delta = mean-self.mean_total
+        self.mean_total += delta*n/count
+        self.m2_total += m2+delta**2*self.count*n/count
+        self.count = count
+    def merge(self, other):
+        if isinstance(other, OutputSummary):
+            self.total += other.total
+            self.nonzero += other.nonzero
+            self.add_stats(other.count, other.mean_total, other.m2_total)
+        else:
+            self.add_rows(other)
+    def std_total(self):
+        return np.sqrt(self.m2_total/self.count)
+
+#Outputs that only keep an OutputSummary for each output instead of a row per patient.
+#Rows from blocks of patients are folded in by merge so memory does not grow with runsize
+class SummaryOutputs(Outputs):
+    def add_output(self, params):
+        varname, shape, value, typ =params
+        self.varnames.append(varname)
+        if typ == list:
+            self[varname] = []
+        else:
+            self[varname] = OutputSummary(shape, typ)
+    def add_value(self, *args):
+        raise TypeError("summary outputs can only be merged into")
+    #summaries only hold the patients merged in
+    def truncate(self, num_patients):
+        self.num_patients = num_patients
+    def merge(self, other):
+        for varname in other.varnames:
+            if isinstance(other[varname], list):
+                self[varname].extend(other[varname])
+            else:
+                self[varname].merge(other[varname])
     
 #stores both discounted and undiscounted outputs
 class DiscOutputs(object):
-    def __init__(self, num_patients, inputs):
-        self.disc = Outputs(num_patients, inputs, DISC_OUTPUTS)
-        self.undisc = Outputs(num_patients, inputs, DISC_OUTPUTS)
+    def __init__(self, num_patients, inputs, first_pid = 0, summary = False):
+        outputs_class = SummaryOutputs if summary else Outputs
+        self.disc = outputs_class(num_patients, inputs, DISC_OUTPUTS, first_pid)
+        self.undisc = outputs_class(num_patients, inputs, DISC_OUTPUTS, first_pid)
         self.disc.add_output(("overall_costs",[len(SS),len(AGE_BRACKETS), len(GENDERS)],0.0, float))
         self.undisc.add_output(("overall_costs",[len(SS),len(AGE_BRACKETS), len(GENDERS)],0.0, float))
     def add_value(self, *args):
         varname, pid, index, value, disc_factor = args
+        pid -= self.disc.first_pid
         if index is not None:
             self.undisc[varname][pid][index]+=value
             self.disc[varname][pid][index]+=value*disc_factor
         else:
             self.undisc[varname][pid]+=value
             self.disc[varname][pid]+=value*disc_factor
-
-
-
-#class so store outputs for a single month
-class MonthOut(dict):
-    def __init__(self, outputs = MONTH_OUTPUTS):
-        super(MonthOut,self).__init__()
+    def merge(self, other):
+        self.disc.merge(other.disc)
+        self.undisc.merge(other.undisc)
+    def truncate(self, num_patients):
+        self.disc.truncate(num_patients)
+        self.undisc.truncate(num_patients)
+
+
+#class to store all monthly outputs. Each output is a single array by
+#[month, *shape] allocated for the longest possible run
+class MonthlyOutputs(dict):
+    def __init__(self, max_months, outputs = MONTH_OUTPUTS):
+        super(MonthlyOutputs,self).__init__()
+        self.max_months = max_months
+        #number of months with outputs
+        self.num_months = 0
+        self.varnames = []
         for output in outputs:
             self.add_output(output)
     def add_output(self, params):
         varname, shape, value, typ =params
-        self[varname] = np.full(shape, value, typ)
-    def add_value(self, varname, index, value):
-        if index is not None:
-            self[varname][index]+=value
+        self.varnames.append(varname)
+        self[varname] = np.full([self.max_months]+list(shape), value, typ)
+    #marks month as having outputs. Grows the arrays for a run that
+    #goes past the max months
+    def use_month(self, month):
+        if month >= self.max_months:
+            for varname in self.varnames:
+                extra = np.zeros((month+1-self.max_months,)+self[varname].shape[1:], self[varname].dtype)
+                self[varname] = np.concatenate((self[varname], extra))
+            self.max_months = month+1
+        if month >= self.num_months:
+            self.num_months = month+1
+    def add_value(self, varname, month, index, value):
+        if index is None:
+            self[varname][month]+=value
+        elif isinstance(index, tuple):
+            self[varname][(month,)+index]+=value
         else:
-            self[varname]+=value
+            self[varname][month, index]+=value
+    #adds the monthly totals of another set of patients
+    def merge(self, other):
+        num_months = other.num_months
+        if num_months:
+            self.use_month(num_months-1)
+        for varname in other.varnames:
+            self[varname][:num_months] += other[varname][:num_months]
     def __getattr__(self, name):
-        return self[name]    
+        return self[name]
     def __setattr__(self,name, value):
         self[name] = value
 
-#class to store all monthly outputs
-class MonthlyOutputs(list):
-    def __init__(self):
-        super(MonthlyOutputs,self).__init__()
-    def add_month(self):
-        mo = MonthOut()
-        self.append(mo)
-        return mo
+#all the output accumulators for a block of patients.
+#Each block is filled by a single worker and blocks are merged in pid order
+#so the results do not depend on how blocks were spread over workers
+#With summary the patient level outputs are kept as summaries only
+class OutputBlock(object):
+    def __init__(self, num_patients, inputs, first_pid = 0, summary = False):
+        self.first_pid = first_pid
+        self.num_patients = num_patients
+        outputs_class = SummaryOutputs if summary else Outputs
+        self.outputs = outputs_class(num_patients, inputs, first_pid = first_pid)
+        self.disc_outputs = DiscOutputs(num_patients, inputs, first_pid, summary)
+        self.monthly_outputs = MonthlyOutputs(inputs.sim.maxage*12+1)
+        #records of the traced patients
+        self.traces = TraceLog()
+        #StepProfile of the patients when the run is profiled
+        self.profile = None
+    def merge(self, other):
+        self.outputs.merge(other.outputs)
+        self.disc_outputs.merge(other.disc_outputs)
+        self.monthly_outputs.merge(other.monthly_outputs)
+        self.traces.merge(other.traces)
+        if other.profile is not None:
+            if self.profile is None:
+                self.profile = StepProfile()
+            self.profile.merge(other.profile)
+    #keeps only the first num_patients patients for a run that stopped early
+    def truncate(self, num_patients):
+        self.num_patients = num_patients
+        self.outputs.truncate(num_patients)
+        self.disc_outputs.truncate(num_patients)
     
 ############################################################################################################
-def write_avg(fout, label, a, axis):
+#statistics across patients of an output.
+#a is either the per patient array or an OutputSummary
+def patient_mean(a):
+    if isinstance(a, OutputSummary):
+        return a.total/a.count
+    return a.mean(axis=0)
+def patient_sum(a):
+    if isinstance(a, OutputSummary):
+        return a.total
+    return a.sum(axis=0)
+#mean over the patients with a nonzero value
+def nonzero_mean(a):
+    if isinstance(a, OutputSummary):
+        return a.total/np.ma.masked_equal(a.nonzero, 0)
+    return np.ma.masked_equal(a,0).mean(axis=0)
+
+#mean and std of patient totals over axis. Summaries always use the total over all cells
+def patient_total_stats(a, axis):
+    if isinstance(a, OutputSummary):
+        return a.mean_total, a.std_total()
     a = a.sum(axis =axis)
-    mean = a.mean()
-    std = a.std()
-
+    return a.mean(), a.std()
+#population summary measures. (label, group, varname) where group is disc or undisc
+SUMMARY_MEASURES = [("Costs Disc", "disc", "overall_costs"),
+                    ("Life Months Disc", "disc", "lms"),
+                    ("Quality-Adjusted Life Months Disc", "disc", "qalms"),
+                    ("Costs Undisc", "undisc", "overall_costs"),
+                    ("Life Months Undisc", "undisc", "lms"),
+                    ("Quality-Adjusted Life Months Undisc", "undisc", "qalms"),
+                    ]
+#mean and standard error of the mean of the paired differences b-a of patient
+#totals. a and b are per patient arrays of two runs with common random numbers
+def paired_diff_stats(a, b, axis):
+    diff = b.sum(axis = axis)-a.sum(axis = axis)
+    return diff.mean(), diff.std()/np.sqrt(len(diff))
+def write_avg(fout, label, a, axis):
+    mean, std = patient_total_stats(a, axis)
     fout.write("\n\t{0}\t{1}\t{2}".format(label, mean,std))
 
 def write_single(fout, header, a, avg=True, ismonth = False):
     if not ismonth:
         if avg:
-            a = a.mean(axis=0)
+            a = patient_mean(a)
         else:
-            a= a.sum(axis=0)
+            a = patient_sum(a)
 
     fout.write("\n\t{0}\t{1}".format(header, a))
+
+#values of an array as nested lists of cells to write. Masked values are written as --
+def get_cells(a):
+    if np.ma.isMaskedArray(a):
+        return a.astype(object).filled("--").tolist()
+    return np.asarray(a).tolist()
+#row of cells each preceded by a tab
+def join_cells(cells):
+    if not cells:
+        return ""
+    return "\t"+"\t".join(map(str, cells))
                
 def write_1d_array(fout, header, labels, a, avg= True, write_labels = True, ismonth=False):
     if not ismonth:
         #avg across patients
         if avg:
-            a = a.mean(axis=0)
+            a = patient_mean(a)
         else:
-            a=a.sum(axis=0)
+            a = patient_sum(a)
 
-    fout.write("\n")
+    text = "\n"
     if write_labels:
-        fout.write("\n\t\t"+"\t".join(labels))
-    fout.write("\n\t{0}".format(header))
-    for x in range(a.size):
-        fout.write("\t{0}".format(a[x]))
+        text += "\n\t\t"+"\t".join(labels)
+    fout.write(text+"\n\t{0}".format(header)+join_cells(get_cells(a)))
             
 def write_2d_array(fout, header, labels, a, order, avg= True, ismonth=False):
     if not ismonth:
         #avg across patients
         if avg:
-            a = a.mean(axis=0)
+            a = patient_mean(a)
         else:
-            a=a.sum(axis=0)
+            a = patient_sum(a)
     a= a.transpose(order)
     i,j=order
-    dims = a.shape
-    fout.write("\n")
-    fout.write("\n\t{0}\t".format(header)+"\t".join(labels[j]))
-    for x in range(dims[0]):
-        fout.write("\n\t{0}".format(labels[i][x]))
-        for y in range(dims[1]):
-            fout.write("\t{0}".format(a[x,y]))
+    cells = get_cells(a)
+    rows = ["\n\t{0}".format(labels[i][x])+join_cells(cells[x]) for x in range(len(cells))]
+    fout.write("\n\n\t{0}\t".format(header)+"\t".join(labels[j])+"".join(rows))
 def write_3d_array(fout, header, labels, a, order, avg= True, ismonth = False):
     if not ismonth:
         #avg across patients
         if avg:
-            a = a.mean(axis=0)
+            a = patient_mean(a)
         else:
-            a=a.sum(axis=0)
+            a = patient_sum(a)
     a= a.transpose(order)
     i,j,k=order
-    dims = a.shape
-    fout.write("\n")
-    fout.write("\n\t{0}\t\t".format(header)+"\t".join(labels[k]))
-    for x in range(dims[0]):
-        fout.write("\n\t{0}".format(labels[i][x]))
-        for y in range(dims[1]):
+    cells = get_cells(a)
+    rows = ["\n\n\t{0}\t\t".format(header)+"\t".join(labels[k])]
+    for x in range(len(cells)):
+        rows.append("\n\t{0}".format(labels[i][x]))
+        for y in range(len(cells[x])):
             if y == 0:
-                fout.write("\t{0}".format(labels[j][y]))
+                rows.append("\t{0}".format(labels[j][y]))
             else:
-                fout.write("\n\t\t{0}".format(labels[j][y]))
-            for z in range(dims[2]):
-                fout.write("\t{0}".format(a[x,y,z]))
+                rows.append("\n\t\t{0}".format(labels[j][y]))
+            rows.append(join_cells(cells[x][y]))
+    fout.write("".join(rows))
                 
-   
+#size of the write buffer of output files
+WRITE_BUFFER = 1 << 20
+#gzip level of compressed output files
+GZIP_LEVEL = 6
+
+#opens an output file for writing text through a large buffer. With compress
+#the text is gzip compressed
+def open_output(filepath, compress = False):
+    if compress:
+        return io.TextIOWrapper(io.BufferedWriter(gzip.open(filepath, "wb", GZIP_LEVEL), WRITE_BUFFER))
+    return open(filepath, "w", buffering = WRITE_BUFFER)
+
 #writes output file
-def write_output(filepath,out,dout, mout):
+def write_output(filepath,out,dout, mout, compress = False):
     #write header
-    with open(filepath,'w') as fout:
+    with open_output(filepath, compress) as fout:
         fout.write("POPULATION SUMMARY MEASURES")
         fout.write("\n\tRun Size\t{0}".format(out.num_patients))
         fout.write("\n\tDisc Rate\t{0}".format(dout.disc.disc_rate))
@@ -289,18 +474,17 @@ def write_events(fout, out, dout):
                "mean months with pre-event","num incident pre-event",
                "num complications",)
     fout.write("\n\t\t"+"\t".join(headers))
-    values = (np.ma.masked_equal(out.event_mths,0).mean(axis=0),
-              out.event_num_prev.sum(axis=0),
-              out.event_num_inc.sum(axis=0),
-              np.ma.masked_equal(out.pevent_mths,0).mean(axis=0),
-              out.pevent_num_inc.sum(axis=0),
-              out.event_comp.sum(axis=0),
+    values = (nonzero_mean(out.event_mths),
+              patient_sum(out.event_num_prev),
+              patient_sum(out.event_num_inc),
+              nonzero_mean(out.pevent_mths),
+              patient_sum(out.pevent_num_inc),
+              patient_sum(out.event_comp),
               )
 
-    for event in range(NUM_EVENTS):
-        fout.write("\n\t{0}".format(out.inputs.sim.event_names[event]))
-        for value in values:
-            fout.write("\t{0}".format(value[event]))
+    cells = [get_cells(value) for value in values]
+    fout.write("".join(["\n\t{0}".format(out.inputs.sim.event_names[event])+
+                        join_cells([value[event] for value in cells]) for event in range(NUM_EVENTS)]))
 
 def write_smoking(fout, out, dout):
     fout.write("\nSMOKING")
@@ -336,9 +520,9 @@ def write_interventions(fout, out, dout):
     fout.write("\nINTERVENTIONS")
 
     headers = ("num start events", "tox events", "intervention costs")
-    values = (out.int_start.sum(axis=0),
-            out.int_num_tox.sum(axis=0),
-              dout.disc.cost_int.sum(axis=0),
+    values = (patient_sum(out.int_start),
+            patient_sum(out.int_num_tox),
+              patient_sum(dout.disc.cost_int),
         )
     fout.write("\n\t\t"+"\t".join(headers))
     for intv in range(NUM_INTERVENTIONS):
@@ -350,8 +534,8 @@ def write_prophs(fout, out, dout):
     fout.write("\nPROPHS")
 
     headers = ("tox events", "proph costs")
-    values = (out.proph_num_tox.sum(axis=0),
-              dout.disc.cost_proph.sum(axis=0),
+    values = (patient_sum(out.proph_num_tox),
+              patient_sum(dout.disc.cost_proph),
         )
     fout.write("\n\t\t"+"\t".join(headers))
     for proph in range(NUM_PROPHS):
@@ -369,60 +553,60 @@ def write_costs(fout, out, dout):
     write_single(fout, "Background Care Costs",dout.disc.cost_bkgd, False)
 
 def write_months(fout, out, mout):
-    for n,mo in enumerate(mout):
+    for n in range(mout.num_months):
         fout.write("\nCohort Summary for Month {0}".format(n))
-        write_single(fout, "Num Alive", mo.num_alive.sum(), ismonth = True)
-        write_2d_array(fout, "Num Alive",(SS_STRS,SI_STRS), mo.num_alive, (0,1), ismonth=True)
+        write_single(fout, "Num Alive", mout.num_alive[n].sum(), ismonth = True)
+        write_2d_array(fout, "Num Alive",(SS_STRS,SI_STRS), mout.num_alive[n], (0,1), ismonth=True)
         fout.write("\n")
-        write_single(fout, "Num Deaths", mo.num_deaths.sum(), ismonth = True)
-        write_2d_array(fout, "Num Deaths",(SS_STRS,SI_STRS), mo.num_deaths, (0,1), ismonth=True)
+        write_single(fout, "Num Deaths", mout.num_deaths[n].sum(), ismonth = True)
+        write_2d_array(fout, "Num Deaths",(SS_STRS,SI_STRS), mout.num_deaths[n], (0,1), ismonth=True)
 
         death_causes = ["Nat Hist","Old Age", "Proph Tox", "Intervention Tox", "Confirmatory Test",]
         death_causes.extend(["{0}".format(out.inputs.sim.event_names[i]) for i in range(NUM_EVENTS)])
         death_causes.extend(["{0} Complication".format(out.inputs.sim.event_names[i]) for i in range(NUM_EVENTS)])
-        write_1d_array(fout, "Causes of Death", death_causes, mo.death_causes,ismonth = True)
+        write_1d_array(fout, "Causes of Death", death_causes, mout.death_causes[n],ismonth = True)
     
         fout.write("\n")
-        write_single(fout, "Monthly Costs", mo.costs_disc, ismonth = True)
-        write_single(fout, "Background Care Costs", mo.cost_bkgd, ismonth = True)
-        write_single(fout, "Num Start", mo.smoking_start, ismonth = True)
-        write_2d_array(fout, "Quit Events", (AGE_BRACKET_STRS, GENDER_STRS), mo.smoking_quit, (1, 0), ismonth=True)
-        write_2d_array(fout, "Relapse Events", (AGE_BRACKET_STRS, GENDER_STRS), mo.smoking_relapse, (1, 0), ismonth=True)
+        write_single(fout, "Monthly Costs", mout.costs_disc[n], ismonth = True)
+        write_single(fout, "Background Care Costs", mout.cost_bkgd[n], ismonth = True)
+        write_single(fout, "Num Start", mout.smoking_start[n], ismonth = True)
+        write_2d_array(fout, "Quit Events", (AGE_BRACKET_STRS, GENDER_STRS), mout.smoking_quit[n], (1, 0), ismonth=True)
+        write_2d_array(fout, "Relapse Events", (AGE_BRACKET_STRS, GENDER_STRS), mout.smoking_relapse[n], (1, 0), ismonth=True)
 
         #events
         for event in range(NUM_EVENTS):
             fout.write("\n")
             write_single(fout,"Num Alive without {0}".format(out.inputs.sim.event_names[event]),
-                          mo.event_num_without[event],ismonth = True)
+                          mout.event_num_without[n][event],ismonth = True)
             write_3d_array(fout, "Num Alive with {0}".format(out.inputs.sim.event_names[event]),
-                           (SS_STRS,AGE_BRACKET_STRS,GENDER_STRS), mo.event_num_with[event], (2,0,1), ismonth = True)
+                           (SS_STRS,AGE_BRACKET_STRS,GENDER_STRS), mout.event_num_with[n][event], (2,0,1), ismonth = True)
             write_3d_array(fout, "Num Incident {0}".format(out.inputs.sim.event_names[event]),
-                           (SS_STRS,AGE_BRACKET_STRS,GENDER_STRS), mo.event_inc[event], (2,0,1), ismonth = True)
+                           (SS_STRS,AGE_BRACKET_STRS,GENDER_STRS), mout.event_inc[n][event], (2,0,1), ismonth = True)
             write_3d_array(fout, "Num Incident Pre-event {0}".format(out.inputs.sim.event_names[event]),
-                           (SS_STRS,AGE_BRACKET_STRS,GENDER_STRS), mo.pevent_inc[event], (2,0,1), ismonth = True)
+                           (SS_STRS,AGE_BRACKET_STRS,GENDER_STRS), mout.pevent_inc[n][event], (2,0,1), ismonth = True)
 
             write_2d_array(fout, "Pre-event Screening Results {0}".format(out.inputs.sim.event_names[event]),
-                           (("True Neg","True Pos"),("Obsv Neg","Obsv Pos")),mo.pevent_screen_results[event],(0,1),ismonth=True)
+                           (("True Neg","True Pos"),("Obsv Neg","Obsv Pos")),mout.pevent_screen_results[n][event],(0,1),ismonth=True)
 
             write_single(fout,"Pre-event Confirmatory Tests {0}".format(out.inputs.sim.event_names[event]),
-                         mo.pevent_conf[event],ismonth = True)
+                         mout.pevent_conf[n][event],ismonth = True)
 
             write_3d_array(fout, "Num Complications {0}".format(out.inputs.sim.event_names[event]),
-                           (SS_STRS,AGE_BRACKET_STRS,GENDER_STRS), mo.event_comp[event], (2,0,1), ismonth = True)
+                           (SS_STRS,AGE_BRACKET_STRS,GENDER_STRS), mout.event_comp[n][event], (2,0,1), ismonth = True)
             write_single(fout,"Cost Events {0}".format(out.inputs.sim.event_names[event]),
-                         mo.cost_event[event],ismonth = True)
+                         mout.cost_event[n][event],ismonth = True)
             write_single(fout,"Cost Complications {0}".format(out.inputs.sim.event_names[event]),
-                         mo.cost_comp[event],ismonth = True)
+                         mout.cost_comp[n][event],ismonth = True)
             write_single(fout,"Cost Pre-event Screening {0}".format(out.inputs.sim.event_names[event]),
-                         mo.cost_screening[event],ismonth = True)
+                         mout.cost_screening[n][event],ismonth = True)
             
         #Interventions
         fout.write("\n")
         headers = ("num on intervention", "num start intervention","num stop intervention", "intervention cost")
-        values = (mo.int_num_with,
-                  mo.int_start,
-                  mo.int_stop,
-                  mo.cost_int,
+        values = (mout.int_num_with[n],
+                  mout.int_start[n],
+                  mout.int_stop[n],
+                  mout.cost_int[n],
                 )
         fout.write("\n\t\t"+"\t".join(headers))
         for intv in range(NUM_INTERVENTIONS):
@@ -434,16 +618,203 @@ def write_months(fout, out, mout):
         #Prophs
         fout.write("\n")
         headers = ("num on proph", "num start proph","num stop proph", "proph cost")
-        values = (mo.proph_num_with,
-                  mo.proph_start,
-                  mo.proph_stop,
-                  mo.cost_proph,
+        values = (mout.proph_num_with[n],
+                  mout.proph_start[n],
+                  mout.proph_stop[n],
+                  mout.cost_proph[n],
                 )
         fout.write("\n\t\t"+"\t".join(headers))
         for proph in range(NUM_PROPHS):
             fout.write("\n\t{0}".format(out.inputs.prophs.proph_names[proph]))
             for value in values:
                 fout.write("\t{0}".format(value[proph]))
+############################################################################################################
+#binary results store. A results file is an uncompressed .npz with every output array
+#under "<group>/<varname>" for the groups outputs, disc, undisc and monthly. The first
+#axis is the patient for outputs, disc and undisc and the month for monthly.
+#The axis names of each array are under "axes/<group>/<varname>" and the labels of
+#each named axis under "labels/<axis>"
+
+#axis names of each output after the patient or month axis
+OUTPUT_AXES = {"init_dist_smoking": ("ss", "si"),
+               "init_dist_gender": ("gender",),
+               "death_dist": ("ss", "si"),
+               "death_causes": ("death_cause",),
+               "event_num_prev": ("event",),
+               "event_num_inc": ("event",),
+               "event_mths": ("event",),
+               "pevent_num_inc": ("event",),
+               "pevent_mths": ("event",),
+               "event_comp": ("event",),
+               "int_num_tox": ("intervention",),
+               "int_start": ("intervention",),
+               "proph_num_tox": ("proph",),
+               "smoking_quit": ("age_bracket", "gender"),
+               "smoking_relapse": ("age_bracket", "gender"),
+               }
+DISC_AXES = {"lms": ("ss", "age_bracket", "gender"),
+             "lms_SI": ("si",),
+             "qalms": ("ss", "age_bracket", "gender"),
+             "overall_costs": ("ss", "age_bracket", "gender"),
+             "cost_event": ("event",),
+             "cost_comp": ("event",),
+             "cost_proph": ("proph",),
+             "cost_int": ("intervention",),
+             "cost_screening": ("event",),
+             }
+MONTH_AXES = {"num_alive": ("ss", "si"),
+              "num_deaths": ("ss", "si"),
+              "death_causes": ("death_cause",),
+              "event_num_with": ("event", "ss", "age_bracket", "gender"),
+              "event_num_without": ("event",),
+              "event_inc": ("event", "ss", "age_bracket", "gender"),
+              "pevent_inc": ("event", "ss", "age_bracket", "gender"),
+              "event_comp": ("event", "ss", "age_bracket", "gender"),
+              "pevent_screen_results": ("event", "screen_truth", "screen_result"),
+              "pevent_conf": ("event",),
+              "smoking_quit": ("age_bracket", "gender"),
+              "smoking_relapse": ("age_bracket", "gender"),
+              "cost_event": ("event",),
+              "cost_comp": ("event",),
+              "cost_screening": ("event",),
+              "cost_proph": ("proph",),
+              "cost_int": ("intervention",),
+              "proph_num_with": ("proph",),
+              "proph_start": ("proph",),
+              "proph_stop": ("proph",),
+              "int_num_with": ("intervention",),
+              "int_start": ("intervention",),
+              "int_stop": ("intervention",),
+              }
+
+#labels of each named axis
+def get_axis_labels(inputs):
+    return {"ss": SS_STRS,
+            "si": SI_STRS,
+            "gender": GENDER_STRS,
+            "age_bracket": AGE_BRACKET_STRS,
+            "death_cause": DTH_NAMES,
+            "event": inputs.sim.event_names,
+            "intervention": inputs.intervention.int_names,
+            "proph": inputs.prophs.proph_names,
+            "screen_truth": ("Negative", "Positive"),
+            "screen_result": ("Negative", "Positive"),
+            }
+
+#arrays to store for a group of patient level outputs. Summary outputs store
+#their totals and nonzero counts without the patient axis and their
+#patient total stats as [count, mean, m2]. List outputs are stored as is
+def get_output_arrays(group, outputs, axes, arrays):
+    for varname in outputs.varnames:
+        value = outputs[varname]
+        names = axes.get(varname, ())
+        key = "{0}/{1}".format(group, varname)
+        if isinstance(value, OutputSummary):
+            arrays[key+".total"] = value.total
+            arrays[key+".nonzero"] = value.nonzero
+            arrays[key+".stats"] = np.array([value.count, value.mean_total, value.m2_total])
+            arrays["axes/"+key+".total"] = np.array(names, str)
+            arrays["axes/"+key+".nonzero"] = np.array(names, str)
+        elif isinstance(value, list):
+            #one entry per occurrence instead of per patient
+            arrays[key] = np.asarray(value, float)
+            arrays["axes/"+key] = np.array(("entry",), str)
+        else:
+            arrays[key] = value
+            arrays["axes/"+key] = np.array(("patient",)+names, str)
+
+#saves all outputs in a results store
+def write_results(filepath, out, dout, mout):
+    arrays = {}
+    get_output_arrays("outputs", out, OUTPUT_AXES, arrays)
+    get_output_arrays("disc", dout.disc, DISC_AXES, arrays)
+    get_output_arrays("undisc", dout.undisc, DISC_AXES, arrays)
+    for varname in mout.varnames:
+        arrays["monthly/"+varname] = mout[varname][:mout.num_months]
+        arrays["axes/monthly/"+varname] = np.array(("month",)+MONTH_AXES.get(varname, ()), str)
+    for axis, labels in get_axis_labels(out.inputs).items():
+        arrays["labels/"+axis] = np.array(labels, str)
+    arrays["info/num_patients"] = np.array(out.num_patients)
+    arrays["info/disc_rate"] = np.array(dout.disc.disc_rate)
+    with open(filepath, "wb") as f:
+        np.savez(f, **arrays)
+
+#reads the arrays of an uncompressed .npz. Arrays are memory mapped from the
+#file instead of read where possible
+def load_npz_mmap(filepath):
+    arrays = {}
+    with zipfile.ZipFile(filepath) as zf, open(filepath, "rb") as f:
+        for info in zf.infolist():
+            key = info.filename[:-len(".npy")]
+            if info.compress_type != zipfile.ZIP_STORED:
+                arrays[key] = np.lib.format.read_array(zf.open(info))
+                continue
+            #skip the local file header to the start of the .npy data
+            f.seek(info.header_offset+26)
+            name_len, extra_len = struct.unpack("<HH", f.read(4))
+            f.seek(info.header_offset+30+name_len+extra_len)
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+            if dtype.hasobject or not np.prod(shape, dtype=int) or not shape:
+                f.seek(info.header_offset+30+name_len+extra_len)
+                arrays[key] = np.lib.format.read_array(f)
+            else:
+                arrays[key] = np.memmap(filepath, dtype, "r", f.tell(), shape,
+                                        "F" if fortran_order else "C")
+    return arrays
+
+#results store read back from a file written by write_results
+class StoredResults(object):
+    def __init__(self, filepath):
+        self.arrays = load_npz_mmap(filepath)
+        self.num_patients = int(self.arrays["info/num_patients"])
+        self.disc_rate = float(self.arrays["info/disc_rate"])
+    #output array of a group
+    def get(self, group, varname):
+        return self.arrays["{0}/{1}".format(group, varname)]
+    #names of the axes of an output array
+    def get_axes(self, group, varname):
+        return tuple(self.arrays["axes/{0}/{1}".format(group, varname)].tolist())
+    #labels along each axis of an output array. Patient and month axes have none
+    def get_labels(self, group, varname):
+        return [tuple(self.arrays["labels/"+axis].tolist()) if "labels/"+axis in self.arrays else None
+                for axis in self.get_axes(group, varname)]
+    
+#saves a trace log with the labels needed to render it as an uncompressed .npz
+#that is memory mapped when read
+def write_trace_log(filepath, log, inputs):
+    arrays = {"records": log.get_records(), "index": log.get_index()}
+    for key, labels in get_trace_labels(inputs).items():
+        arrays["labels/"+key] = np.array(labels, str)
+    with open(filepath, "wb") as f:
+        np.savez(f, **arrays)
+
+#trace log read back from a file written by write_trace_log
+class StoredTrace(object):
+    def __init__(self, filepath):
+        arrays = load_npz_mmap(filepath)
+        self.records = arrays["records"]
+        self.index = {pid: (start, stop) for pid, start, stop in np.asarray(arrays["index"]).tolist()}
+        self.labels = {key[len("labels/"):]: arrays[key].tolist() for key in arrays if key.startswith("labels/")}
+    #pids in the trace, in order
+    def get_pids(self):
+        return sorted(self.index)
+    def get_records(self, pid):
+        start, stop = self.index[pid]
+        return self.records[start:stop]
+    #trace text of pids (all pids if None) or of the pids for which select(pid) is true
+    def render(self, pids = None, select = None):
+        if pids is None:
+            pids = self.get_pids()
+        return "".join([render_records(self.get_records(pid), self.labels) for pid in pids
+                        if pid in self.index and (select is None or select(pid))])
+    def write_text(self, filepath, pids = None, select = None):
+        with open(filepath, "w") as ftrace:
+            ftrace.write(self.render(pids, select))
+
 if __name__=="__main__":
     from inputs import *
     excelfile = "../Smoking Model Inputs.xlsm"
@@ -451,8 +822,8 @@ if __name__=="__main__":
     i.load_excel(excelfile)
     o = Outputs(1000, i)
     do = DiscOutputs(1000, i)
-    mo = MonthlyOutputs()
-    mo.add_month()
+    mo = MonthlyOutputs(i.sim.maxage*12+1)
+    mo.use_month(0)
     costs = do.disc.overall_costs
     write_output("test.smout",o, do, mo)
 
@@ -7,26 +7,48 @@ The patient object for smoking model
 from enums import *
 from inputs import *
 from outputs import *
-from math import exp
+from streams import *
+from tables import *
+from tracelog import *
+
+#windows of the event engine whose months are quiet with a lower mean prob are
+#run month by month, as sampling the wait would rarely skip a month. The patient
+#is then run month by month for at least MIN_STEPPED_MONTHS as their months are
+#likely to stay eventful
+MIN_QUIET_PROB = 0.5
+MIN_STEPPED_MONTHS = 12
 
 ######################################################################
 class Patient(object):
-    def __init__(self, pid,inputs, outputs, disc_outputs, monthly_outputs, traces = None):
+    #seed is the root seed of the run that the patient's random stream is spawned from
+    #trace_log is the TraceLog the patient records to if it is traced
+    def __init__(self, pid,inputs, outputs, disc_outputs, monthly_outputs, trace_log = None, seed = 0):
         self.inputs = inputs
         self.outputs = outputs
         self.disc_outputs = disc_outputs
         self.monthly_outputs = monthly_outputs
-        #current monthly output object
-        self.curr_mo= None
         self.pid = pid
-        self.traces = traces
-        self.trace_text = ""
+        self.trace_log = trace_log
+        #running disc lms, qalms and costs for the trace
+        self.trace_totals = None if trace_log is None else [0.0, 0.0, 0.0]
         #calendar month of run
         self.month = 0
         self.isalive = True
         self.causeofdeath = None
 
         self.update_qol = self.inputs.qol.enable_qol
+        self.tables = get_tables(inputs)
+
+        #random stream key and the draws for the current step
+        self.seed = seed
+        self.stream_key = patient_keys(seed, [pid])[0]
+        self.draws = None
+
+        #months the current step stands for and, when more than one, the discount
+        #factor of each of them and their total. See run_quiet_months
+        self.span = 1
+        self.span_disc = None
+        self.span_disc_total = None
 
         #month of next regular screening
         self.month_of_reg_screen = [None for i in range(NUM_EVENTS)]
@@ -34,8 +56,14 @@ class Patient(object):
         self.month_of_conf = [None for i in range(NUM_EVENTS)]
         self.is_detected_pevent = [False for i in range(NUM_EVENTS)]
         
-        #mortality risks
-        self.mort_risks = []
+        #mortality risks. Survival product and summed risk by cause
+        self.mort_nodeath = 1.0
+        self.mort_risks = np.zeros(len(DTH_CAUSES))
+
+        #bitmasks of the full events, interventions and prophs the patient has
+        self.event_mask = 0
+        self.int_mask = 0
+        self.proph_mask = 0
 
         #smoking
         self.ever_quit = False
@@ -57,6 +85,9 @@ class Patient(object):
         self.month_of_comp = [None for i in range(NUM_EVENTS)]
         
         self.init_patient()
+    #uniform draw for slot of the current step
+    def random(self, slot):
+        return self.draws[slot]
     #initialize patient
     def init_patient(self):
         init = self.inputs.init
@@ -64,22 +95,21 @@ class Patient(object):
         self.event_names = self.inputs.sim.event_names
         self.int_names = self.inputs.intervention.int_names
         self.proph_names = self.inputs.prophs.proph_names
-        self.death_names=["Nat Hist","Old Age", "Proph Tox", "Intervention Tox", "Confirmatory Test",]
-        self.death_names.extend(["{0}".format(self.event_names[event]) for event in range(NUM_EVENTS)])
-        self.death_names.extend(["{0} Complication".format(self.event_names[event]) for event in range(NUM_EVENTS)])
 
         self.disc_mult_month = pow(self.inputs.sim.disc_rate_year+1,1/12.0)
         self.disc_factor = 1.0
-        self.gender = draw_dist(init.sex_dist)
-        self.age = int(round(draw_trunc_norm(*init.age_dist)))
+        self.draws = keyed_uniforms(self.stream_key, 0, np.arange(NUM_SLOTS)).tolist()
+        self.gender = self.tables.gender.draw(self.random(SLOT_INIT_GENDER))
+        self.age = int(round(self.tables.age.draw(self.random(SLOT_INIT_AGE))))
         self.agecat = get_age_cat(AGE_BRACKETS, self.age)
-        self.ss = draw_dist(init.ss[self.gender,:,self.agecat])
-        self.si = draw_dist(init.si[self.gender,:,self.agecat])
+        self.ss = self.tables.ss.draw(self.random(SLOT_INIT_SS), self.gender, self.agecat)
+        self.si = self.tables.si.draw(self.random(SLOT_INIT_SI), self.gender, self.agecat)
 
         #roll for time since quit
         self.month_of_quit = None
         if self.ss == SS_FORMER:
-            self.month_of_quit = -1*int(round(draw_trunc_norm(*(init.quit_dist),low=0,high=self.age)))
+            self.month_of_quit = -1*int(round(self.tables.quit_time.draw(self.random(SLOT_INIT_QUIT),
+                                                                            high=self.age)))
             self.agequit = self.age - (self.month - self.month_of_quit)
             self.agequit_cat = get_age_cat(AGE_BRACKETS, self.agequit)
 
@@ -87,7 +117,7 @@ class Patient(object):
         #draw event prev
         for event in range(NUM_EVENTS):
             prob = init.event_prev[event,self.gender,self.ss,self.si,self.agecat]
-            if random() <= prob:
+            if self.random(SLOT_INIT_EVENT+event) <= prob:
                 self.get_event(event, True)
 
         #roll for start proph at init
@@ -95,11 +125,10 @@ class Patient(object):
         for i in range(NUM_PROPHS):
             prob_proph = prophs.start_prob_init[self.si,self.gender,i]
             prob_proph *= prophs.start_age_mult[self.gender, i, self.agecat]
-            evts = [j for j in range(NUM_EVENTS) if self.events[j] == EVT_FULL]
-            prob_proph *= prophs.event_hist_mult[self.gender, i, evts].prod()
+            prob_proph *= self.tables.proph_event_hist_prod[self.gender, i, self.event_mask]
             prob_proph *= prophs.ss_mult[self.gender, i, self.ss]
                 
-            if random() <= prob_proph:
+            if self.random(SLOT_INIT_PROPH+i) <= prob_proph:
                 self.start_proph(i, True)
 
         #roll for start intervention at init
@@ -107,12 +136,9 @@ class Patient(object):
         for i in range(NUM_INTERVENTIONS):
             prob_int = intv.start_prob_init[self.si,self.gender,i]
             prob_int *= intv.start_age_mult[self.gender, i, self.agecat]
-            evts = [j for j in range(NUM_EVENTS) if self.events[j] == EVT_FULL]
-            mults = intv.event_hist_mult[self.gender, i, evts]
-            if mults.size:
-                prob_int *= mults.max()
+            prob_int *= self.tables.int_event_hist_max[self.gender, i, self.event_mask]
             
-            if random() <= prob_int:
+            if self.random(SLOT_INIT_INT+i) <= prob_int:
                 self.start_intervention(i, True)
 
         #set next regular screening month
@@ -127,31 +153,25 @@ class Patient(object):
         self.add_out("init_dist_gender",(self.gender,),1)
         self.add_out("init_age",None, self.age)
 
-        #prints to trace file if it exists
-        if self.traces is not None:
-            self.trace("\n\nBEGIN PATIENT {0}".format(self.pid), False)
-            self.trace("\n\tgender: {0}, init age: {1} mths".format(GENDER_STRS[self.gender], self.age), False)
-            self.trace("\n\tsmoking status: {0}, smoking intensity: {1}".format(SS_STRS[self.ss],SI_STRS[self.si]), False)
+        #records to the trace log if the patient is traced
+        if self.trace_log is not None:
+            self.trace(TRC_BEGIN, self.gender, self.age)
+            self.trace(TRC_INIT_SMOKING, self.ss, self.si)
             if self.ss == SS_FORMER:
-                self.trace("\n\tmonth of quit: {0}".format(self.month_of_quit))
-            self.trace("\n\tevents: {0}".format(",".join(
-                [self.event_names[event] for event in range(NUM_EVENTS) if self.events[event]==EVT_FULL])), False)
-            self.trace("\n\tinterventions: {0}".format(",".join(
-                [self.int_names[intv] for intv in range(NUM_INTERVENTIONS) if self.has_int[intv]])), False)
-            self.trace("\n\tprophs: {0}".format(",".join(
-                [self.proph_names[proph] for proph in range(NUM_PROPHS) if self.has_proph[proph]])), False)
+                self.trace(TRC_INIT_QUIT, 0, self.month_of_quit)
+            self.trace(TRC_INIT_EVENTS, 0, self.event_mask)
+            self.trace(TRC_INIT_INTS, 0, self.int_mask)
+            self.trace(TRC_INIT_PROPHS, 0, self.proph_mask)
     def update_start_month(self):
         #clear mortality risks
-        self.mort_risks = []
+        self.mort_nodeath = 1.0
+        self.mort_risks.fill(0.0)
         #calculate age_category
         self.agecat = get_age_cat(AGE_BRACKETS, self.age)
         self.qol = 1.0
 
         #add month for output
-        try:
-            self.curr_mo = self.monthly_outputs[self.month]
-        except IndexError:
-            self.curr_mo = self.monthly_outputs.add_month()
+        self.monthly_outputs.use_month(self.month+self.span-1)
         
     def update_interventions(self):
         if self.ss == SS_NEVER:
@@ -180,7 +200,7 @@ class Patient(object):
 
                 if not stop_int:
                     prob_stop = intv.stop_prob_month[self.si, self.gender, i]        
-                    if random() <= prob_stop:
+                    if self.random(SLOT_INT_STOP+i) <= prob_stop:
                         stop_int = True
 
                 if stop_int:
@@ -188,17 +208,11 @@ class Patient(object):
             #check for int start
             if self.ss==SS_CURRENT and not self.has_int[i]:
                 if not self.has_int_tox_hist[i] or intv.allow_restart_on_tox[i]:
-                    prob_start = intv.start_prob_month[self.si, self.gender, i]
-                    prob_start *= intv.start_age_mult[self.gender, i, self.agecat]
-                    evts = [j for j in range(NUM_EVENTS) if self.events[j] == EVT_FULL]
-                    mults = intv.event_hist_mult[self.gender, i, evts]
-                    if mults.size:
-                        prob_start *= mults.max()                    
-                    if random() <= prob_start:
+                    if self.random(SLOT_INT_START+i) <= self.get_prob_int_start(i):
                         self.start_intervention(i)
 
             #toxicity
-            if self.has_int[i] and random() <= intv.tox_prob[i]:
+            if self.has_int[i] and self.random(SLOT_INT_TOX+i) <= intv.tox_prob[i]:
                 self.set_int_tox(i)
                 #add tox death prob
                 self.add_mort_risk(DTH_TOX_INT,intv.tox_dth_prob[i])
@@ -210,10 +224,8 @@ class Patient(object):
         #updater for starting smoking
         if self.ss != SS_NEVER:
             return
-        ageyrs = self.age // 12
-        probstart = self.inputs.smoking.start_prob[self.gender,ageyrs]
         #roll for start
-        if random() <= probstart:
+        if self.random(SLOT_SMOKE_START) <= self.get_prob_smoke_start():
             self.start_smoking()
 
     def update_smoke_quit(self):
@@ -221,49 +233,15 @@ class Patient(object):
         if self.ss != SS_CURRENT:
             return
 
-        smoking = self.inputs.smoking
-        ageyrs = self.age // 12
-
-
-        evts = [i for i in range(NUM_EVENTS) if self.events[i] == EVT_FULL and
-                self.month - self.month_of_event[i]<=smoking.event_quit_duration[i]]
-        comps = [i for i in range(NUM_EVENTS) if self.month_of_comp[i] is not None and
-                self.month - self.month_of_comp[i]<=smoking.comp_quit_duration[i]]
-
-        probs = np.concatenate((smoking.event_quit_prob[evts],smoking.comp_quit_prob[comps]))
-        if probs.size:
-            probquit= max(probs)
-        else:
-            probquit = smoking.quit_prob[self.gender, ageyrs]
-
-        int_mults = self.inputs.intervention.quit_mult[self.has_int]
-
-
-        if int_mults.size:
-            probquit *= int_mults.max()
-
-        if random() <= probquit:
+        if self.random(SLOT_SMOKE_QUIT) <= self.get_prob_quit():
             self.quit_smoking()
     
     def update_smoke_relapse(self):
         #updater for smoking relapse
         if self.ss != SS_FORMER:
             return
-        smoking = self.inputs.smoking
-
-        time_since_quit = self.month - self.month_of_quit
-        c,b = smoking.relapse_coeffs[self.si, self.agecat]
-        if time_since_quit==0:
-            probrelapse = 0
-        else:
-            probrelapse = c*exp(b*time_since_quit)
-
-        int_mults = self.inputs.intervention.relapse_mult[self.has_int]
-
-        if int_mults.size:
-            probrelapse *= int_mults.max()
 
-        if random() <= probrelapse:
+        if self.random(SLOT_SMOKE_RELAPSE) <= self.get_prob_relapse():
             self.relapse_smoking()
             
     def update_prophs(self):
@@ -275,24 +253,17 @@ class Patient(object):
                 
                 #Check for proph stop
                 prob_stop = prophs.stop_prob_month[self.si, self.gender, i]        
-                if random() <= prob_stop:
+                if self.random(SLOT_PROPH_STOP+i) <= prob_stop:
                     self.stop_proph(i)
 
             #check for proph start
             if not self.has_proph[i]:
                 if not self.has_proph_tox_hist[i] or prophs.allow_restart_on_tox[i]:
-                    prob_start = prophs.start_prob_month[self.si, self.gender, i]
-                    prob_start *= prophs.start_age_mult[self.gender, i, self.agecat]
-                    evts = [j for j in range(NUM_EVENTS) if self.events[j] == EVT_FULL]
-                    mults = prophs.event_hist_mult[self.gender, i, evts]
-                    if mults.size:
-                        prob_start *= mults.max()
-                    prob_start *= prophs.ss_mult[self.gender, i, self.ss]
-                    if random() <= prob_start:
+                    if self.random(SLOT_PROPH_START+i) <= self.get_prob_proph_start(i):
                         self.start_proph(i)
 
             #toxicity
-            if self.has_proph[i] and random() <= prophs.tox_prob[i]:
+            if self.has_proph[i] and self.random(SLOT_PROPH_TOX+i) <= prophs.tox_prob[i]:
                 self.set_proph_tox(i)
                 #add tox death prob
                 self.add_mort_risk(DTH_TOX_PROPH,prophs.tox_dth_prob[i])
@@ -302,33 +273,12 @@ class Patient(object):
                 
     def update_pre_events(self):
         #roll for incidence of pre-events
-        pevt = self.inputs.pre_events
-        agecat = self.agecat
-        
         for event in range(NUM_EVENTS):
             if self.events[event] != EVT_NONE:
                 continue
             
-            prob_event = pevt.pevent_inc_baseline[self.gender,event,agecat]
-            cs_mult = pevt.pevent_inc_mult_curr[event,self.si]
-            
-            if self.ss == SS_CURRENT:
-                prob_event *= cs_mult
-            elif self.ss == SS_FORMER:
-                trans = pevt.pevent_inc_trans[event]
-                time_since_quit = self.month - self.month_of_quit
-                xs_mult = pevt.pevent_inc_mult_ex[self.si,event,self.agequit_cat]
-                #ex smokers
-                if time_since_quit >= trans[1]:
-                    prob_event *= xs_mult
-                #current smokers
-                elif time_since_quit <= trans[0]:
-                    prob_event *= cs_mult
-                #stopped smokers                    
-                else:
-                    prob_event *= np.interp(time_since_quit, trans, [cs_mult, xs_mult])
             #roll for pre-event
-            if random() <= prob_event:
+            if self.random(SLOT_PEVENT_INC+event) <= self.get_prob_pevent(event):
                 self.get_pevent(event)
 
         for event in range(NUM_EVENTS):
@@ -349,7 +299,7 @@ class Patient(object):
 
                 if month_of_screen is not None and self.month >= month_of_screen:
                     #roll for prob attend
-                    if random() > pevt.screening_regular_prob_skip[event]:
+                    if self.random(SLOT_SCREEN_ATTEND+event) > pevt.screening_regular_prob_skip[event]:
                         self.screen(SCREEN_REG, event)
                         self.num_reg_screens[event]+=1
                         has_reg_screen = True
@@ -362,7 +312,7 @@ class Patient(object):
                     self.month_of_reg_screen[event] = next_screen
 
                 #roll for background screening
-                if not has_reg_screen and random() <= pevt.screening_background_prob[self.gender,event,self.agecat]:
+                if not has_reg_screen and self.random(SLOT_SCREEN_BACK+event) <= pevt.screening_background_prob[self.gender,event,self.agecat]:
                     self.screen(SCREEN_BACK, event)
 
 
@@ -391,45 +341,17 @@ class Patient(object):
         #updater for events
         inp = self.inputs.events
         agecat = self.agecat
-        prophs = [i for i in range(NUM_PROPHS) if self.has_proph[i]]
 
         #for those who have event
         for event in range(NUM_EVENTS):
             if self.events[event] != EVT_FULL:
                 continue
             
-            #add monthly cost of event:
-            self.add_cost("cost_event",event, self.inputs.costs.event_month[event], True)
-
-            #add qol
-            if self.update_qol:
-                self.add_qol(self.inputs.qol.event_month[event])
+            #add monthly cost and qol of event
+            self.add_event_month(event)
                 
-            #roll for event complications
-            prob_comp = inp.event_comp_baseline[self.gender, event, agecat]
-            cs_mult = inp.event_comp_mult_curr[event, self.si]
-            
-            if self.ss == SS_CURRENT:
-                prob_comp *= cs_mult
-            elif self.ss == SS_FORMER:
-                trans = inp.event_comp_trans[event]
-                time_since_quit = self.month - self.month_of_quit
-                xs_mult = inp.event_comp_mult_ex[self.si, event, self.agequit_cat]
-                #ex smokers
-                if time_since_quit >= trans[1]:
-                    prob_comp *= xs_mult
-                #current smokers
-                elif time_since_quit <= trans[0]:
-                    prob_comp *= cs_mult
-                #stopped smokers
-                else:
-                    prob_comp *= np.interp(time_since_quit, trans, [cs_mult, xs_mult])
-                    
-            #modify by proph
-            prob_comp *= self.inputs.prophs.eff_comp[prophs,event].prod()
-            
             #roll for complication
-            if random() <= prob_comp:
+            if self.random(SLOT_EVENT_COMP+event) <= self.get_prob_comp(event):
                 self.get_event_comp(event)
                 #roll for complication death
                 prob_death = inp.event_comp_prob_death[event]
@@ -442,7 +364,7 @@ class Patient(object):
                 #modify by detected status
                 if self.is_detected_pevent[event]:
                     prob_event*=self.inputs.pre_events.screening_outcome_event_mult[event]
-                if random() <= prob_event:
+                if self.random(SLOT_PEVENT_TO_EVENT+event) <= prob_event:
                     self.get_event(event)
                     
         #roll for incidence of event
@@ -450,53 +372,105 @@ class Patient(object):
             if self.events[event] != EVT_NONE:
                 continue
             
-            prob_event = inp.event_inc_baseline[self.gender,event,agecat]
-            cs_mult = inp.event_inc_mult_curr[event,self.si]
-            
-            if self.ss == SS_CURRENT:
-                prob_event *= cs_mult
-            elif self.ss == SS_FORMER:
-                trans = inp.event_inc_trans[event]
-                time_since_quit = self.month - self.month_of_quit
-                xs_mult = inp.event_inc_mult_ex[self.si,event,self.agequit_cat]
-                #ex smokers
-                if time_since_quit >= trans[1]:
-                    prob_event *= xs_mult
-                #current smokers
-                elif time_since_quit <= trans[0]:
-                    prob_event *= cs_mult
-                #stopped smokers                    
-                else:
-                    prob_event *= np.interp(time_since_quit, trans, [cs_mult, xs_mult])
-
-            #modify by proph
-            prob_event *= self.inputs.prophs.eff_events[prophs,event].prod()
-
             #roll for event
-            if random() <= prob_event:
+            if self.random(SLOT_EVENT_INC+event) <= self.get_prob_event(event):
                 self.get_event(event)
                 #roll for event death
                 prob_death = inp.event_prob_death[event]
                 self.add_mort_risk(globals()["DTH_EVENT_{0}".format(event)],prob_death)
 
     def update_nathist(self):
-        nh = self.inputs.nathist
-        ageyrs = self.age//12
-        agecat = self.agecat
-        
         #accumulate pre-event multiplier
         pevent_mult = 1
         for event in range(NUM_EVENTS):
             if self.events[event] == EVT_PRE:
-                pevent_mult *= self.inputs.pre_events.pevent_mort_mult[self.gender,event, agecat]
+                pevent_mult *= self.inputs.pre_events.pevent_mort_mult[self.gender,event, self.agecat]
                 if self.is_detected_pevent[event]:
                     pevent_mult *= self.inputs.pre_events.screening_outcome_pevent_mort_mult[event]
 
+        self.add_mort_risk(DTH_NAT_HIST, self.get_nathist_mort(), pevent_mult)
+
+    #probabilities of the monthly rolls. months is how many months past the current
+    #month to evaluate at and may be an array for the probs that depend on months since quit
+    def get_time_since_quit(self, months = 0):
+        return self.month + months - self.month_of_quit
+    def get_prob_int_start(self, intv):
+        inp = self.inputs.intervention
+        prob_start = inp.start_prob_month[self.si, self.gender, intv]
+        prob_start *= inp.start_age_mult[self.gender, intv, self.agecat]
+        prob_start *= self.tables.int_event_hist_max[self.gender, intv, self.event_mask]
+        return prob_start
+    def get_prob_smoke_start(self):
+        return self.inputs.smoking.start_prob[self.gender, self.age//12]
+    def get_prob_quit(self):
+        smoking = self.inputs.smoking
+        ageyrs = self.age // 12
+
+        evts = [i for i in range(NUM_EVENTS) if self.events[i] == EVT_FULL and
+                self.month - self.month_of_event[i]<=smoking.event_quit_duration[i]]
+        comps = [i for i in range(NUM_EVENTS) if self.month_of_comp[i] is not None and
+                self.month - self.month_of_comp[i]<=smoking.comp_quit_duration[i]]
+
+        probs = np.concatenate((smoking.event_quit_prob[evts],smoking.comp_quit_prob[comps]))
+        if probs.size:
+            probquit= max(probs)
+        else:
+            probquit = smoking.quit_prob[self.gender, ageyrs]
+
+        probquit *= self.tables.int_quit_max[self.int_mask]
+        return probquit
+    def get_prob_relapse(self, months = 0):
+        probrelapse = self.tables.relapse.lookup(self.get_time_since_quit(months), self.si, self.agecat)
+        probrelapse *= self.tables.int_relapse_max[self.int_mask]
+        return probrelapse
+    def get_prob_proph_start(self, proph):
+        prophs = self.inputs.prophs
+        prob_start = prophs.start_prob_month[self.si, self.gender, proph]
+        prob_start *= prophs.start_age_mult[self.gender, proph, self.agecat]
+        prob_start *= self.tables.proph_event_hist_max[self.gender, proph, self.event_mask]
+        prob_start *= prophs.ss_mult[self.gender, proph, self.ss]
+        return prob_start
+    def get_prob_pevent(self, event, months = 0):
+        pevt = self.inputs.pre_events
+        prob_event = pevt.pevent_inc_baseline[self.gender,event,self.agecat]
+        if self.ss == SS_CURRENT:
+            prob_event *= pevt.pevent_inc_mult_curr[event,self.si]
+        elif self.ss == SS_FORMER:
+            prob_event *= self.tables.pevent_inc_quit.lookup(self.get_time_since_quit(months),
+                                                             event, self.si, self.agequit_cat)
+        return prob_event
+    def get_prob_comp(self, event, months = 0):
+        inp = self.inputs.events
+        prob_comp = inp.event_comp_baseline[self.gender, event, self.agecat]
+        if self.ss == SS_CURRENT:
+            prob_comp *= inp.event_comp_mult_curr[event, self.si]
+        elif self.ss == SS_FORMER:
+            prob_comp *= self.tables.event_comp_quit.lookup(self.get_time_since_quit(months),
+                                                            event, self.si, self.agequit_cat)
+        #modify by proph
+        prob_comp *= self.tables.proph_eff_comp_prod[event, self.proph_mask]
+        return prob_comp
+    def get_prob_event(self, event, months = 0):
+        inp = self.inputs.events
+        prob_event = inp.event_inc_baseline[self.gender,event,self.agecat]
+        if self.ss == SS_CURRENT:
+            prob_event *= inp.event_inc_mult_curr[event,self.si]
+        elif self.ss == SS_FORMER:
+            prob_event *= self.tables.event_inc_quit.lookup(self.get_time_since_quit(months),
+                                                            event, self.si, self.agequit_cat)
+        #modify by proph
+        prob_event *= self.tables.proph_eff_events_prod[event, self.proph_mask]
+        return prob_event
+    #natural history mortality before the pre-event multiplier
+    def get_nathist_mort(self, months = 0):
+        nh = self.inputs.nathist
+        ageyrs = self.age//12
+        agecat = self.agecat
+
         ns_mort = nh.ns_lifetable[self.gender,ageyrs]
         #never smokers
         if (self.ss == SS_NEVER):
-            self.add_mort_risk(DTH_NAT_HIST,ns_mort,pevent_mult)
-            return
+            return ns_mort
         
         #current smokers
         if nh.cs_mort_usemult:
@@ -505,12 +479,10 @@ class Patient(object):
             cs_mort = nh.cs_lifetable[self.si,self.gender,ageyrs]
 
         if (self.ss == SS_CURRENT):
-            self.add_mort_risk(DTH_NAT_HIST,cs_mort, pevent_mult)
-            return
+            return cs_mort
                 
         #former smokers
-        time_since_quit = self.month - self.month_of_quit
-        trans = nh.trans
+        time_since_quit = self.get_time_since_quit(months)
         #ex smokers
         if nh.xs_mort_usemult:
             xs_mort = ns_mort * nh.xs_mort_mult[self.si,self.gender,agecat]
@@ -518,25 +490,35 @@ class Patient(object):
             age_at_quit = self.age - time_since_quit
             xs_mort = nh.xs_agequit_mult[self.si,self.gender,agecat]*nh.xs_lifetable[self.si,self.gender,ageyrs]
 
-        #ex smokers
-        if time_since_quit >= trans[1]:
-            self.add_mort_risk(DTH_NAT_HIST, xs_mort, pevent_mult)
-        #current smokers
-        elif time_since_quit <= trans[0]:
-            self.add_mort_risk(DTH_NAT_HIST, cs_mort, pevent_mult)
-        #stopped smokers
-        else:
-            self.add_mort_risk(DTH_NAT_HIST,np.interp(time_since_quit, trans, [cs_mort, xs_mort]), pevent_mult)
+        #moves from current to ex smoker mortality over the transition
+        weight = self.tables.nathist_quit_weight.lookup(time_since_quit)
+        return (1-weight)*cs_mort + weight*xs_mort
 
     def update_mort(self):
         #roll for death
-        causes, risks = list(zip(*self.mort_risks))
-        prob_nodeath = np.prod([1-p for p in risks])
-        if random() > prob_nodeath:
-            #roll for cause of death
-            cause = causes[draw_dist(risks)]
-            self.kill_patient(cause)
+        if self.random(SLOT_DEATH) > self.mort_nodeath:
+            #roll for cause of death in DTH_CAUSES order
+            self.kill_patient(draw_dist(self.mort_risks, self.random(SLOT_DEATH_CAUSE)))
     def update_end_month(self):
+        self.add_end_month()
+
+        #kill patient if max age reached
+        if self.isalive and self.age / 12 >= self.inputs.sim.maxage:
+            self.kill_patient(DTH_OLD_AGE)
+
+        if self.isalive:
+            self.add_month_out('num_alive',(self.ss,self.si), 1)
+        else:
+            self.add_month_out('num_deaths',(self.ss,self.si), 1)
+        #advance age
+        if self.isalive:
+            self.month+=1
+            self.age+=1
+
+            #update disc factor
+            self.disc_factor*=1/self.disc_mult_month
+    #background costs, qol and outputs of every month the patient starts alive
+    def add_end_month(self):
         qol = self.inputs.qol
         
         #add costs for background care
@@ -581,22 +563,6 @@ class Patient(object):
             else:
                 self.add_month_out('event_num_without',event,1)
 
-        #kill patient if max age reached
-        if self.isalive and self.age / 12 >= self.inputs.sim.maxage:
-            self.kill_patient(DTH_OLD_AGE)
-
-        if self.isalive:
-            self.add_month_out('num_alive',(self.ss,self.si), 1)
-        else:
-            self.add_month_out('num_deaths',(self.ss,self.si), 1)
-        #advance age
-        if self.isalive:
-            self.month+=1
-            self.age+=1
-
-            #update disc factor
-            self.disc_factor*=1/self.disc_mult_month
-
     def screen(self, testtype, event):
         #screen for pre events handles intial screen and schedules conf test
         pevt = self.inputs.pre_events
@@ -614,18 +580,16 @@ class Patient(object):
         else:
             rate = pevt.screening_specificity
             
-        if random() <= rate[self.gender, event]:
+        if self.random(SLOT_SCREEN_RESULT+event) <= rate[self.gender, event]:
             result = true_status
         else:
             result = not true_status
 
         self.add_month_out("pevent_screen_results", (event,int(true_status),int(result)),1)
 
-        #prints to trace file if it exists
-        if self.traces is not None:
-            self.trace("\n**{0} Pre-event {1} Screening, Result: {2},Status: {2}".format(self.month,
-                                                                                       self.event_names[event],
-                                                                                       result, true_status))
+        #records to the trace log if the patient is traced
+        if self.trace_log is not None:
+            self.trace(TRC_SCREEN, event, result)
         #schedule conf test
         if result:
             self.schedule_conf_test(event, self.month+pevt.screening_conf_delay[event])
@@ -651,14 +615,14 @@ class Patient(object):
         self.add_mort_risk(DTH_CONF_TEST,pevt.screening_conf_mort[event])
 
 
-        #prints to trace file if it exists
-        if self.traces is not None:
-            self.trace("\n**{0} Pre-event {1} Confirmatory Test".format(self.month,self.event_names[event]))
+        #records to the trace log if the patient is traced
+        if self.trace_log is not None:
+            self.trace(TRC_CONF_TEST, event)
         #change outcomes for true positives
         if self.events[event] == EVT_PRE:
             self.is_detected_pevent[event] = True
             #roll for revert to neutral
-            if random() <= pevt.screening_outcome_neutral[event]:
+            if self.random(SLOT_CONF_NEUTRAL+event) <= pevt.screening_outcome_neutral[event]:
                 self.cure_pevent(event)
             #start proph if set
             if pevt.screening_outcome_proph[event]:
@@ -671,10 +635,12 @@ class Patient(object):
             
     #add a mortality risk for that month
     def add_mort_risk(self, cause, prob, mult = 1):
-        self.mort_risks.append((cause, prob*mult))
-    #adds value to output
+        risk = prob*mult
+        self.mort_nodeath *= 1-risk
+        self.mort_risks[cause] += risk
+    #adds value to output, once for each month of the span
     def add_out(self, name, index, value, add_month = False):
-        self.outputs.add_value(name, self.pid,index,value)
+        self.outputs.add_value(name, self.pid,index,value*self.span)
 
         #if true add to same name category in monthly costs
         if add_month:
@@ -683,15 +649,40 @@ class Patient(object):
     def add_list_out(self, name,value):
         self.outputs.add_list_value(name,value)
     def add_disc_out(self, name, index, value):
+        self.add_disc_value(name, index, value)
+        if self.trace_totals is not None:
+            if name == "lms":
+                self.trace_totals[0] += value*self.get_disc_total()
+            elif name == "qalms":
+                self.trace_totals[1] += value*self.get_disc_total()
+    #adds value to the undiscounted and discounted output name for each month of the span
+    def add_disc_value(self, name, index, value):
         out = self.disc_outputs
-        out.add_value(name,self.pid,index, value, self.disc_factor)
+        if self.span_disc is None:
+            out.add_value(name,self.pid,index, value, self.disc_factor)
+        else:
+            out.undisc.add_value(name, self.pid, index, value*self.span)
+            out.disc.add_value(name, self.pid, index, value*self.span_disc_total)
+    #total discount factor of the months of the span
+    def get_disc_total(self):
+        if self.span_disc is None:
+            return self.disc_factor
+        return self.span_disc_total
+    #adds value to monthly output name for the month or each month of the span
     def add_month_out(self, name, index, value):
-        self.curr_mo.add_value(name, index, value)
+        if self.span_disc is None:
+            self.monthly_outputs.add_value(name, self.month, index, value)
+        else:
+            self.monthly_outputs.add_value(name, slice(self.month, self.month+self.span), index, value)
     def add_cost(self, name, index, value, add_month = False):
-        out = self.disc_outputs
-        disc_value = value*self.disc_factor
-        out.add_value("overall_costs",self.pid,(self.ss, self.agecat, self.gender), value, self.disc_factor)
-        out.add_value(name,self.pid,index, value, self.disc_factor)
+        if self.span_disc is None:
+            disc_value = value*self.disc_factor
+        else:
+            disc_value = value*self.span_disc
+        self.add_disc_value("overall_costs",(self.ss, self.agecat, self.gender), value)
+        self.add_disc_value(name,index, value)
+        if self.trace_totals is not None:
+            self.trace_totals[2] += value*self.get_disc_total()
 
         self.add_month_out("costs_disc", None, disc_value)
 
@@ -703,6 +694,11 @@ class Patient(object):
         
     def add_qol(self, qol_mult):
         self.qol*=qol_mult
+    #monthly cost and qol of having event
+    def add_event_month(self, event):
+        self.add_cost("cost_event",event, self.inputs.costs.event_month[event], True)
+        if self.update_qol:
+            self.add_qol(self.inputs.qol.event_month[event])
     def set_proph_tox(self, proph):
         self.has_proph_tox_hist[proph] = True
         #add qol
@@ -711,9 +707,9 @@ class Patient(object):
         #add output
         self.add_out("proph_num_tox",proph,1)
 
-        #prints to trace file if it exists
-        if self.traces is not None:
-            self.trace("\n**{0} Toxicity Proph: {1} ".format(self.month,self.proph_names[proph]))
+        #records to the trace log if the patient is traced
+        if self.trace_log is not None:
+            self.trace(TRC_PROPH_TOX, proph)
     def set_int_tox(self, intv):
         self.has_int_tox_hist[intv] = True
         #add qol
@@ -723,43 +719,47 @@ class Patient(object):
         #add output
         self.add_out("int_num_tox",intv,1)
 
-        #prints to trace file if it exists
-        if self.traces is not None:
-            self.trace("\n**{0} Toxicity Intervention: {1} ".format(self.month,self.int_names[intv]))
+        #records to the trace log if the patient is traced
+        if self.trace_log is not None:
+            self.trace(TRC_INT_TOX, intv)
     def schedule_conf_test(self, event, month_of_test):
         self.month_of_conf[event] = month_of_test
 
     def stop_proph(self, proph):
         self.has_proph[proph] = False
+        self.proph_mask &= ~(1 << proph)
         #add output
         self.add_month_out("proph_stop",proph,1)
 
-        #prints to trace file if it exists
-        if self.traces is not None:
-            self.trace("\n**{0} Stopping Proph: {1}".format(self.month, self.proph_names[proph]))
+        #records to the trace log if the patient is traced
+        if self.trace_log is not None:
+            self.trace(TRC_PROPH_STOP, proph)
     def start_proph(self, proph, is_init = False):
         self.has_proph[proph] = True
+        self.proph_mask |= 1 << proph
         #add cost
         if not is_init:
             self.add_cost("cost_proph",(proph,),self.inputs.costs.proph_init[proph], True)
             #add output
             self.add_month_out("proph_start",proph,1)
 
-            #prints to trace file if it exists
-            if self.traces is not None:
-                self.trace("\n**{0} Starting Proph: {1}".format(self.month, self.proph_names[proph]))
+            #records to the trace log if the patient is traced
+            if self.trace_log is not None:
+                self.trace(TRC_PROPH_START, proph)
     def stop_intervention(self, intv):
         self.has_int[intv] = False
+        self.int_mask &= ~(1 << intv)
 
         #add output
         self.add_month_out("int_stop",intv,1)
 
-        #prints to trace file if it exists
-        if self.traces is not None:
-            self.trace("\n**{0} Stopping Intervention: {1}".format(self.month, self.int_names[intv]))
+        #records to the trace log if the patient is traced
+        if self.trace_log is not None:
+            self.trace(TRC_INT_STOP, intv)
     def start_intervention(self, intv, is_init = False):
         self.month_start_int[intv] = self.month
         self.has_int[intv] = True
+        self.int_mask |= 1 << intv
         self.ever_start_any_int = True
         #add cost
         if not is_init:
@@ -768,9 +768,9 @@ class Patient(object):
             self.add_out("int_start",intv,1)
             self.add_month_out("int_start",intv,1)
 
-            #prints to trace file if it exists
-            if self.traces is not None:
-                self.trace("\n**{0} Starting Intervention: {1}".format(self.month, self.int_names[intv]))
+            #records to the trace log if the patient is traced
+            if self.trace_log is not None:
+                self.trace(TRC_INT_START, intv)
     def start_smoking(self):
         if self.ss ==SS_FORMER:
             self.add_list_out("quit_duration",self.month - self.month_of_quit)
@@ -779,9 +779,9 @@ class Patient(object):
         #add output
         self.add_out("smoking_start",None,1, True)
         
-        #prints to trace file if it exists
-        if self.traces is not None:
-            self.trace("\n**{0} Smoking Start".format(self.month))
+        #records to the trace log if the patient is traced
+        if self.trace_log is not None:
+            self.trace(TRC_SMOKE_START)
     def quit_smoking(self):
         self.ss = SS_FORMER
         self.ever_quit= True
@@ -789,9 +789,9 @@ class Patient(object):
         self.agequit = self.age
         self.agequit_cat = get_age_cat(AGE_BRACKETS, self.agequit)
 
-        #prints to trace file if it exists
-        if self.traces is not None:
-            self.trace("\n**{0} Smoking Quit".format(self.month))
+        #records to the trace log if the patient is traced
+        if self.trace_log is not None:
+            self.trace(TRC_SMOKE_QUIT)
 
         #check to see if should stop intervention
         for i in range(NUM_INTERVENTIONS):
@@ -806,11 +806,12 @@ class Patient(object):
         self.ever_relapse = True
         #add output
         self.add_out("smoking_relapse",(self.agecat,self.gender),1, True)
-        #prints to trace file if it exists
-        if self.traces is not None:
-            self.trace("\n**{0} Smoking Relapse".format(self.month))
+        #records to the trace log if the patient is traced
+        if self.trace_log is not None:
+            self.trace(TRC_SMOKE_RELAPSE)
     def get_event(self, event, is_prev=False):
         self.events[event] = EVT_FULL
+        self.event_mask |= 1 << event
         self.month_of_event[event] = self.month
         #add cost
         if not is_prev:
@@ -819,9 +820,9 @@ class Patient(object):
             if self.update_qol:
                 self.add_qol(self.inputs.qol.event_init[event])
 
-            #prints to trace file if it exists
-            if self.traces is not None:
-                self.trace("\n**{0} Event {1}".format(self.month, self.event_names[event]))
+            #records to the trace log if the patient is traced
+            if self.trace_log is not None:
+                self.trace(TRC_EVENT, event)
 
         #add output
         if is_prev:
@@ -835,20 +836,22 @@ class Patient(object):
         
     def cure_pevent(self, event):
         self.events[event] = EVT_NONE
+        self.event_mask &= ~(1 << event)
         self.is_detected_pevent[event] = False
-        #prints to trace file if it exists
-        if self.traces is not None:
-            self.trace("\n**{0} Pre-event {1} Cured".format(self.month,self.event_names[event]))
+        #records to the trace log if the patient is traced
+        if self.trace_log is not None:
+            self.trace(TRC_PEVENT_CURED, event)
     def get_pevent(self, event):
         self.events[event] = EVT_PRE
+        self.event_mask &= ~(1 << event)
 
         #add output
         self.add_out("pevent_num_inc", event,1)
         self.add_month_out('pevent_inc',(event, self.ss, self.agecat, self.gender),1)
 
-        #prints to trace file if it exists
-        if self.traces is not None:
-            self.trace("\n**{0} Pre-event {1}".format(self.month,self.event_names[event]))
+        #records to the trace log if the patient is traced
+        if self.trace_log is not None:
+            self.trace(TRC_PEVENT, event)
     def get_event_comp(self, event):
         self.month_of_comp[event] = self.month
         #add cost
@@ -862,12 +865,16 @@ class Patient(object):
         self.add_out("event_comp", event,1)
         self.add_month_out('event_comp',(event, self.ss, self.agecat, self.gender),1)
 
-        #prints to trace file if it exists
-        if self.traces is not None:
-            self.trace("\n**{0} Event {1} Complication".format(self.month,self.event_names[event]))
-    #run single time step(month)
-    def run_step(self):
+        #records to the trace log if the patient is traced
+        if self.trace_log is not None:
+            self.trace(TRC_COMP, event)
+    #run single time step(month). draws are the month's uniforms by slot and
+    #are taken from the patient's stream if not given
+    def run_step(self, draws = None):
         self.update_start_month()
+        if draws is None:
+            draws = self.get_month_draws()
+        self.draws = draws
         self.update_interventions()
         self.update_smoke_start()
         self.update_smoke_quit()
@@ -883,9 +890,222 @@ class Patient(object):
     def run_until_death(self):
         while(self.isalive):
             self.run_step()
+    #uniforms of the current month by slot
+    def get_month_draws(self):
+        return keyed_uniforms(self.stream_key, self.month+1, np.arange(NUM_SLOTS)).tolist()
+
+    #same as run_until_death but samples the wait until the next month in which one
+    #of the patient's rolls succeeds instead of running the months before it.
+    #Within a quiet window the monthly probs are fixed or follow the months since
+    #quit, so the number of quiet months is drawn at once from the product of each
+    #month's probs that no roll succeeds, which is a geometric wait when they are
+    #fixed. The quiet months are run as one step that adds their outputs in closed
+    #form and the month that ends the wait is run in full with its draws conditioned
+    #on one of its rolls succeeding. Windows in which most months have a successful
+    #roll are run month by month as sampling them would skip few months
+    def run_events_until_death(self):
+        self.event_key = event_keys(self.seed, [self.pid])[0]
+        #months before this one are run month by month
+        stepped_until = 0
+        while(self.isalive):
+            #age category of the month the window starts in
+            self.agecat = get_age_cat(AGE_BRACKETS, self.age)
+            window = 0 if self.month < stepped_until else self.get_quiet_window()
+            if window == 0:
+                self.run_step()
+                continue
+            slots, probs = self.get_quiet_rolls(np.arange(window))
+            quiet = (1-probs).prod(axis = 1)
+            if quiet.prod() < MIN_QUIET_PROB**window:
+                stepped_until = self.month+max(window, MIN_STEPPED_MONTHS)
+                self.run_step()
+                continue
 
-        if self.traces is not None:
-            self.traces[self.pid] = self.trace_text
+            wait_draw, first_draw = keyed_uniforms(self.event_key, self.month+1, [SLOT_EVENT_WAIT, SLOT_EVENT_FIRST])
+            #the first num_quiet months are quiet with prob the product of their quiet probs
+            num_quiet = int((np.cumprod(quiet) > wait_draw).sum())
+            if num_quiet:
+                self.run_quiet_months(num_quiet)
+            if num_quiet < window:
+                self.run_step(self.get_wait_end_draws(slots, probs[num_quiet], first_draw))
+
+    #number of months from now in which only the rolls of get_quiet_rolls can change
+    #the patient and the outputs of a month depend only on months since quit.
+    #Ends at the next birthday, max age, regular screening, confirmatory test or change
+    #of the smoking related quit windows. 0 if the current month has to be run in full
+    def get_quiet_window(self):
+        maxage = self.inputs.sim.maxage*12
+        ends = [12 - self.age % 12, maxage - self.age]
+        for event in range(NUM_EVENTS):
+            if self.events[event] != EVT_FULL and self.month_of_reg_screen[event] is not None:
+                ends.append(self.month_of_reg_screen[event] - self.month)
+            if self.month_of_conf[event] is not None:
+                ends.append(self.month_of_conf[event] - self.month)
+
+        if self.ss == SS_FORMER:
+            time_since_quit = self.get_time_since_quit()
+            if time_since_quit < self.inputs.costs.bkgd_trans:
+                ends.append(self.inputs.costs.bkgd_trans - time_since_quit)
+            quit_duration = self.inputs.qol.quit_duration[self.si]
+            if self.update_qol and time_since_quit <= quit_duration:
+                ends.append(quit_duration + 1 - time_since_quit)
+        elif self.ss == SS_CURRENT:
+            smoking = self.inputs.smoking
+            for event in range(NUM_EVENTS):
+                if self.events[event] == EVT_FULL:
+                    months_event = self.month - self.month_of_event[event]
+                    if months_event <= smoking.event_quit_duration[event]:
+                        ends.append(smoking.event_quit_duration[event] + 1 - months_event)
+                if self.month_of_comp[event] is not None:
+                    months_comp = self.month - self.month_of_comp[event]
+                    if months_comp <= smoking.comp_quit_duration[event]:
+                        ends.append(smoking.comp_quit_duration[event] + 1 - months_comp)
+
+        intv = self.inputs.intervention
+        for i in range(NUM_INTERVENTIONS):
+            if self.has_int[i] and self.ss != SS_NEVER:
+                if self.ss == SS_FORMER and intv.stop_abst_duration[i] >= 0:
+                    ends.append(intv.stop_abst_duration[i] - self.get_time_since_quit())
+                if intv.duration[i] >= 0:
+                    ends.append(intv.duration[i] - (self.month - self.month_start_int[i]))
+        return int(max(min(ends), 0))
+    #slots of the rolls of a quiet month in the order run_step makes them, ending
+    #with death, and the probs they succeed with by [month, roll]
+    def get_quiet_rolls(self, months):
+        intv = self.inputs.intervention
+        prophs = self.inputs.prophs
+        pevt = self.inputs.pre_events
+        slots = []
+        probs = []
+
+        #update_interventions
+        if self.ss != SS_NEVER:
+            for i in range(NUM_INTERVENTIONS):
+                if self.has_int[i]:
+                    slots += [SLOT_INT_STOP+i, SLOT_INT_TOX+i]
+                    probs += [intv.stop_prob_month[self.si, self.gender, i], intv.tox_prob[i]]
+                elif self.ss == SS_CURRENT and (not self.has_int_tox_hist[i] or intv.allow_restart_on_tox[i]):
+                    slots.append(SLOT_INT_START+i)
+                    probs.append(self.get_prob_int_start(i))
+
+        #update_smoke_start, update_smoke_quit and update_smoke_relapse
+        if self.ss == SS_NEVER:
+            slots.append(SLOT_SMOKE_START)
+            probs.append(self.get_prob_smoke_start())
+        elif self.ss == SS_CURRENT:
+            slots.append(SLOT_SMOKE_QUIT)
+            probs.append(self.get_prob_quit())
+        else:
+            slots.append(SLOT_SMOKE_RELAPSE)
+            probs.append(self.get_prob_relapse(months))
+
+        #update_prophs
+        for i in range(NUM_PROPHS):
+            if self.has_proph[i]:
+                slots += [SLOT_PROPH_STOP+i, SLOT_PROPH_TOX+i]
+                probs += [prophs.stop_prob_month[self.si, self.gender, i], prophs.tox_prob[i]]
+            elif not self.has_proph_tox_hist[i] or prophs.allow_restart_on_tox[i]:
+                slots.append(SLOT_PROPH_START+i)
+                probs.append(self.get_prob_proph_start(i))
+
+        #update_pre_events
+        for event in range(NUM_EVENTS):
+            if self.events[event] == EVT_NONE:
+                slots.append(SLOT_PEVENT_INC+event)
+                probs.append(self.get_prob_pevent(event, months))
+
+        #update_pevent_screening
+        for event in range(NUM_EVENTS):
+            if self.events[event] != EVT_FULL and self.month_of_conf[event] is None:
+                slots.append(SLOT_SCREEN_BACK+event)
+                probs.append(pevt.screening_background_prob[self.gender,event,self.agecat])
+
+        #update_events
+        pevent_mult = 1
+        for event in range(NUM_EVENTS):
+            if self.events[event] == EVT_FULL:
+                slots.append(SLOT_EVENT_COMP+event)
+                probs.append(self.get_prob_comp(event, months))
+        for event in range(NUM_EVENTS):
+            if self.events[event] == EVT_PRE:
+                prob_event = pevt.pevent_to_event_prob[self.gender, event, self.agecat]
+                pevent_mult *= pevt.pevent_mort_mult[self.gender,event, self.agecat]
+                if self.is_detected_pevent[event]:
+                    prob_event *= pevt.screening_outcome_event_mult[event]
+                    pevent_mult *= pevt.screening_outcome_pevent_mort_mult[event]
+                slots.append(SLOT_PEVENT_TO_EVENT+event)
+                probs.append(prob_event)
+        for event in range(NUM_EVENTS):
+            if self.events[event] == EVT_NONE:
+                slots.append(SLOT_EVENT_INC+event)
+                probs.append(self.get_prob_event(event, months))
+
+        #update_nathist and update_mort
+        slots.append(SLOT_DEATH)
+        probs.append(np.minimum(self.get_nathist_mort(months)*pevent_mult, 1.0))
+
+        prob_table = np.zeros((len(months), len(slots)))
+        for j, prob in enumerate(probs):
+            prob_table[:,j] = prob
+        return slots, prob_table
+    #uniforms of the month that ends a wait, conditioned on one of the rolls of
+    #slots succeeding with probs. The first roll to succeed is drawn with draw from
+    #the probs that it is the first, the rolls before it are made to fail and the
+    #rolls after it keep their draws. Death succeeds on a draw above its no death prob
+    def get_wait_end_draws(self, slots, probs, draw):
+        draws = self.get_month_draws()
+        none_yet = np.cumprod(1-probs)
+        first = min(int((none_yet >= 1-draw*(1-none_yet[-1])).sum()), len(slots)-1)
+        for j in range(first+1):
+            slot, prob, u = slots[j], probs[j], draws[slots[j]]
+            if j < first:
+                fail = prob+(1-u)*(1-prob) if slot != SLOT_DEATH else (1-u)*(1-prob)
+                draws[slot] = fail
+            else:
+                draws[slot] = u*prob if slot != SLOT_DEATH else 1-u*prob
+        return draws
+    #num months in which none of the patient's rolls succeed, run as one step. Adds
+    #the same outputs as num run_steps. The discounted outputs of the months are the
+    #geometric sum of their discount factors and the monthly ones use each factor
+    def run_quiet_months(self, num):
+        qol = self.inputs.qol
+        disc_month = 1/self.disc_mult_month
+        self.span = num
+        self.span_disc = self.disc_factor*np.power(disc_month, np.arange(num))
+        if disc_month == 1:
+            self.span_disc_total = self.disc_factor*num
+        else:
+            self.span_disc_total = self.disc_factor*(1-disc_month**num)/(1-disc_month)
+        self.update_start_month()
+
+        for event in range(NUM_EVENTS):
+            if self.events[event] == EVT_PRE:
+                self.add_out("pevent_mths",event,1)
+        for event in range(NUM_EVENTS):
+            if self.events[event] == EVT_FULL:
+                continue
+            #awaiting conf test
+            if self.month_of_conf[event] is not None and self.update_qol:
+                self.add_qol(qol.screen_wait_conf[event])
+            if self.events[event] == EVT_PRE:
+                if self.is_detected_pevent[event]:
+                    self.add_cost("cost_screening",event, self.inputs.costs.screen_detected[event], True)
+                    if self.update_qol:
+                        self.add_qol(qol.screen_det[event])
+                elif self.update_qol:
+                    self.add_qol(qol.screen_undet[event])
+        for event in range(NUM_EVENTS):
+            if self.events[event] == EVT_FULL:
+                self.add_event_month(event)
+        self.add_end_month()
+        self.add_month_out('num_alive',(self.ss,self.si), 1)
+
+        self.month += num
+        self.age += num
+        self.disc_factor *= disc_month**num
+        self.span = 1
+        self.span_disc = None
+        self.span_disc_total = None
 
     def kill_patient(self,cause):
         self.isalive = False
@@ -906,20 +1126,11 @@ class Patient(object):
         if self.ever_start_any_int:  
             self.add_out("int_start",None,1)
             
-        if self.traces is not None:
-            self.trace("\n**{0} DEATH {1}".format(self.month,self.death_names[cause]))
-            self.trace("\nEND PATIENT {0}".format(self.pid), False)
-    def trace(self, text, include_lm = True):
-        #prints to trace file
-        out = self.disc_outputs.disc
-        if include_lm:
-            text+=", LM {0:.2f}, QA {1:.2f}, $ {2:.2f}".format(out['lms'][self.pid].sum(),
-                                                   out['qalms'][self.pid].sum(),
-                                                   out['overall_costs'][self.pid].sum())
-
-        self.trace_text+=text
-        #self.traces.write(text)
-        
+        if self.trace_log is not None:
+            self.trace(TRC_DEATH, cause)
+    #records kind to the trace log with the running totals of the patient
+    def trace(self, kind, index = 0, value = 0):
+        self.trace_log.add(self.pid, self.month, kind, index, value, self.trace_totals)
     def __repr__(self):
         s = "Patient {0}".format(self.pid)
         s += "\nGender:{0}".format(GENDER_STRS[self.gender])
@@ -935,21 +1146,15 @@ if __name__ == "__main__":
     o = Outputs(runsize, i)
     
     do = DiscOutputs(runsize, i)
-    mo = MonthlyOutputs()
+    mo = MonthlyOutputs(i.sim.maxage*12+1)
     num = 0
-    tracepath = "test.smtrace"
-    with open(tracepath, 'w') as ftrace:
-        for n in range(runsize):
-            if n%100==0:
-                print(n)
-            
-        
-            if n <50:
-                traces = ftrace
-            else:
-                traces = None
-            
-            p = Patient(n, i, o, do, mo, traces)
-            p.run_until_death()
-        
-    write_output("test.smout",o, do, mo)        
+    trace_log = TraceLog()
+    for n in range(runsize):
+        if n%100==0:
+            print(n)
+
+        p = Patient(n, i, o, do, mo, trace_log if n < 50 else None)
+        p.run_until_death()
+
+    write_output("test.smout",o, do, mo)
+    write_trace_log("test.smtlog", trace_log, i)        
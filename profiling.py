@@ -0,0 +1,144 @@
+"""
+Instrumentation of the monthly step for smoking model
+
+A StepProfile wraps the methods of each patient or cohort it instruments with
+timers and counters. Objects that are not instrumented run the unchanged methods,
+so runs without profiling have no overhead.
+"""
+
+from time import perf_counter
+import inspect, json
+import numpy as np
+try:
+    import resource
+except ImportError:
+    resource = None
+
+#methods timed for their number of calls and total wall time. Times include
+#the time of the timed methods they call
+TIMED_METHODS = ["update_start_month", "update_interventions", "update_smoke_start", "update_smoke_quit",
+                 "update_smoke_relapse", "update_prophs", "update_pre_events", "update_pevent_screening",
+                 "update_events", "update_nathist", "update_mort", "update_end_month",
+                 "add_cost", "add_out", "add_disc_out", "add_month_out"]
+#methods counted as transitions. Cohort methods count the patients in idx
+TRANSITION_METHODS = ["start_smoking", "quit_smoking", "relapse_smoking", "start_proph", "stop_proph",
+                      "start_intervention", "stop_intervention", "get_event", "get_pevent", "cure_pevent",
+                      "get_event_comp", "kill_patient"]
+#methods that return random draws. Patients draw all of a month's uniforms at once
+#so these count the draws used
+DRAW_METHODS = ["random"]
+#methods that each run one month
+STEP_METHODS = ["run_step", "run_quiet_months"]
+
+#peak resident memory of this process, or with children of the largest of its
+#finished child processes, as reported by the os (kB on linux). None if unknown
+def get_peak_rss(children = False):
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF).ru_maxrss
+
+def timed(method, entry):
+    def wrapper(*args, **kwargs):
+        start = perf_counter()
+        value = method(*args, **kwargs)
+        entry[0] += 1
+        entry[1] += perf_counter()-start
+        return value
+    return wrapper
+#counts the patients in the idx argument at idx_pos, one if there is none
+def counted(method, counts, name, idx_pos):
+    def wrapper(*args, **kwargs):
+        counts[name] += 1 if idx_pos is None else np.size(args[idx_pos])
+        return method(*args, **kwargs)
+    return wrapper
+#counts the draws in the values returned
+def counted_draws(method, counts, name):
+    def wrapper(*args, **kwargs):
+        value = method(*args, **kwargs)
+        counts[name] += np.size(value)
+        return value
+    return wrapper
+
+#timers and counters of the monthly step over the instrumented objects of a block
+#or, once merged, of a run
+class StepProfile(object):
+    def __init__(self):
+        #[calls, seconds] by method
+        self.times = {name: [0, 0.0] for name in TIMED_METHODS+["init"]}
+        self.counts = {name: 0 for name in TRANSITION_METHODS+DRAW_METHODS+STEP_METHODS}
+        self.num_patients = 0
+        self.patient_months = 0
+        self.block_seconds = 0.0
+        self.peak_rss = get_peak_rss()
+    #creates an object with make(*args), timed as init
+    def make(self, make, *args):
+        return timed(make, self.times["init"])(*args)
+    #wraps the methods of a patient or cohort
+    def instrument(self, obj):
+        for name in TIMED_METHODS:
+            if hasattr(obj, name):
+                setattr(obj, name, timed(getattr(obj, name), self.times[name]))
+        for name in TRANSITION_METHODS+STEP_METHODS:
+            if hasattr(obj, name):
+                method = getattr(obj, name)
+                params = list(inspect.signature(method).parameters)
+                idx_pos = params.index("idx") if "idx" in params else None
+                setattr(obj, name, counted(method, self.counts, name, idx_pos))
+        for name in DRAW_METHODS:
+            if hasattr(obj, name):
+                setattr(obj, name, counted_draws(getattr(obj, name), self.counts, name))
+    #adds the patients of a finished block that took seconds
+    def add_block(self, block, seconds):
+        self.num_patients += block.num_patients
+        #each patient adds one undiscounted life month for each month alive
+        self.patient_months += int(round(block.disc_outputs.undisc.lms.sum()))
+        self.block_seconds += seconds
+        self.update_peak_rss()
+    #takes the peak memory of this process if it is the highest yet
+    def update_peak_rss(self):
+        peak_rss = get_peak_rss()
+        if peak_rss is not None:
+            self.peak_rss = max(self.peak_rss or 0, peak_rss)
+    def merge(self, other):
+        for name, (calls, seconds) in other.times.items():
+            self.times[name][0] += calls
+            self.times[name][1] += seconds
+        for name, count in other.counts.items():
+            self.counts[name] += count
+        self.num_patients += other.num_patients
+        self.patient_months += other.patient_months
+        self.block_seconds += other.block_seconds
+        if other.peak_rss is not None:
+            self.peak_rss = max(self.peak_rss or 0, other.peak_rss)
+    def get_report(self):
+        methods = {}
+        for name, (calls, seconds) in self.times.items():
+            methods[name] = {"calls": calls,
+                             "seconds": seconds,
+                             "us_per_call": 1e6*seconds/calls if calls else 0.0,
+                             "share": seconds/self.block_seconds if self.block_seconds else 0.0}
+        return {"num_patients": self.num_patients,
+                "patient_months": self.patient_months,
+                "block_seconds": self.block_seconds,
+                "patient_months_per_second": self.patient_months/self.block_seconds if self.block_seconds else 0.0,
+                "peak_rss_kb": self.peak_rss,
+                "methods": methods,
+                "counts": dict(self.counts)}
+
+#writes the report of a profile as .smprof.json and a tab separated table as .smprof
+def write_profile(basepath, profile):
+    report = profile.get_report()
+    with open(basepath+".smprof.json", "w") as fout:
+        json.dump(report, fout, indent = 1)
+    with open(basepath+".smprof", "w") as fout:
+        fout.write("STEP PROFILE")
+        for key in ("num_patients", "patient_months", "block_seconds", "patient_months_per_second", "peak_rss_kb"):
+            fout.write("\n\t{0}\t{1}".format(key, report[key]))
+        fout.write("\n\n\tMethod\tCalls\tSeconds\tus per call\tShare")
+        for name, entry in sorted(report["methods"].items(), key = lambda item: -item[1]["seconds"]):
+            fout.write("\n\t{0}\t{1}\t{2:.4f}\t{3:.3f}\t{4:.4f}".format(name, entry["calls"], entry["seconds"],
+                                                                      entry["us_per_call"], entry["share"]))
+        fout.write("\n\n\tCount\tNumber")
+        for name, count in report["counts"].items():
+            fout.write("\n\t{0}\t{1}".format(name, count))
+        fout.write("\n")
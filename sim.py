@@ -8,92 +8,447 @@ from inputs import *
 from outputs import *
 from enums import *
 from patient import *
-import os, sys,threading
+from cohort import *
+from markov import *
+import os, sys, time, pickle, hashlib
 from glob import glob
-import random
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from collections import deque
 
-######################################################################
-#patient thread
-class PatientThread(threading.Thread):
-    def __init__(self,tID,pargs):
-        threading.Thread.__init__(self)
-        self.tID = tID
-        self.pargs = pargs
-    def run(self):
-        p = Patient(*self.pargs)
-        p.run_until_death()
+#number of patients in each output block by default. Blocks are the unit of work
+#handed to workers and are always merged in pid order. The monthly outputs are summed
+#block by block, so the size does not depend on the workers and the outputs of a run
+#are the same for any number of workers
+BLOCK_SIZE = 2000
+
+#patients with pid below this are traced by default
+NUM_TRACED = 50
+
+#seconds between checkpoints of a run
+CHECKPOINT_INTERVAL = 300
+
+#runs the patients of one block into that block's own accumulators
+#seed is the root seed of the run that the patients' random streams are spawned from
+#traced selects the traced patients as in is_traced
+#profiled instruments the patients and keeps their StepProfile in block.profile
+def run_block(args):
+    inputs, engine, seed, start, stop, traced, profiled = args
+    block_start = time.perf_counter()
+    block = OutputBlock(stop-start, inputs, start)
+    profile = StepProfile() if profiled else None
+    if engine == "cohort":
+        cohort_args = (range(start, stop), inputs, block.outputs, block.disc_outputs, block.monthly_outputs, seed)
+        if profile is None:
+            c = Cohort(*cohort_args)
+        else:
+            c = profile.make(Cohort, *cohort_args)
+            profile.instrument(c)
+        c.run_until_death()
+    else:
+        for n in range(start, stop):
+            trace_log = block.traces if is_traced(traced, n) else None
+            patient_args = (n, inputs, block.outputs, block.disc_outputs, block.monthly_outputs, trace_log, seed)
+            if profile is None:
+                p = Patient(*patient_args)
+            else:
+                p = profile.make(Patient, *patient_args)
+                profile.instrument(p)
+            if engine == "event":
+                p.run_events_until_death()
+            else:
+                p.run_until_death()
+    if profile is not None:
+        profile.add_block(block, time.perf_counter()-block_start)
+        block.profile = profile
+    return block
+
+#stopping rule for a run of adaptive size. The run stops once the confidence half
+#width of the mean patient total of every measure (label, group, varname as in
+#SUMMARY_MEASURES) is at most half_width, taken relative to the absolute mean when
+#relative, or once max_runsize patients have run (the runsize of the inputs if None).
+#z is the normal quantile of the confidence level
+class Precision(object):
+    def __init__(self, half_width, relative = True, max_runsize = None, measures = None, z = 1.96):
+        self.half_width = half_width
+        self.relative = relative
+        self.max_runsize = max_runsize
+        if measures is None:
+            measures = [SUMMARY_MEASURES[0], SUMMARY_MEASURES[2]]
+        self.measures = measures
+        self.z = z
+    #running summary of the patient totals of each measure
+    def get_trackers(self):
+        return [OutputSummary((), float) for measure in self.measures]
+    #adds the patients of a block. With the block of a base scenario for the same
+    #patients the paired differences from the base are added instead
+    def add_block(self, trackers, block, base = None):
+        for tracker, (label, group, varname) in zip(trackers, self.measures):
+            rows = getattr(block.disc_outputs, group)[varname]
+            if base is not None:
+                rows = rows-getattr(base.disc_outputs, group)[varname]
+            tracker.add_rows(rows.reshape(len(rows), -1).sum(axis = 1))
+    def get_half_width(self, tracker):
+        return self.z*tracker.std_total()/np.sqrt(tracker.count)
+    def is_reached(self, trackers):
+        for tracker in trackers:
+            target = self.half_width
+            if self.relative:
+                target *= abs(tracker.mean_total)
+            if self.get_half_width(tracker) > target:
+                return False
+        return True
 
 ######################################################################
 #Main simulation object
+#engine is "patient" to run each patient on its own or "cohort" to step
+#all patients together with the vectorized cohort object or "event" to run
+#each patient skipping the months in which nothing happens to it.
+#"markov" writes the expected summary outputs of the markov cohort instead
+#workers > 1 runs the patient blocks on that many processes
+#block_size is the number of patients in each block (BLOCK_SIZE by default). Runs with
+#different block sizes sum the monthly outputs in a different order so they agree
+#only to rounding
+#summary keeps only running summaries of the patient level outputs
+#compress writes the output file gzip compressed as .smout.gz
+#store also saves all output arrays in the binary results store .smres.npz
+#cache_dir keeps the loaded inputs of each input file so they are not parsed again
+#seed fixes the root seed of the random streams instead of taking it from the
+#inputs. Scenarios run with the same seed use common random numbers
+#precision runs patients only until the Precision is reached
+#checkpoint saves the merged results every that many seconds to .smckpt and
+#resume continues from the saved results of an earlier run that did not finish.
+#Resumed runs give the same results as runs that were never stopped
+#trace selects the traced patients by the number of first pids, a collection of
+#pids or a predicate of the pid. Traces are saved as records to .smtlog and
+#trace_text also renders them to .smtrace
+#profile times the monthly updates and counts draws and transitions of each
+#patient, reported in .smprof.json and .smprof
 class Sim(object):
-    def __init__(self):
+    def __init__(self, engine = "patient", workers = 1, summary = False, compress = False, store = False,
+                 cache_dir = None, seed = None, precision = None, checkpoint = None, resume = False,
+                 trace = NUM_TRACED, trace_text = False, profile = False, block_size = None):
         self.inputs = None
-        self.traces = {}
+        self.engine = engine
+        self.workers = workers
+        self.block_size = BLOCK_SIZE if block_size is None else block_size
+        self.summary = summary
+        self.compress = compress
+        self.store = store
+        self.cache_dir = cache_dir
+        self.fixed_seed = seed
+        self.precision = precision
+        self.checkpoint = checkpoint
+        self.resume = resume
+        if trace is None or callable(trace) or isinstance(trace, (int, np.integer)):
+            self.traced = trace
+        else:
+            self.traced = frozenset(trace)
+        self.trace_text = trace_text
+        self.profile = profile
     def load_inputs_xl(self, filepath):
         self.input_path = filepath
 
         self.inputs = Inputs()
-        self.inputs.load_excel(filepath)
-
-        self.runsize = self.inputs.sim.runsize
-        self.is_rand_seed = self.inputs.sim.rand_seed
-
-        self.outputs = Outputs(self.runsize, self.inputs)
-
-        self.disc_outputs = DiscOutputs(self.runsize, self.inputs)
-
-        self.monthly_outputs = MonthlyOutputs()
+        if self.cache_dir:
+            self.inputs.load_cached(filepath, self.inputs.load_excel, self.cache_dir)
+        else:
+            self.inputs.load_excel(filepath)
+        self.init_outputs()
 
+    #loads an excel or text input file by its extension
+    def load_inputs(self, filepath):
+        if filepath.endswith(".xlsm"):
+            self.load_inputs_xl(filepath)
+        else:
+            self.load_inputs_text(filepath)
     def load_inputs_text(self, filepath):
         self.input_path = filepath
 
         self.inputs = Inputs()
-        self.inputs.load_txt(filepath)
-
+        if self.cache_dir:
+            self.inputs.load_cached(filepath, self.inputs.load_txt, self.cache_dir)
+        else:
+            self.inputs.load_txt(filepath)
+        self.init_outputs()
+    def init_outputs(self):
         self.runsize = self.inputs.sim.runsize
+        if self.precision is not None and self.precision.max_runsize:
+            self.runsize = self.precision.max_runsize
         self.is_rand_seed = self.inputs.sim.rand_seed
-
-        self.outputs = Outputs(self.runsize, self.inputs)
-
-        self.disc_outputs = DiscOutputs(self.runsize, self.inputs)
-
-        self.monthly_outputs = MonthlyOutputs()
+        self.set_results(OutputBlock(self.runsize, self.inputs, summary = self.summary))
+    def set_results(self, results):
+        self.results = results
+        self.outputs = self.results.outputs
+        self.disc_outputs = self.results.disc_outputs
+        self.monthly_outputs = self.results.monthly_outputs
+        self.traces = self.results.traces
     def convert_excel_to_text(self,excelfile,textfile):
         self.load_inputs_xl(excelfile)
         self.inputs.save_txt(textfile)
     #main loop
     def run(self):
-        threads = []
-        tracepath = os.path.splitext(self.input_path)[0]+".smtrace"
-        for n in range(self.runsize):
-
-            if not self.is_rand_seed:
-                random.seed(n)
-            if n%100==0:
-                print(n)
-            if n < 50:
-                traces = self.traces
+        if self.engine == "markov":
+            self.run_markov()
+            return
+        if self.workers > 1:
+            with ProcessPoolExecutor(self.workers) as pool:
+                self.run_blocks(pool)
+        else:
+            self.run_blocks()
+        self.write_outputs()
+    #runs all the blocks of patients or with precision only as many as needed
+    def run_blocks(self, pool = None):
+        if self.precision is None:
+            self.start(pool)
+            self.finish()
+        else:
+            self.run_adaptive(pool)
+    #sets the root seed of the run
+    def init_run(self):
+        if self.fixed_seed is None:
+            self.seed = get_run_seed(self.is_rand_seed)
+        else:
+            self.seed = self.fixed_seed
+        #build the tables once so that workers receive them with the inputs
+        get_tables(self.inputs)
+    #queues the blocks of patients on pool. Without a pool the blocks are
+    #run in this process one at a time as they are merged
+    def start(self, pool = None):
+        self.init_run()
+        first_pid = 0
+        if self.resume and os.path.exists(self.get_checkpoint_path()):
+            first_pid = self.load_checkpoint()
+        self.last_checkpoint = time.time()
+        blocks = self.get_blocks(first_pid)
+        if pool is None:
+            self.pending = map(run_block, blocks)
+        else:
+            self.pending = pool.map(run_block, blocks)
+    #waits for all blocks and merges them into the results
+    def finish(self):
+        pending, self.pending = self.pending, None
+        self.reduce_blocks(pending)
+    #runs blocks in waves of one per worker until the precision is reached. With
+    #a base sim, the base runs the same patients with the same seed and the
+    #precision is of the paired differences from the base. Results are kept for
+    #the patients that ran
+    def run_adaptive(self, pool = None, base = None):
+        sims = [self] if base is None else [self, base]
+        for s in sims:
+            s.init_run()
+        if base is not None:
+            if base.runsize != self.runsize:
+                raise ValueError("paired runs need the same runsize")
+            base.seed = self.seed
+        trackers = self.precision.get_trackers()
+        blocks = [s.get_blocks() for s in sims]
+        num_patients = 0
+        for i in range(0, len(blocks[0]), self.workers):
+            waves = [b[i:i+self.workers] for b in blocks]
+            if pool is None:
+                waves = [map(run_block, wave) for wave in waves]
             else:
-                traces = None
+                waves = [pool.map(run_block, wave) for wave in waves]
+            for finished in zip(*waves):
+                for s, block in zip(sims, finished):
+                    s.results.merge(block)
+                self.precision.add_block(trackers, *finished)
+                num_patients = finished[0].first_pid+finished[0].num_patients
+            print(num_patients)
+            if self.precision.is_reached(trackers):
+                break
+        for s in sims:
+            s.results.truncate(num_patients)
+        self.runsize = num_patients
+        if base is not None:
+            base.runsize = num_patients
+        return [(measure[0], tracker.mean_total, self.precision.get_half_width(tracker))
+                for measure, tracker in zip(self.precision.measures, trackers)]
+    #writes the trace, profile and output files of the results
+    def write_outputs(self):
+        if self.results.profile is not None:
+            self.results.profile.update_peak_rss()
+            write_profile(os.path.splitext(self.input_path)[0], self.results.profile)
+        if self.traces.num_records:
+            logpath = os.path.splitext(self.input_path)[0]+".smtlog"
+            write_trace_log(logpath, self.traces, self.inputs)
+            if self.trace_text:
+                StoredTrace(logpath).write_text(os.path.splitext(self.input_path)[0]+".smtrace")
 
-            t = PatientThread(n,[n,self.inputs,self.outputs, self.disc_outputs, self.monthly_outputs, traces])
-            t.start()
-            threads.append(t)
-            #p = Patient(n,self.inputs,self.outputs, self.disc_outputs, self.monthly_outputs, trace_file)
-            #p.run_until_death()
+        #write output
+        outpath = os.path.splitext(self.input_path)[0]+".smout"
+        if self.compress:
+            outpath += ".gz"
+        write_output(outpath,self.outputs, self.disc_outputs, self.monthly_outputs, self.compress)
+        if self.store:
+            storepath = os.path.splitext(self.input_path)[0]+".smres.npz"
+            write_results(storepath, self.outputs, self.disc_outputs, self.monthly_outputs)
+        #the run is complete so it is never resumed
+        if self.checkpoint is not None and os.path.exists(self.get_checkpoint_path()):
+            os.remove(self.get_checkpoint_path())
+    def get_checkpoint_path(self):
+        return os.path.splitext(self.input_path)[0]+".smckpt"
+    #identifies the run a checkpoint can be resumed by. Blocks of a different
+    #size or inputs with different values would not continue the same run
+    def get_checkpoint_key(self):
+        tabs = pickle.dumps([getattr(self.inputs, tabname) for tabname in self.inputs.tabnames])
+        return (self.engine, self.runsize, self.block_size, self.summary, hashlib.sha256(tabs).hexdigest())
+    #saves the results merged so far, the first pid not yet merged and the root seed.
+    #Patient draws are keyed by the seed so nothing else is needed to continue
+    def write_checkpoint(self, next_pid):
+        state = {"key": self.get_checkpoint_key(),
+                 "seed": self.seed,
+                 "next_pid": next_pid,
+                 "results": self.results}
+        #replace the last checkpoint only once the new one is complete
+        path = self.get_checkpoint_path()
+        tmppath = path+".tmp"
+        with open(tmppath, "wb") as f:
+            pickle.dump(state, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmppath, path)
+        self.last_checkpoint = time.time()
+    #restores the results and seed of the checkpoint and returns the first pid to run.
+    #A fixed seed must be the seed the checkpoint was run with
+    def load_checkpoint(self):
+        with open(self.get_checkpoint_path(), "rb") as f:
+            state = pickle.load(f)
+        if state["key"] != self.get_checkpoint_key() or self.fixed_seed not in (None, state["seed"]):
+            raise ValueError("checkpoint {0} is from a different run".format(self.get_checkpoint_path()))
+        self.seed = state["seed"]
+        self.set_results(state["results"])
+        return state["next_pid"]
+    #expected summary outputs from the markov cohort instead of simulated patients
+    def run_markov(self):
+        cohort = MarkovCohort(self.inputs)
+        if cohort.omitted:
+            print("{0}: markov cohort leaves out {1}".format(self.input_path, ", ".join(cohort.omitted)))
+        cohort.run_until_death()
+        outpath = os.path.splitext(self.input_path)[0]+".smmarkov"
+        write_markov_output(outpath, cohort)
+    #work items for each block of patients
+    def get_blocks(self, first_pid = 0):
+        bounds = list(range(first_pid, self.runsize, self.block_size))+[self.runsize]
+        return [(self.inputs, self.engine, self.seed, start, stop, self.traced, self.profile)
+                for start, stop in zip(bounds[:-1], bounds[1:])]
+    #merges finished blocks into the results. blocks must be in pid order
+    def reduce_blocks(self, blocks):
+        for block in blocks:
+            self.results.merge(block)
+            next_pid = block.first_pid+block.num_patients
+            print(next_pid)
+            if self.checkpoint is not None and time.time()-self.last_checkpoint >= self.checkpoint:
+                self.write_checkpoint(next_pid)
 
-        for t in threads:
-            t.join()
+#runs every input file on one pool of workers. The blocks of the next scenarios
+#are queued while earlier ones are merged, and outputs are written on a separate
+#thread so the workers never wait on them. At most pending scenarios are held at
+#once (by default one per worker and at least two, so that with one worker the next
+#scenario is queued while the last is merged). A scenario that fails does not stop the batch.
+#options are passed to each Sim. Returns the error of each failed file by filepath
+def run_batch(filepaths, workers = 1, pending = None, **options):
+    failures = {}
+    running = deque()
+    writes = []
+    pending = pending or max(workers, 2)
+    #merges the oldest running scenario and queues writing its outputs
+    def finish_next():
+        filepath, s = running.popleft()
+        try:
+            s.finish()
+        except Exception as e:
+            failures[filepath] = e
+        else:
+            writes.append((filepath, writer.submit(s.write_outputs)))
 
-        with open(tracepath, 'w') as ftrace:
-            for pid in sorted(self.traces):
-                ftrace.write(self.traces[pid])
+    with ProcessPoolExecutor(workers) as pool, ThreadPoolExecutor(1) as writer:
+        for filepath in filepaths:
+            print(filepath)
+            s = Sim(workers = workers, **options)
+            try:
+                s.load_inputs(filepath)
+                if s.engine == "markov":
+                    s.run_markov()
+                    continue
+                if s.precision is not None:
+                    #stopping depends on the merged blocks so the run cannot be queued ahead
+                    s.run_adaptive(pool)
+                    writes.append((filepath, writer.submit(s.write_outputs)))
+                    continue
+                s.start(pool)
+            except Exception as e:
+                failures[filepath] = e
+                continue
+            running.append((filepath, s))
+            if len(running) >= pending:
+                finish_next()
+        while running:
+            finish_next()
+        for filepath, write in writes:
+            try:
+                write.result()
+            except Exception as e:
+                failures[filepath] = e
 
-        #write output
-        outpath = os.path.splitext(self.input_path)[0]+".smout"
-        write_output(outpath,self.outputs, self.disc_outputs, self.monthly_outputs)
+    for filepath in failures:
+        print("{0} failed: {1!r}".format(filepath, failures[filepath]))
+    return failures
+
+#removes option from the argument list and returns its value
+def pop_option(argv, name, default = None):
+    if name not in argv:
+        return default
+    i = argv.index(name)
+    value = argv[i+1]
+    del argv[i:i+2]
+    return value
+#removes flag from the argument list and returns whether it was there
+def pop_flag(argv, name):
+    if name not in argv:
+        return False
+    argv.remove(name)
+    return True
 if __name__ == "__main__":
-    s = Sim()
+    options = {"engine": pop_option(sys.argv, "--engine", "patient"),
+               "summary": pop_flag(sys.argv, "--summary"),
+               "compress": pop_flag(sys.argv, "--gzip"),
+               "store": pop_flag(sys.argv, "--store"),
+               "cache_dir": pop_option(sys.argv, "--cache")}
+    #--crn runs every scenario on one seed so that they use common random numbers
+    #--precision stops each run once the relative half width of the costs and qalms is within it
+    #and --max-runsize caps its runsize
+    precision = pop_option(sys.argv, "--precision")
+    max_runsize = pop_option(sys.argv, "--max-runsize")
+    if max_runsize is not None and precision is None:
+        sys.exit("--max-runsize needs --precision")
+    if precision is not None:
+        options["precision"] = Precision(float(precision), max_runsize = max_runsize and int(max_runsize))
+    #--trace N traces the first N patients and --trace-pids the comma separated pids
+    trace = pop_option(sys.argv, "--trace")
+    trace_pids = pop_option(sys.argv, "--trace-pids")
+    if trace_pids is not None:
+        options["trace"] = [int(pid) for pid in trace_pids.split(",")]
+    elif trace is not None:
+        options["trace"] = int(trace)
+    options["trace_text"] = pop_flag(sys.argv, "--trace-text")
+    options["profile"] = pop_flag(sys.argv, "--profile")
+    checkpoint = pop_option(sys.argv, "--checkpoint")
+    if checkpoint is not None:
+        options["checkpoint"] = float(checkpoint)
+    options["resume"] = pop_flag(sys.argv, "--resume")
+    if options["resume"] and checkpoint is None:
+        options["checkpoint"] = CHECKPOINT_INTERVAL
+    #--seed also runs every scenario on one seed so it wins over --crn
+    seed = pop_option(sys.argv, "--seed")
+    crn = pop_flag(sys.argv, "--crn")
+    if seed is not None:
+        options["seed"] = int(seed)
+    elif crn:
+        options["seed"] = get_run_seed(True)
+    block_size = pop_option(sys.argv, "--block-size")
+    if block_size is not None:
+        options["block_size"] = int(block_size)
+    workers = int(pop_option(sys.argv, "--workers", 1))
+    s = Sim(workers = workers, **options)
     if len(sys.argv)>= 2 and sys.argv[1]=="text":
         #convert excel file to text
         print(sys.argv)
@@ -123,20 +478,4 @@ if __name__ == "__main__":
             excelfiles = glob(os.path.join(folder,"*.xlsm"))
             textfiles = glob(os.path.join(folder,"*.smin"))
 
-        for excelfile in excelfiles:
-            print(excelfile)
-            try:
-                s.load_inputs_xl(excelfile)
-            except:
-                pass
-            else:
-                s.run()
-
-        for textfile in textfiles:
-            print(textfile)
-            try:
-                s.load_inputs_text(textfile)
-            except IndexError:
-                pass
-            else:
-                s.run()
\ No newline at end of file
+        run_batch(excelfiles+textfiles, workers, **options)
@@ -0,0 +1,96 @@
+"""
+Per patient random number streams for smoking model
+
+Each patient gets a key from SeedSequence(seed).spawn keyed by pid. A draw is
+the SplitMix64 output for counter (step, slot) of that key, where step is 0
+for initialization and month+1 after that and slot is a fixed id of the decision
+being rolled. Draws therefore do not depend on thread or process scheduling,
+block size, the number of workers or the engine, and a draw that is skipped for
+one patient does not shift any other draw.
+
+Every decision also has its own substream that does not depend on the other
+inputs, so runs of different scenarios with the same root seed use common random
+numbers: a patient starts with the same characteristics and rolls the same draw
+for the same decision in the same month in every scenario.
+
+The event engine takes the draws that sample its waiting times from a second
+key of each patient so that they never share a counter with the monthly draws.
+"""
+
+from enums import *
+import numpy as np
+
+#slots for the draws made when initializing a patient (step 0)
+SLOT_INIT_GENDER = 0
+SLOT_INIT_AGE = 1
+SLOT_INIT_SS = 2
+SLOT_INIT_SI = 3
+SLOT_INIT_QUIT = 4
+SLOT_INIT_EVENT = 5
+SLOT_INIT_PROPH = SLOT_INIT_EVENT+NUM_EVENTS
+SLOT_INIT_INT = SLOT_INIT_PROPH+NUM_PROPHS
+
+#slots for the draws made each month. Indexed slots are offset by intervention, proph or event
+SLOT_INT_STOP = 0
+SLOT_INT_START = SLOT_INT_STOP+NUM_INTERVENTIONS
+SLOT_INT_TOX = SLOT_INT_START+NUM_INTERVENTIONS
+SLOT_SMOKE_START = SLOT_INT_TOX+NUM_INTERVENTIONS
+SLOT_SMOKE_QUIT = SLOT_SMOKE_START+1
+SLOT_SMOKE_RELAPSE = SLOT_SMOKE_QUIT+1
+SLOT_PROPH_STOP = SLOT_SMOKE_RELAPSE+1
+SLOT_PROPH_START = SLOT_PROPH_STOP+NUM_PROPHS
+SLOT_PROPH_TOX = SLOT_PROPH_START+NUM_PROPHS
+SLOT_PEVENT_INC = SLOT_PROPH_TOX+NUM_PROPHS
+SLOT_SCREEN_ATTEND = SLOT_PEVENT_INC+NUM_EVENTS
+SLOT_SCREEN_BACK = SLOT_SCREEN_ATTEND+NUM_EVENTS
+SLOT_SCREEN_RESULT = SLOT_SCREEN_BACK+NUM_EVENTS
+SLOT_CONF_NEUTRAL = SLOT_SCREEN_RESULT+NUM_EVENTS
+SLOT_EVENT_COMP = SLOT_CONF_NEUTRAL+NUM_EVENTS
+SLOT_PEVENT_TO_EVENT = SLOT_EVENT_COMP+NUM_EVENTS
+SLOT_EVENT_INC = SLOT_PEVENT_TO_EVENT+NUM_EVENTS
+SLOT_DEATH = SLOT_EVENT_INC+NUM_EVENTS
+SLOT_DEATH_CAUSE = SLOT_DEATH+1
+NUM_SLOTS = SLOT_DEATH_CAUSE+1
+
+#slots of the event engine draws, made at the step of the month a quiet window starts.
+#The wait draw samples the number of quiet months and the first draw which roll of
+#the next month succeeds first
+SLOT_EVENT_WAIT = 0
+SLOT_EVENT_FIRST = 1
+
+#spawn key of the event engine stream after the pid
+EVENT_SUBSTREAM = 1
+
+#SplitMix64 constants
+GOLDEN_GAMMA = np.uint64(0x9E3779B97F4A7C15)
+MIX_MULT_1 = np.uint64(0xBF58476D1CE4E5B9)
+MIX_MULT_2 = np.uint64(0x94D049BB133111EB)
+
+#root seed for a run. Random seeds come from fresh OS entropy
+def get_run_seed(is_rand_seed):
+    if is_rand_seed:
+        return np.random.SeedSequence().entropy
+    return 0
+
+#stream key for each pid
+def patient_keys(seed, pids):
+    return np.array([np.random.SeedSequence(seed, spawn_key = (pid,)).generate_state(1, np.uint64)[0]
+                     for pid in pids], np.uint64)
+
+#event engine stream key for each pid
+def event_keys(seed, pids):
+    return np.array([np.random.SeedSequence(seed, spawn_key = (pid, EVENT_SUBSTREAM)).generate_state(1, np.uint64)[0]
+                     for pid in pids], np.uint64)
+
+#SplitMix64 finalizer
+def mix64(z):
+    z = (z ^ (z >> np.uint64(30)))*MIX_MULT_1
+    z = (z ^ (z >> np.uint64(27)))*MIX_MULT_2
+    return z ^ (z >> np.uint64(31))
+
+#uniform draws in [0,1) for keys at step and slot. keys, step and slot broadcast
+def keyed_uniforms(keys, step, slot):
+    counter = np.asarray(slot, np.uint64)+np.asarray(step, np.uint64)*np.uint64(NUM_SLOTS)+np.uint64(1)
+    with np.errstate(over = "ignore"):
+        z = mix64(np.asarray(keys, np.uint64)+counter*GOLDEN_GAMMA)
+    return (z >> np.uint64(11))*(1.0/(1 << 53))
@@ -0,0 +1,124 @@
+"""
+Parameter sweeps for smoking model
+
+Runs variants of a base set of inputs without writing input files. Each variant
+shares the base inputs except for the values its overrides change.
+"""
+
+from sim import *
+import copy
+
+#change to one input of a tab. index picks part of an array input and is
+#None for the whole input. The input is set to value or multiplied by scale
+class Override(object):
+    def __init__(self, tab, varname, index = None, value = None, scale = None):
+        if (value is None) == (scale is None):
+            raise ValueError("override of {0}.{1} needs one of value or scale".format(tab, varname))
+        self.tab = tab
+        self.varname = varname
+        self.index = index
+        self.value = value
+        self.scale = scale
+    #new value of the input. Arrays are changed in place
+    def apply(self, value):
+        if isinstance(value, np.ndarray):
+            index = Ellipsis if self.index is None else self.index
+            if self.scale is None:
+                value[index] = self.value
+            else:
+                value[index] = value[index]*self.scale
+            return value
+        if self.scale is None:
+            return self.value
+        return type(value)(value*self.scale)
+    def __repr__(self):
+        name = "{0}.{1}".format(self.tab, self.varname)
+        if self.index is not None:
+            name += str(np.atleast_1d(self.index).tolist())
+        if self.scale is None:
+            return "{0}={1}".format(name, self.value)
+        return "{0}*{1}".format(name, self.scale)
+
+#inputs with overrides applied over base. Tabs and inputs without overrides
+#are shared with base and the ones with overrides are copied before they are
+#changed so base is never modified
+def override_inputs(base, overrides):
+    inputs = copy.copy(base)
+    inputs.tables = None
+    copied = set()
+    for override in overrides:
+        tab = getattr(inputs, override.tab)
+        if tab is getattr(base, override.tab):
+            tab = copy.copy(tab)
+            setattr(inputs, override.tab, tab)
+        value = getattr(tab, override.varname)
+        if (override.tab, override.varname) not in copied:
+            value = copy.copy(value)
+            copied.add((override.tab, override.varname))
+        setattr(tab, override.varname, override.apply(value))
+    return inputs
+
+#variants that scale one input by each of scales
+def one_way_variants(tab, varname, scales, index = None):
+    return [[Override(tab, varname, index, scale = scale)] for scale in scales]
+#variants for every pair of scales of two inputs. Each input is (tab, varname, index)
+def two_way_variants(first, second, first_scales, second_scales):
+    return [[Override(*first, scale = scale1), Override(*second, scale = scale2)]
+            for scale1 in first_scales for scale2 in second_scales]
+
+#rows of the results table for a finished variant, one per measure. With the
+#sim of the first variant the rows also have the paired difference from it,
+#which needs the per patient outputs of both (nan otherwise)
+def get_sweep_rows(variant, overrides, s, first = None):
+    rows = []
+    for label, group, varname in SUMMARY_MEASURES:
+        a = getattr(s.disc_outputs, group)[varname]
+        axis = tuple(range(1, np.ndim(a)))
+        mean, std = patient_total_stats(a, axis)
+        row = {"variant": variant,
+               "overrides": "; ".join([repr(o) for o in overrides]),
+               "measure": label,
+               "mean": mean,
+               "std": std}
+        if first is not None:
+            a0 = getattr(first.disc_outputs, group)[varname]
+            if isinstance(a, np.ndarray) and isinstance(a0, np.ndarray) and a.shape == a0.shape:
+                row["diff_mean"], row["diff_se"] = paired_diff_stats(a0, a, axis)
+            else:
+                row["diff_mean"], row["diff_se"] = np.nan, np.nan
+        rows.append(row)
+    return rows
+
+#runs a variant of base for each list of overrides on one pool of workers.
+#Variants only keep summary outputs unless summary is False, in which case the
+#rows also have the paired difference of each variant from the first.
+#With crn all variants share one seed so that they use common random numbers.
+#Returns the results table as a list of rows with the variant, its overrides,
+#the measure and the mean and std of the measure over patients
+def run_sweep(base, variants, workers = 1, engine = "patient", summary = True, crn = True):
+    rows = []
+    seed = get_run_seed(base.sim.rand_seed) if crn else None
+    with ProcessPoolExecutor(workers) as pool:
+        sims = []
+        for overrides in variants:
+            s = Sim(engine, workers, summary, seed = seed)
+            s.inputs = override_inputs(base, overrides)
+            s.init_outputs()
+            s.start(pool)
+            sims.append(s)
+        first = None if summary else sims[0]
+        for variant, s in enumerate(sims):
+            s.finish()
+            rows.extend(get_sweep_rows(variant, variants[variant], s, first))
+    return rows
+
+#writes the results table of a sweep as tab separated text
+def write_sweep(filepath, rows):
+    columns = ["variant", "overrides", "measure", "mean", "std"]
+    if rows and "diff_mean" in rows[0]:
+        columns += ["diff_mean", "diff_se"]
+    with open(filepath, "w") as fout:
+        fout.write("\t".join(columns))
+        for row in rows:
+            fout.write("\n"+"\t".join([str(row[column]) for column in columns]))
+        fout.write("\n")
@@ -0,0 +1,207 @@
+"""
+Precomputed sampling tables for smoking model
+
+Built once per Inputs by get_tables and shared by the patient and cohort engines.
+Samplers take the uniform draws from the patient streams and accept either
+scalars or arrays of draws.
+"""
+
+import numpy as np
+from scipy.special import ndtr, ndtri
+
+#truncated normal sampler with the standardized bounds precomputed.
+#A bound of -1 means unbounded. The upper bound can instead be given per draw
+class TruncNormSampler(object):
+    def __init__(self, mean, std, low = -1, high = -1):
+        self.mean = mean
+        self.std = std
+        self.a = self.standardize(low, -np.inf)
+        self.b = self.standardize(high, np.inf)
+    #bound in standard deviations from the mean
+    def standardize(self, bound, unbounded):
+        if self.std == 0:
+            return unbounded
+        bound = np.asarray(bound, float)
+        return np.where(bound == -1, unbounded, (bound - self.mean)/float(self.std))
+    #draws by inverting the cdf at u. Inverts in the upper tail when both
+    #bounds are above the mean so that precision is kept
+    def draw(self, u, high = None):
+        if self.std == 0:
+            return np.full(np.shape(u), self.mean, float)
+        a = self.a
+        b = self.b if high is None else self.standardize(high, np.inf)
+        if a > 0:
+            sa, sb = ndtr(-a), ndtr(-b)
+            x = -ndtri(sa - u*(sa - sb))
+        else:
+            ca, cb = ndtr(a), ndtr(b)
+            x = ndtri(ca + u*(cb - ca))
+        return self.mean + self.std*np.clip(x, a, b)
+    #probability of a draw at or below x
+    def cdf(self, x, high = None):
+        if self.std == 0:
+            return np.where(np.asarray(x) >= self.mean, 1.0, 0.0)
+        a = self.a
+        b = self.b if high is None else self.standardize(high, np.inf)
+        z = np.clip((np.asarray(x, float) - self.mean)/self.std, a, b)
+        return (ndtr(z) - ndtr(a))/(ndtr(b) - ndtr(a))
+
+#Vose alias table for one set of weights. Weights need not be normalized.
+#All zero weights always give the first category
+def build_alias(weights):
+    num_cats = len(weights)
+    prob = np.ones(num_cats)
+    alias = np.arange(num_cats)
+    total = weights.sum()
+    if total <= 0:
+        prob[:] = 0
+        alias[:] = 0
+        return prob, alias
+    scaled = weights*num_cats/total
+    small = [k for k in range(num_cats) if scaled[k] < 1]
+    large = [k for k in range(num_cats) if scaled[k] >= 1]
+    while small and large:
+        s, l = small.pop(), large.pop()
+        prob[s] = scaled[s]
+        alias[s] = l
+        scaled[l] -= 1-scaled[s]
+        if scaled[l] < 1:
+            small.append(l)
+        else:
+            large.append(l)
+    return prob, alias
+
+#categorical sampler with an alias table for every slice of weights.
+#axis is the category axis and draws give the index of the slice over the
+#remaining axes. One uniform per draw picks the column and the coin flip
+class CategoricalSampler(object):
+    def __init__(self, weights, axis = -1):
+        weights = np.moveaxis(np.asarray(weights, float), axis, -1)
+        self.num_cats = weights.shape[-1]
+        self.prob = np.ones(weights.shape)
+        self.alias = np.zeros(weights.shape, int)
+        for index in np.ndindex(weights.shape[:-1]):
+            self.prob[index], self.alias[index] = build_alias(weights[index])
+    #u and index are either scalars or arrays of the same size
+    def draw(self, u, *index):
+        x = u*self.num_cats
+        if np.ndim(x) == 0:
+            k = min(int(x), self.num_cats-1)
+            if x-k < self.prob[index+(k,)]:
+                return k
+            return int(self.alias[index+(k,)])
+        k = np.minimum(x.astype(int), self.num_cats-1)
+        index = index+(k,)
+        return np.where(x-k < self.prob[index], k, self.alias[index])
+
+#value for former smokers by months since quit (last axis of table). Equal to
+#cs up to t0, xs from t1 and linear in between as np.interp. cs, xs, t0 and t1
+#broadcast over the index axes. Past the end of the table the value is xs
+class QuitCurve(object):
+    def __init__(self, cs, xs, t0, t1):
+        self.last = int(max(np.ceil(np.max(t1)), 0))
+        time_since_quit = np.arange(self.last+1)
+        cs, xs, t0, t1 = [np.asarray(v, float)[...,None] for v in (cs, xs, t0, t1)]
+        with np.errstate(divide = "ignore", invalid = "ignore"):
+            interp = (xs - cs)/(t1 - t0)*(time_since_quit - t0) + cs
+        self.table = np.where(time_since_quit >= t1, xs,
+                              np.where(time_since_quit <= t0, cs, interp))
+    def lookup(self, time_since_quit, *index):
+        if np.ndim(time_since_quit) == 0:
+            return self.table[index+(min(max(time_since_quit, 0), self.last),)]
+        return self.table[index+(np.clip(time_since_quit, 0, self.last),)]
+
+#relapse prob c*exp(b*t) by (si, agecat, months since quit) and 0 in the month of
+#quitting. Months past the table are computed directly
+class RelapseCurve(object):
+    def __init__(self, coeffs, length):
+        self.coeffs = coeffs
+        self.last = length-1
+        c, b = coeffs[...,0,None], coeffs[...,1,None]
+        self.table = c*np.exp(b*np.arange(length))
+        self.table[...,0] = 0
+    def lookup(self, time_since_quit, si, agecat):
+        if np.ndim(time_since_quit) == 0:
+            if time_since_quit <= self.last:
+                return self.table[si, agecat, time_since_quit]
+            c, b = self.coeffs[si, agecat]
+            return c*np.exp(b*time_since_quit)
+        si, agecat = np.broadcast_arrays(si, agecat, time_since_quit)[:2]
+        prob = self.table[si, agecat, np.minimum(time_since_quit, self.last)]
+        over = np.flatnonzero(time_since_quit > self.last)
+        if over.size:
+            c, b = self.coeffs[si[over], agecat[over]].T
+            prob[over] = c*np.exp(b*time_since_quit[over])
+        return prob
+
+#largest of the multipliers present, 1 if there are none
+def max_mult(mults):
+    if mults.size:
+        return mults.max()
+    return 1.0
+
+#reduce of the items in every bitmask over the last axis of values.
+#table[..., mask] is reduce(values[..., items with their bit set in mask])
+def mask_table(values, reduce):
+    num_items = values.shape[-1]
+    table = np.ones(values.shape[:-1]+(1 << num_items,))
+    for mask in range(1 << num_items):
+        items = [j for j in range(num_items) if mask >> j & 1]
+        for index in np.ndindex(values.shape[:-1]):
+            table[index+(mask,)] = reduce(values[index][items])
+    return table
+
+#all tables for an Inputs
+class ModelTables(object):
+    def __init__(self, inputs):
+        init = inputs.init
+
+        #initial gender, smoking status and intensity. ss and si by (gender, agecat)
+        self.gender = CategoricalSampler(init.sex_dist)
+        self.ss = CategoricalSampler(init.ss, axis = 1)
+        self.si = CategoricalSampler(init.si, axis = 1)
+
+        #initial age in months and months since quit for former smokers (bounded by age)
+        self.age = TruncNormSampler(*init.age_dist)
+        mean, std = init.quit_dist
+        self.quit_time = TruncNormSampler(mean, std, low = 0)
+
+        #smoking multipliers for former smokers by (event, si, agequit_cat, months since quit)
+        pevt = inputs.pre_events
+        evts = inputs.events
+        self.pevent_inc_quit = self.quit_mult_curve(pevt.pevent_inc_mult_curr, pevt.pevent_inc_mult_ex,
+                                                    pevt.pevent_inc_trans)
+        self.event_inc_quit = self.quit_mult_curve(evts.event_inc_mult_curr, evts.event_inc_mult_ex,
+                                                   evts.event_inc_trans)
+        self.event_comp_quit = self.quit_mult_curve(evts.event_comp_mult_curr, evts.event_comp_mult_ex,
+                                                    evts.event_comp_trans)
+
+        #weight of ex smoker mortality for former smokers by months since quit
+        trans = inputs.nathist.trans
+        self.nathist_quit_weight = QuitCurve(0.0, 1.0, trans[0], trans[1])
+
+        #relapse prob by (si, agecat, months since quit) over a lifetime
+        self.relapse = RelapseCurve(inputs.smoking.relapse_coeffs, inputs.sim.maxage*12+1)
+        #multipliers by bitmask of the full events, interventions or prophs a patient has
+        intv = inputs.intervention
+        prophs = inputs.prophs
+        #by [gender, intervention or proph, event mask]
+        self.int_event_hist_max = mask_table(intv.event_hist_mult, max_mult)
+        self.proph_event_hist_max = mask_table(prophs.event_hist_mult, max_mult)
+        self.proph_event_hist_prod = mask_table(prophs.event_hist_mult, np.prod)
+        #by [intervention mask]
+        self.int_quit_max = mask_table(intv.quit_mult, max_mult)
+        self.int_relapse_max = mask_table(intv.relapse_mult, max_mult)
+        #by [event, proph mask]
+        self.proph_eff_comp_prod = mask_table(prophs.eff_comp.T, np.prod)
+        self.proph_eff_events_prod = mask_table(prophs.eff_events.T, np.prod)
+    #cs_mult is by [event, si], xs_mult by [si, event, agequit_cat] and trans by [event]
+    def quit_mult_curve(self, cs_mult, xs_mult, trans):
+        return QuitCurve(cs_mult[:,:,None], xs_mult.transpose(1,0,2),
+                         trans[:,0,None,None], trans[:,1,None,None])
+
+#tables for inputs. Built on first use and kept on the inputs
+def get_tables(inputs):
+    if inputs.tables is None:
+        inputs.tables = ModelTables(inputs)
+    return inputs.tables
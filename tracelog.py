@@ -0,0 +1,133 @@
+"""
+Trace log for smoking model
+
+Traced patients append a fixed size record for each thing that happens to them
+instead of building trace text. A record has the pid, month, kind, an index (the
+event, proph, intervention or death cause), a value and the patient's running
+discounted life months, QALMs and costs. The .smtrace text is rendered from the
+records only when it is asked for.
+"""
+
+from enums import *
+import numpy as np
+import struct, sys
+
+TRACE_RECORD = np.dtype([("pid", "<i8"), ("month", "<i4"), ("kind", "<i2"), ("index", "<i2"),
+                         ("value", "<i8"), ("lms", "<f8"), ("qalms", "<f8"), ("costs", "<f8")])
+RECORD_STRUCT = struct.Struct("<qihhqddd")
+
+#kinds of records
+TRACE_KINDS = (TRC_BEGIN, TRC_INIT_SMOKING, TRC_INIT_QUIT, TRC_INIT_EVENTS, TRC_INIT_INTS, TRC_INIT_PROPHS,
+               TRC_SCREEN, TRC_CONF_TEST, TRC_PROPH_TOX, TRC_INT_TOX, TRC_PROPH_STOP, TRC_PROPH_START,
+               TRC_INT_STOP, TRC_INT_START, TRC_SMOKE_START, TRC_SMOKE_QUIT, TRC_SMOKE_RELAPSE,
+               TRC_EVENT, TRC_PEVENT_CURED, TRC_PEVENT, TRC_COMP, TRC_DEATH) = tuple(range(22))
+
+#text of each kind as (template, labels of the index, labels of the value, include totals).
+#Templates are formatted with pid, month, name (label of the index) and value (label of the value).
+#Values labeled "bool" are written as True or False and "mask:..." as the labels in the bitmask
+TRACE_TEXT = {TRC_BEGIN: ("\n\nBEGIN PATIENT {pid}\n\tgender: {name}, init age: {value} mths", "gender", None, False),
+              TRC_INIT_SMOKING: ("\n\tsmoking status: {name}, smoking intensity: {value}", "ss", "si", False),
+              TRC_INIT_QUIT: ("\n\tmonth of quit: {value}", None, None, True),
+              TRC_INIT_EVENTS: ("\n\tevents: {value}", None, "mask:event", False),
+              TRC_INIT_INTS: ("\n\tinterventions: {value}", None, "mask:intervention", False),
+              TRC_INIT_PROPHS: ("\n\tprophs: {value}", None, "mask:proph", False),
+              TRC_SCREEN: ("\n**{month} Pre-event {name} Screening, Result: {value},Status: {value}", "event", "bool", True),
+              TRC_CONF_TEST: ("\n**{month} Pre-event {name} Confirmatory Test", "event", None, True),
+              TRC_PROPH_TOX: ("\n**{month} Toxicity Proph: {name} ", "proph", None, True),
+              TRC_INT_TOX: ("\n**{month} Toxicity Intervention: {name} ", "intervention", None, True),
+              TRC_PROPH_STOP: ("\n**{month} Stopping Proph: {name}", "proph", None, True),
+              TRC_PROPH_START: ("\n**{month} Starting Proph: {name}", "proph", None, True),
+              TRC_INT_STOP: ("\n**{month} Stopping Intervention: {name}", "intervention", None, True),
+              TRC_INT_START: ("\n**{month} Starting Intervention: {name}", "intervention", None, True),
+              TRC_SMOKE_START: ("\n**{month} Smoking Start", None, None, True),
+              TRC_SMOKE_QUIT: ("\n**{month} Smoking Quit", None, None, True),
+              TRC_SMOKE_RELAPSE: ("\n**{month} Smoking Relapse", None, None, True),
+              TRC_EVENT: ("\n**{month} Event {name}", "event", None, True),
+              TRC_PEVENT_CURED: ("\n**{month} Pre-event {name} Cured", "event", None, True),
+              TRC_PEVENT: ("\n**{month} Pre-event {name}", "event", None, True),
+              TRC_COMP: ("\n**{month} Event {name} Complication", "event", None, True),
+              TRC_DEATH: ("\n**{month} DEATH {name}", "death", None, True),
+              }
+
+#names of the causes of death in traces
+def get_death_names(event_names):
+    death_names = ["Nat Hist","Old Age", "Proph Tox", "Intervention Tox", "Confirmatory Test",]
+    death_names.extend(["{0}".format(event_names[event]) for event in range(NUM_EVENTS)])
+    death_names.extend(["{0} Complication".format(event_names[event]) for event in range(NUM_EVENTS)])
+    return death_names
+
+#labels the records of a trace are rendered with
+def get_trace_labels(inputs):
+    return {"gender": GENDER_STRS,
+            "ss": SS_STRS,
+            "si": SI_STRS,
+            "event": list(inputs.sim.event_names),
+            "intervention": list(inputs.intervention.int_names),
+            "proph": list(inputs.prophs.proph_names),
+            "death": get_death_names(inputs.sim.event_names),
+            }
+
+#whether pid is traced. traced is the number of first pids traced, a collection
+#of pids or a predicate of the pid (which has to be picklable to run on workers)
+def is_traced(traced, pid):
+    if traced is None:
+        return False
+    if callable(traced):
+        return traced(pid)
+    if isinstance(traced, (int, np.integer)):
+        return pid < traced
+    return pid in traced
+
+#append only log of trace records. The records of each patient are contiguous
+#and index has the first and end record of each pid
+class TraceLog(object):
+    def __init__(self):
+        self.data = bytearray()
+        self.num_records = 0
+        self.index = {}
+    def add(self, pid, month, kind, index, value, totals):
+        self.data += RECORD_STRUCT.pack(pid, month, kind, index, value, *totals)
+        if pid in self.index:
+            self.index[pid][1] = self.num_records+1
+        else:
+            self.index[pid] = [self.num_records, self.num_records+1]
+        self.num_records += 1
+    #appends the records of a log of later patients
+    def merge(self, other):
+        self.data += other.data
+        for pid, (start, stop) in other.index.items():
+            self.index[pid] = [start+self.num_records, stop+self.num_records]
+        self.num_records += other.num_records
+    def get_records(self):
+        return np.frombuffer(bytes(self.data), TRACE_RECORD)
+    #pids with their first and end record in pid order
+    def get_index(self):
+        index = np.array([(pid, start, stop) for pid, (start, stop) in sorted(self.index.items())], int)
+        return index.reshape(-1, 3)
+
+#trace text of records
+def render_records(records, labels):
+    text = []
+    for pid, month, kind, index, value, lms, qalms, costs in records.tolist():
+        template, index_labels, value_labels, include_totals = TRACE_TEXT[kind]
+        name = labels[index_labels][index] if index_labels else None
+        if value_labels == "bool":
+            value = bool(value)
+        elif value_labels and value_labels.startswith("mask:"):
+            names = labels[value_labels[len("mask:"):]]
+            value = ",".join([names[j] for j in range(len(names)) if value >> j & 1])
+        elif value_labels:
+            value = labels[value_labels][value]
+        text.append(template.format(pid = pid, month = month, name = name, value = value))
+        if include_totals:
+            text.append(", LM {0:.2f}, QA {1:.2f}, $ {2:.2f}".format(lms, qalms, costs))
+        if kind == TRC_DEATH:
+            text.append("\nEND PATIENT {0}".format(pid))
+    return "".join(text)
+
+#renders the .smtrace text of a trace log, optionally of the pids given only
+if __name__ == "__main__":
+    from outputs import StoredTrace
+    logpath = sys.argv[1]
+    pids = [int(pid) for pid in sys.argv[2:]] or None
+    StoredTrace(logpath).write_text(logpath[:-len(".smtlog")]+".smtrace", pids)